@@ -5,6 +5,7 @@ RESOURCE_DIR = os.path.join(ROOT, "resources")
 
 CHARACTERISTICS_FILE = os.path.join(RESOURCE_DIR, "characteristics.json")
 SERVICES_FILE = os.path.join(RESOURCE_DIR, "services.json")
+EVENT_PRIORITIES_FILE = os.path.join(RESOURCE_DIR, "event_priorities.json")
 
 
 # Flag if QR Code dependencies are installed.
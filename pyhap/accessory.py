@@ -4,9 +4,10 @@ import logging
 import struct
 
 from pyhap import util, SUPPORT_QR_CODE
+from pyhap.characteristic import EVENT_PRIORITY_NORMAL, PROP_PRIORITY
 from pyhap.const import (
-    STANDALONE_AID, HAP_REPR_AID, HAP_REPR_IID, HAP_REPR_SERVICES,
-    HAP_REPR_VALUE, CATEGORY_OTHER, CATEGORY_BRIDGE)
+    STANDALONE_AID, HAP_REPR_AID, HAP_REPR_SERVICES, CATEGORY_OTHER,
+    CATEGORY_BRIDGE)
 from pyhap.iid_manager import IIDManager
 
 if SUPPORT_QR_CODE:
@@ -288,7 +289,7 @@ class Accessory:
 
     # Driver
 
-    def publish(self, value, sender):
+    def publish(self, value, sender, sender_client_addr=None):
         """Append AID and IID of the sender and forward it to the driver.
 
         Characteristics call this method to send updates.
@@ -298,13 +299,38 @@ class Accessory:
 
         :param sender: The Service or Characteristic from which the call originated.
         :type: Service or Characteristic
+
+        :param sender_client_addr: The client that wrote the value, if any.
+        :type sender_client_addr: tuple <str, int>
+
+        The event is sent with the priority in the sender's properties, if any.
+        The value is sent as the sender's cached ``value_bytes``, if it is its current
+        value.
         """
-        acc_data = {
-            HAP_REPR_AID: self.aid,
-            HAP_REPR_IID: self.iid_manager.get_iid(sender),
-            HAP_REPR_VALUE: value,
-        }
-        self.driver.publish(acc_data)
+        self.driver.publish_value(*self._event_of(value, sender, sender_client_addr))
+
+    def async_publish(self, value, sender, sender_client_addr=None):
+        """Like ``publish``, but return a future of the delivery of the event.
+
+        Must be called in the event loop.
+
+        .. seealso:: AccessoryDriver.async_publish
+
+        :rtype: asyncio.Future
+        """
+        return self.driver.async_publish_value(
+            *self._event_of(value, sender, sender_client_addr))
+
+    def _event_of(self, value, sender, sender_client_addr):
+        """Return the topic, value bytes, sender client and priority of an event."""
+        if hasattr(sender, 'value_bytes') and value is sender.value:
+            value_bytes = sender.value_bytes
+        else:
+            value_bytes = util.json_bytes(value)
+        priority = getattr(sender, 'properties', {}).get(PROP_PRIORITY,
+                                                         EVENT_PRIORITY_NORMAL)
+        return ((self.aid, self.iid_manager.get_iid(sender)), value_bytes,
+                sender_client_addr, priority)
 
 
 class Bridge(Accessory):
@@ -11,18 +11,28 @@ then add some more information and eventually the value change will reach the
 AccessoryDriver (all this happens through the publish() interface). The AccessoryDriver
 will then check if there is a client that subscribed for events from this exact
 Characteristic from this exact Accessory (remember, it could be a Bridge with more than
-one Accessory in it). If so, the event is put in a FIFO queue - the event queue. This
-terminates the call chain and concludes the publishing process from the Characteristic,
-the Characteristic does not block waiting for the actual send to happen.
-
-When the AccessoryDriver is started, it spawns an event dispatch thread. The purpose of
-this thread is to get events from the event queue and send them to subscribed clients.
+one Accessory in it). If so, the event is put in a FIFO queue - the event queue. The
+queue holds only the latest value of each characteristic: a newer value replaces the
+queued one, which is then never sent. This terminates the call chain and concludes the
+publishing process from the Characteristic. The Characteristic does not block waiting
+for the actual send to happen.
+
+The event queue belongs to the event loop of the driver. Events published in the loop,
+e.g. from an async run method, are queued right away. Events published from other
+threads are collected and handed to the loop in batches, with one
+call_soon_threadsafe per batch. High priority events are handed over one by one
+instead, and the loop takes them before the batches. Once events are queued, sending
+them is scheduled on the loop. The events that are queued within the coalescing
+window are merged into a single EVENT message per client, with the latest value of
+each characteristic.
 Whenever a send fails, the client is unsubscripted, as it is assumed that the client left
 or went to sleep before telling us. This concludes the publishing process from the
 AccessoryDriver.
 """
 import asyncio
+import collections
 from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import logging
 import socket
@@ -32,20 +42,29 @@ import sys
 import time
 import threading
 import json
-import queue
 
 from zeroconf import ServiceInfo, Zeroconf
 
-from pyhap.accessory import get_topic
-from pyhap.characteristic import CharacteristicError
+from pyhap.characteristic import (
+    EVENT_PRIORITY_HIGH, EVENT_PRIORITY_NORMAL, PROP_STATELESS, CharacteristicError)
 from pyhap.const import (
     STANDALONE_AID, HAP_PERMISSION_NOTIFY, HAP_REPR_ACCS, HAP_REPR_AID,
     HAP_REPR_CHARS, HAP_REPR_IID, HAP_REPR_STATUS, HAP_REPR_VALUE)
+from pyhap import util
 from pyhap.encoder import AccessoryEncoder
+from pyhap.hap_admission import (
+    DEFAULT_HANDSHAKE_BURST, DEFAULT_HANDSHAKE_RATE, DEFAULT_MAX_HANDSHAKES,
+    HandshakeAdmission)
+from pyhap.hap_connections import (
+    DEFAULT_EVENT_SEND_TIMEOUT, DEFAULT_MAX_EVENT_BACKLOG,
+    DEFAULT_MAX_EVENT_BACKLOG_BYTES, SLOW_CONSUMER_COALESCE, SlowConsumerPolicy)
+from pyhap.hap_crypto import DEFAULT_KEY_POOL_SIZE, X25519KeyPool
+from pyhap.hap_events import EventDelivery, LatestValueQueue, SubscriptionRegistry
+from pyhap.hap_protocol import AsyncHAPServer
 from pyhap.hap_server import HAPServer
-from pyhap.hsrp import Server as SrpServer
+from pyhap.hap_sessions import SessionCache
+import pyhap.hap_workers as hap_workers
 from pyhap.loader import Loader
-from pyhap.params import get_srp_context
 from pyhap.state import State
 
 logger = logging.getLogger(__name__)
@@ -53,6 +72,24 @@ logger = logging.getLogger(__name__)
 CHAR_STAT_OK = 0
 SERVICE_COMMUNICATION_FAILURE = -70402
 
+EVENT_PREFIX = '{{"{}": ['.format(HAP_REPR_CHARS).encode()
+EVENT_SUFFIX = b']}'
+CHAR_STAT_OK_SUFFIX = ', "{}": {}}}'.format(HAP_REPR_STATUS, CHAR_STAT_OK).encode()
+CHAR_STAT_ERROR_JSON = '{{"{}": %d, "{}": %d, "{}": %d}}'.format(
+    HAP_REPR_AID, HAP_REPR_IID, HAP_REPR_STATUS).encode()
+
+
+def event_payload(char_events):
+    """Return the body of an EVENT message with the given characteristic changes, or
+    of a characteristics response.
+
+    :param char_events: The JSON of each changed characteristic.
+    :type char_events: iterable <bytes>
+
+    :rtype: bytes
+    """
+    return EVENT_PREFIX + b', '.join(char_events) + EVENT_SUFFIX
+
 
 def callback(func):
     """Decorator for non blocking functions."""
@@ -116,10 +153,21 @@ class AccessoryDriver:
     """
 
     NUM_EVENTS_BEFORE_STATS = 100
+    MAX_COALESCED_EVENTS = 256  # queued events merged at most into one send
 
     def __init__(self, *, address=None, port=51234,
                  persist_file='accessory.state', pincode=None,
-                 encoder=None, loader=None, loop=None):
+                 encoder=None, loader=None, loop=None, threaded_server=False,
+                 server_workers=None, max_connections=None, idle_timeout=None,
+                 keypair_pool_size=DEFAULT_KEY_POOL_SIZE, keypair_refill_rate=None,
+                 max_handshakes=DEFAULT_MAX_HANDSHAKES,
+                 handshake_rate=DEFAULT_HANDSHAKE_RATE,
+                 handshake_burst=DEFAULT_HANDSHAKE_BURST, crypto_processes=None,
+                 event_coalesce_window=0,
+                 event_send_timeout=DEFAULT_EVENT_SEND_TIMEOUT,
+                 max_event_backlog=DEFAULT_MAX_EVENT_BACKLOG,
+                 max_event_backlog_bytes=DEFAULT_MAX_EVENT_BACKLOG_BYTES,
+                 slow_consumer_action=SLOW_CONSUMER_COALESCE, max_queued_events=None):
         """
         Initialize a new AccessoryDriver object.
 
@@ -145,12 +193,91 @@ class AccessoryDriver:
 
         :param encoder: The encoder to use when persisting/loading the Accessory state.
         :type encoder: AccessoryEncoder
+
+        :param threaded_server: Whether to serve each connection in its own thread with
+            the ``HAPServer``, instead of serving all connections from the event loop
+            with the ``AsyncHAPServer``.
+        :type threaded_server: bool
+
+        :param server_workers: With ``threaded_server``, serve the connections with a
+            pool of this many threads, instead of a thread per connection.
+        :type server_workers: int
+
+        :param max_connections: How many controller connections may be open at the
+            same time. Defaults to no limit.
+        :type max_connections: int
+
+        :param idle_timeout: Seconds without requests or events after which a
+            controller connection is closed. Defaults to keeping idle connections,
+            as controllers keep them open to receive events.
+        :type idle_timeout: float
+
+        :param keypair_pool_size: How many ephemeral X25519 key pairs for pair verify
+            to generate ahead of time, so that many controllers can reconnect at once
+            quickly. 0 to generate them during pair verify.
+        :type keypair_pool_size: int
+
+        :param keypair_refill_rate: How many key pairs per second to generate at most
+            when refilling the pool. Defaults to no limit.
+        :type keypair_refill_rate: float
+
+        :param max_handshakes: How many pair setup and pair verify requests may be
+            handled at the same time. More are rejected, so that a pairing storm does
+            not starve the requests of paired controllers. None for no limit.
+        :type max_handshakes: int
+
+        :param handshake_rate: How many pair setups or pair verifies per second each
+            address may start, sustained. None for no limit.
+        :type handshake_rate: float
+
+        :param handshake_burst: How many pair setups or pair verifies each address may
+            start at once.
+        :type handshake_burst: int
+
+        :param crypto_processes: Compute the SRP and pair verify crypto in a pool of
+            this many worker processes, so that handshakes do not hold the GIL and
+            stall the other connections. Defaults to computing it in the handler
+            thread. The processes are started right away, so create the driver
+            before starting other threads.
+        :type crypto_processes: int
+
+        :param event_coalesce_window: Seconds to wait for more characteristic changes
+            after one, e.g. 0.05, so that they are sent to each client in one EVENT
+            message. Changes that are already queued are always merged.
+        :type event_coalesce_window: float
+
+        :param event_send_timeout: Seconds in which events must be sent to a
+            controller. If it does not read them in time, it is disconnected. None to
+            wait forever.
+        :type event_send_timeout: float
+
+        :param max_event_backlog: How many events may be queued for a controller.
+            None for no limit.
+        :type max_event_backlog: int
+
+        :param max_event_backlog_bytes: How many bytes of events may be queued for a
+            controller. None for no limit.
+        :type max_event_backlog_bytes: int
+
+        :param slow_consumer_action: What to do once the backlog of a controller is
+            full: "drop" its oldest events, "coalesce" them into the latest value of
+            each characteristic, or "disconnect" it.
+        :type slow_consumer_action: str
+
+        :param max_queued_events: How many events may be outstanding, i.e. queued or
+            pushed to a client but not written yet, before ``async_wait_for_room``
+            makes producers wait. An event counts once per client. None for no limit.
+        :type max_queued_events: int
         """
         if sys.platform == 'win32':
             self.loop = loop or asyncio.ProactorEventLoop()
         else:
             self.loop = loop or asyncio.new_event_loop()
 
+        self.crypto_pool = None
+        if crypto_processes:
+            self.crypto_pool = hap_workers.CryptoProcessPool(crypto_processes)
+
         executer_opts = {'max_workers': None}
         if sys.version_info >= (3, 6):
             executer_opts['thread_name_prefix'] = 'SyncWorker'
@@ -163,23 +290,70 @@ class AccessoryDriver:
         self.advertiser = Zeroconf()
         self.persist_file = os.path.expanduser(persist_file)
         self.encoder = encoder or AccessoryEncoder()
-        self.topics = {}  # topic: set of (address, port) of subscribed clients
-        self.topic_lock = threading.Lock()  # for exclusive access to the topics
+        self.subscriptions = SubscriptionRegistry()
+        # (aid, iid) topic: frozenset of (address, port) of subscribed clients
+        self.topics = self.subscriptions.topics
+        # (aid, iid): the JSON of a characteristic up to its value, e.g. the
+        # '{"aid": 1, "iid": 9, "value": ' of its events
+        self.char_prefixes = {}
+        # (aid, iid): whether the events of the characteristic are stateless, i.e.
+        # queued without superseding each other
+        self.stateless_topics = {}
         self.loader = loader or Loader()
         self.aio_stop_event = asyncio.Event(loop=self.loop)
         self.stop_event = threading.Event()
-        self.event_queue = queue.Queue()  # (topic, bytes)
-        self.send_event_thread = None  # the event dispatch thread
+        # ((aid, iid), JSON bytes of the characteristic, sender client, priority), the
+        # latest of each topic, used in the event loop only
+        self.event_queue = LatestValueQueue()
+        # Events published from other threads, until the loop takes them.
+        self.published_events = collections.deque()
+        self.handover_scheduled = False  # whether _take_published_events is scheduled
+        # High priority events published from other threads, handed over one by one
+        self.urgent_events = collections.deque()
+        self.event_coalesce_window = event_coalesce_window
+        self.send_events_handle = None  # the scheduled _send_events, if any
+        self.send_events_delayed = False  # whether it waits for the coalescing window
+        # (aid, iid): futures of the publishers of the queued event of the topic
+        self.event_futures = {}
+        self.max_queued_events = max_queued_events
+        # Events pushed to clients and not written yet, each once per client. Counted
+        # only with max_queued_events.
+        self.unwritten_events = 0
+        self.event_room = asyncio.Event(loop=self.loop)  # set while below the limit
+        self.event_room.set()
+        # callback: its asyncio.TimerHandle and on_cancel callback, see call_later
+        self.later_calls = {}
         self.sent_events = 0
         self.accumulated_qsize = 0
 
         self.mdns_service_info = None
-        self.srp_verifier = None
+        self.next_srp_verifier = None  # future of the precomputed SRP verifier
+        self.srp_lock = threading.Lock()  # for next_srp_verifier
+        self.session_cache = SessionCache()  # resumable pair verify sessions
+        self.handshake_admission = HandshakeAdmission(max_handshakes, handshake_rate,
+                                                      handshake_burst)
+        self.keypair_pool = X25519KeyPool(keypair_pool_size, keypair_refill_rate,
+                                          self.executer)
         self.accessory_thread = None
 
+        self.slow_consumer = SlowConsumerPolicy(
+            slow_consumer_action, max_event_backlog, max_event_backlog_bytes,
+            event_send_timeout)
+
         self.state = State(address=address, pincode=pincode, port=port)
         network_tuple = (self.state.address, self.state.port)
-        self.http_server = HAPServer(network_tuple, self)
+        self.threaded_server = threaded_server
+        if threaded_server:
+            self.http_server = HAPServer(network_tuple, self,
+                                         max_workers=server_workers,
+                                         max_connections=max_connections,
+                                         idle_timeout=idle_timeout,
+                                         slow_consumer=self.slow_consumer)
+        else:
+            self.http_server = AsyncHAPServer(network_tuple, self,
+                                              max_connections=max_connections,
+                                              idle_timeout=idle_timeout,
+                                              slow_consumer=self.slow_consumer)
 
     def start(self):
         """Start the event loop and call `_do_start`.
@@ -202,7 +376,6 @@ class AccessoryDriver:
         """Starts the accessory.
 
         - Call the accessory's run method.
-        - Start handling accessory events.
         - Start the HAP server.
         - Publish a mDNS advertisement.
         - Print the setup QR code if the accessory is not paired.
@@ -217,27 +390,25 @@ class AccessoryDriver:
                     self.accessory.display_name, self.state.address,
                     self.state.port)
 
-        # Start sending events to clients. This is done in a daemon thread, because:
-        # - if the queue is blocked waiting on an empty queue, then there is nothing left
-        #   for clean up.
-        # - if the queue is currently sending an event to the client, then, when it has
-        #   finished, it will check the run sentinel, see that it is set and break the
-        #   loop. Alternatively, the server's server_close method will shutdown and close
-        #   the socket, while sending is in progress, which will result abort the sending.
-        self.send_event_thread = threading.Thread(daemon=True, target=self.send_events)
-        self.send_event_thread.start()
-
         # Start listening for requests
-        self.http_server_thread = threading.Thread(target=self.http_server.serve_forever)
-        self.http_server_thread.start()
+        if self.threaded_server:
+            self.http_server_thread = threading.Thread(
+                target=self.http_server.serve_forever)
+            self.http_server_thread.start()
+        else:
+            asyncio.run_coroutine_threadsafe(
+                self.http_server.async_start(self.loop), self.loop).result()
 
         # Advertise the accessory as a mDNS service.
         self.mdns_service_info = AccessoryMDNSServiceInfo(
             self.accessory, self.state)
         self.advertiser.register_service(self.mdns_service_info)
 
+        self.keypair_pool.refill()
+
         # Print accessory setup message
         if not self.state.paired:
+            self.prepare_srp_verifier()
             self.accessory.setup_message()
 
         # Start the accessory so it can do stuff.
@@ -252,8 +423,13 @@ class AccessoryDriver:
     async def async_stop(self):
         """Stops the AccessoryDriver and shutdown all remaining tasks."""
         await self.async_add_job(self._do_stop)
+        for later_call in self.later_calls.values():
+            self._cancel_later_call(*later_call)
+        self.later_calls.clear()
         logger.debug('Shutdown executers')
         self.executer.shutdown()
+        if self.crypto_pool is not None:
+            self.crypto_pool.shutdown()
         self.loop.stop()
 
     def _do_stop(self):
@@ -272,6 +448,7 @@ class AccessoryDriver:
         logger.debug("Setting stop events, stopping accessory and event sending")
         self.stop_event.set()
         self.loop.call_soon_threadsafe(self.aio_stop_event.set)
+        self.keypair_pool.close()
         self.add_job(self.accessory.stop)
 
         logger.debug("Stopping mDNS advertising")
@@ -279,9 +456,13 @@ class AccessoryDriver:
         self.advertiser.close()
 
         logger.debug("Stopping HAP server")
-        self.http_server.shutdown()
-        self.http_server.server_close()
-        self.http_server_thread.join()
+        if self.threaded_server:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server_thread.join()
+        else:
+            asyncio.run_coroutine_threadsafe(
+                self.http_server.async_stop(), self.loop).result()
 
         logger.debug("AccessoryDriver stopped successfully")
 
@@ -318,6 +499,69 @@ class AccessoryDriver:
         else:
             self.async_add_job(target, *args)
 
+    def call_later(self, delay, target, on_cancel=None):
+        """Call the given callback in the event loop after ``delay`` seconds.
+
+        Thread-safe. A callback that is already pending is not scheduled again, and
+        the pending callbacks are cancelled when the driver stops.
+
+        :param on_cancel: Called instead of ``target`` if the call is refused, as the
+            driver is stopping or its loop is closed, or cancelled.
+        :type on_cancel: callable
+        """
+        if util.in_loop(self.loop):
+            self.async_call_later(delay, target, on_cancel)
+            return
+        if not self.stop_event.is_set():
+            try:
+                self.loop.call_soon_threadsafe(
+                    self.async_call_later, delay, target, on_cancel)
+                return
+            except RuntimeError:  # The loop is closed.
+                pass
+        if on_cancel is not None:
+            on_cancel()
+
+    @callback
+    def async_call_later(self, delay, target, on_cancel=None):
+        """Like ``call_later``, from within the event loop."""
+        if target in self.later_calls:
+            return
+        if self.aio_stop_event.is_set():
+            if on_cancel is not None:
+                on_cancel()
+            return
+        self.later_calls[target] = (
+            self.loop.call_later(delay, self._run_later, target), on_cancel)
+
+    def cancel_call_later(self, target):
+        """Cancel the pending call of the given callback, if any. Thread-safe."""
+        if util.in_loop(self.loop):
+            self.async_cancel_call_later(target)
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.async_cancel_call_later, target)
+        except RuntimeError:  # The loop is closed.
+            pass
+
+    @callback
+    def async_cancel_call_later(self, target):
+        """Like ``cancel_call_later``, from within the event loop."""
+        later_call = self.later_calls.pop(target, None)
+        if later_call is not None:
+            self._cancel_later_call(*later_call)
+
+    @staticmethod
+    def _cancel_later_call(handle, on_cancel):
+        handle.cancel()
+        if on_cancel is not None:
+            on_cancel()
+
+    @callback
+    def _run_later(self, target):
+        del self.later_calls[target]
+        target()
+
     def add_accessory(self, accessory):
         """Add top level accessory to driver."""
         self.accessory = accessory
@@ -338,84 +582,360 @@ class AccessoryDriver:
         :param client: A client (address, port) tuple that should be subscribed.
         :type client: tuple <str, int>
 
-        :param topic: The topic to which to subscribe.
-        :type topic: str
+        :param topic: The (aid, iid) of the characteristic to which to subscribe.
+        :type topic: tuple <int, int>
 
         :param subscribe: Whether to subscribe or unsubscribe the client. Both subscribing
             an already subscribed client and unsubscribing a client that is not subscribed
             do nothing.
         :type subscribe: bool
         """
-        with self.topic_lock:
-            if subscribe:
-                subscribed_clients = self.topics.get(topic)
-                if subscribed_clients is None:
-                    subscribed_clients = set()
-                    self.topics[topic] = subscribed_clients
-                subscribed_clients.add(client)
-            else:
-                if topic not in self.topics:
-                    return
-                subscribed_clients = self.topics[topic]
-                subscribed_clients.discard(client)
-                if not subscribed_clients:
-                    del self.topics[topic]
+        self.subscriptions.subscribe(client, topic, subscribe)
+
+    def unsubscribe_client(self, client):
+        """Unsubscribe the given client from all topics, thread-safe.
 
-    def publish(self, data):
+        Called by the HAP server when the connection with the client is closed.
+
+        :param client: A client (address, port) tuple.
+        :type client: tuple <str, int>
+        """
+        self.subscriptions.unsubscribe_client(client)
+
+    def publish(self, data, sender_client_addr=None,
+                priority=EVENT_PRIORITY_NORMAL):
         """Publishes an event to the client.
 
         The publishing occurs only if the current client is subscribed to the topic for
-        the aid and iid contained in the data.
+        the aid and iid contained in the data. If an event of the topic is still
+        queued, it is replaced.
 
         :param data: The data to publish. It must at least contain the keys "aid" and
             "iid".
         :type data: dict
+
+        :param sender_client_addr: The client that wrote the value, if any. It is not
+            sent the event, as it knows the value already.
+        :type sender_client_addr: tuple <str, int>
+
+        :param priority: The delivery priority, an ``EVENT_PRIORITY_*`` value. Queued
+            events of a higher priority are sent first.
+        :type priority: int
+        """
+        topic = (data[HAP_REPR_AID], data[HAP_REPR_IID])
+        if topic not in self.subscriptions:
+            return
+
+        self._queue_event((topic, json.dumps(data).encode(), sender_client_addr,
+                           priority))
+
+    def publish_value(self, topic, value_bytes, sender_client_addr=None,
+                      priority=EVENT_PRIORITY_NORMAL):
+        """Like ``publish``, but for an already encoded value.
+
+        The event is the cached JSON prefix of the characteristic followed by the
+        given bytes, thus no dict is built and nothing is encoded.
+
+        :param topic: The (aid, iid) of the characteristic.
+        :type topic: tuple <int, int>
+
+        :param value_bytes: The JSON encoding of the value, e.g.
+            ``Characteristic.value_bytes``.
+        :type value_bytes: bytes
+        """
+        if topic not in self.subscriptions:
+            return
+
+        self._queue_event((topic, self._char_prefix(topic) + value_bytes + b'}',
+                           sender_client_addr, priority))
+
+    @callback
+    def async_publish(self, data, sender_client_addr=None,
+                      priority=EVENT_PRIORITY_NORMAL):
+        """Like ``publish``, but return a future of the delivery of the event.
+
+        Must be called in the event loop.
+
+        :return: A future, whose result is True once the event is written to all
+            subscribed clients (right away if there are none), False if it could not
+            be written to any of them. A newer value of the characteristic that
+            replaces the queued event is delivered in its stead.
+        :rtype: asyncio.Future
+        """
+        topic = (data[HAP_REPR_AID], data[HAP_REPR_IID])
+        return self._async_publish_event(
+            (topic, json.dumps(data).encode(), sender_client_addr, priority))
+
+    @callback
+    def async_publish_value(self, topic, value_bytes, sender_client_addr=None,
+                            priority=EVENT_PRIORITY_NORMAL):
+        """Like ``publish_value``, but return a future of the delivery of the event.
+
+        Must be called in the event loop.
+
+        .. seealso:: async_publish
+
+        :rtype: asyncio.Future
+        """
+        return self._async_publish_event(
+            (topic, self._char_prefix(topic) + value_bytes + b'}', sender_client_addr,
+             priority))
+
+    def _async_publish_event(self, event):
+        future = self.loop.create_future()
+        topic = event[0]
+        if topic not in self.subscriptions:
+            future.set_result(True)
+            return future
+        self.event_futures.setdefault(topic, []).append(future)
+        self._async_queue_event(event)
+        return future
+
+    async def async_wait_for_room(self, timeout=None):
+        """Wait until fewer than ``max_queued_events`` events are outstanding.
+
+        Producers that publish faster than the events can be sent, e.g. a bridge of
+        values from elsewhere, call this before publishing, so that they are slowed
+        down to the pace of the clients: an event pushed to a client is outstanding
+        until it is written to the connection, dropped or merged into a later event
+        that is written.
+
+        :param timeout: Seconds to wait at most. None to wait as long as it takes.
+        :type timeout: float
+
+        :return: True if there is room, False if it timed out.
+        :rtype: bool
+        """
+        if self.event_room.is_set():
+            return True
+        return await util.event_wait(self.event_room, timeout, loop=self.loop)
+
+    def _char_prefix(self, topic):
+        """Return the JSON of the characteristic with the given topic, up to its value.
+
+        :rtype: bytes
+        """
+        prefix = self.char_prefixes.get(topic)
+        if prefix is None:
+            prefix = self.char_prefixes[topic] = '{{"{}": {}, "{}": {}, "{}": '.format(
+                HAP_REPR_AID, topic[0], HAP_REPR_IID, topic[1], HAP_REPR_VALUE).encode()
+        return prefix
+
+    def _is_stateless(self, topic):
+        """Return whether the characteristic with the given topic is stateless.
+
+        .. seealso:: characteristic.PROP_STATELESS
+
+        :rtype: bool
+        """
+        stateless = self.stateless_topics.get(topic)
+        if stateless is None:
+            char = self.accessory and self.accessory.get_characteristic(*topic)
+            stateless = self.stateless_topics[topic] = bool(
+                char and char.properties.get(PROP_STATELESS))
+        return stateless
+
+    def _queue_event(self, event):
+        """Queue the given event in the event loop, thread-safe.
+
+        In the loop, the event is queued right away. From other threads, it is handed
+        over to the loop along with the other events published until the loop takes
+        them. A high priority event is handed over on its own, and the loop takes it
+        before the rest of a batch.
         """
-        topic = get_topic(data[HAP_REPR_AID], data[HAP_REPR_IID])
-        if topic not in self.topics:
+        if util.in_loop(self.loop):
+            self._async_queue_event(event)
             return
+        try:
+            if event[-1] == EVENT_PRIORITY_HIGH:
+                self.urgent_events.append(event)
+                self.loop.call_soon_threadsafe(self._take_urgent_events)
+                return
+            self.published_events.append(event)
+            if not self.handover_scheduled:
+                self.handover_scheduled = True
+                self.loop.call_soon_threadsafe(self._take_published_events)
+        except RuntimeError:  # The loop is closed.
+            pass
+
+    @callback
+    def _take_urgent_events(self):
+        """Queue the high priority events published from other threads, if any."""
+        urgent_events = self.urgent_events
+        while urgent_events:
+            self._async_queue_event(urgent_events.popleft())
+
+    @callback
+    def _take_published_events(self):
+        """Queue the events published from other threads."""
+        # Reset first, so that an event published from now on schedules another call.
+        self.handover_scheduled = False
+        published_events = self.published_events
+        while published_events:
+            if self.urgent_events:
+                # Let the high priority events be sent first, take the rest after.
+                self.handover_scheduled = True
+                self.loop.call_soon(self._take_published_events)
+                return
+            self._async_queue_event(published_events.popleft())
 
-        data = {HAP_REPR_CHARS: [data]}
-        bytedata = json.dumps(data).encode()
-        self.event_queue.put((topic, bytedata))
+    @callback
+    def _async_queue_event(self, event):
+        """Queue the given event and schedule sending it.
+
+        High priority events are sent right away. Others are sent once the coalescing
+        window after the first of them is over, along with the events queued until then.
+        """
+        self.event_queue.put(event, supersede=not self._is_stateless(event[0]))
+        self._update_event_room()
+        if event[-1] == EVENT_PRIORITY_HIGH or not self.event_coalesce_window:
+            if self.send_events_handle is not None:
+                if not self.send_events_delayed:
+                    return
+                self.send_events_handle.cancel()
+            self.send_events_handle = self.loop.call_soon(self._send_events)
+            self.send_events_delayed = False
+        elif self.send_events_handle is None:
+            self.send_events_handle = self.loop.call_later(
+                self.event_coalesce_window, self._send_events)
+            self.send_events_delayed = True
+
+    @callback
+    def _send_events(self):
+        """Send the queued events to clients.
+
+        The events are sent to each subscribed client in one message, with the latest
+        value of each characteristic. The client that wrote a value is not sent it
+        back. Events of a higher priority are taken from the queue first. The average
+        queue size for the past NUM_EVENTS_BEFORE_STATS is logged. Enable debug logging
+        to see this information.
+
+        ``push_event`` only queues the event on the connection of the client, which
+        writes it on its own. Whenever the client is not connected or is disconnected
+        as a slow consumer (i.e. ``push_event`` returns False), it is unsubscribed from
+        all topics. If writing fails, the connection is closed and the client is
+        unsubscribed too.
+        """
+        self.send_events_handle = None
+        self._take_urgent_events()  # so that they are taken first
+        events = self._get_events()
+        if not events:
+            return
+        self._dispatch_events(events)
+        self.sent_events += len(events)
+        self.accumulated_qsize += len(self.event_queue) * len(events)
+        if self.sent_events > self.NUM_EVENTS_BEFORE_STATS:
+            logger.debug('Average queue size for the past %s events: %.2f, '
+                         '%d superseded events so far',
+                         self.sent_events, self.accumulated_qsize / self.sent_events,
+                         self.event_queue.stats()['superseded'])
+            self.sent_events = 0
+            self.accumulated_qsize = 0
+        self._update_event_room()
+        if self.event_queue:
+            # The rest of the events was queued within the coalescing window as well.
+            self.send_events_handle = self.loop.call_soon(self._send_events)
+            self.send_events_delayed = False
 
-    def send_events(self):
-        """Start sending events from the queue to clients.
+    @callback
+    def _update_event_room(self):
+        """Set or clear ``event_room`` according to the outstanding events."""
+        if self.max_queued_events is None:
+            return
+        if len(self.event_queue) + self.unwritten_events < self.max_queued_events:
+            self.event_room.set()
+        else:
+            self.event_room.clear()
 
-        This continues until self.run_sentinel is set. The method logs the average
-        queue size for the past NUM_EVENTS_BEFORE_STATS. Enable debug logging to see this
-        information.
+    def _get_events(self):
+        """Take the events to send in one batch from the queue.
 
-        Whenever sending an event fails (i.e. HAPServer.push_event returns False), the
-        intended client is removed from the set of subscribed clients for the topic.
+        A batch that starts with high priority events ends before the first event of a
+        lower priority, so that they are not held up by a large batch. A batch ends
+        before a second event of a topic as well, e.g. another press of a stateless
+        switch, which would be merged with the first one otherwise.
 
-        @note: This method blocks on Queue.get, waiting for something to come. Thus, if
-        this is not run in a daemon thread or it is run on the main thread, the app will
-        hang.
+        :return: The (topic, bytes, sender client, priority) of each event, if any.
+        :rtype: list
         """
-        while not self.loop.is_closed():
-            # Maybe consider having a pool of worker threads, each performing a send in
-            # order to increase throughput.
-            topic, bytedata = self.event_queue.get()
-            subscribed_clients = self.topics.get(topic, [])
+        events = []
+        topics = set()
+        event_queue = self.event_queue
+        urgent_events = event_queue.events[EVENT_PRIORITY_HIGH]
+        urgent = bool(urgent_events)
+        while event_queue and len(events) < self.MAX_COALESCED_EVENTS:
+            if urgent and not urgent_events:
+                break
+            if event_queue.unsuperseded:
+                topic = event_queue.peek()[0]
+                if topic in topics:
+                    break
+                topics.add(topic)
+            events.append(event_queue.get())
+        return events
+
+    def _dispatch_events(self, events):
+        """Send the given events, merged into one message per subscribed client.
+
+        :param events: The (topic, bytes, sender client, priority) of each event,
+            oldest first.
+        :type events: list
+        """
+        client_events = {}  # client: {topic: bytes}, the latest of each topic
+        deliveries = {}  # topic: EventDelivery, for events with waiting publishers
+        for topic, bytedata, sender_client_addr, _ in events:
             logger.debug('Send event: topic(%s), data(%s)', topic, bytedata)
-            for client_addr in subscribed_clients.copy():
-                logger.debug('Sending event to client: %s', client_addr)
-                pushed = self.http_server.push_event(bytedata, client_addr)
-                if not pushed:
-                    logger.debug('Could not send event to %s, probably stale socket.',
-                                 client_addr)
-                    # Maybe consider removing the client_addr from every topic?
-                    self.subscribe_client_topic(client_addr, topic, False)
-            self.event_queue.task_done()
-            self.sent_events += 1
-            self.accumulated_qsize += self.event_queue.qsize()
-
-            if self.sent_events > self.NUM_EVENTS_BEFORE_STATS:
-                logger.debug('Average queue size for the past %s events: %.2f',
-                             self.sent_events, self.accumulated_qsize / self.sent_events)
-                self.sent_events = 0
-                self.accumulated_qsize = 0
+            clients = self.subscriptions.get(topic)
+            for client_addr in clients:
+                if client_addr == sender_client_addr:
+                    client_events.get(client_addr, {}).pop(topic, None)
+                    continue
+                client_events.setdefault(client_addr, {})[topic] = bytedata
+            futures = self.event_futures.pop(topic, None)
+            if futures:
+                deliveries[topic] = EventDelivery(
+                    futures, clients - {sender_client_addr})
+        for client_addr, topic_events in client_events.items():
+            logger.debug('Sending %d events to client: %s', len(topic_events),
+                         client_addr)
+            payload = event_payload(topic_events.values())
+            client_deliveries = [deliveries[topic] for topic in topic_events
+                                 if topic in deliveries]
+            # Counted until written, if producers wait for room
+            counted = 0 if self.max_queued_events is None else len(topic_events)
+            if client_deliveries or counted:
+                self.unwritten_events += counted
+                pushed = self.http_server.push_event(
+                    payload, client_addr, functools.partial(
+                        self._events_written, client_addr, client_deliveries,
+                        counted))
+            else:
+                pushed = self.http_server.push_event(payload, client_addr)
+            if not pushed:
+                logger.debug('Could not send event to %s, probably stale socket.',
+                             client_addr)
+                self.unsubscribe_client(client_addr)
+                self._events_written(client_addr, client_deliveries, counted, False)
+
+    def _events_written(self, client_addr, deliveries, counted, written):
+        """Record whether the events of the given deliveries were written to the given
+        client, thread-safe.
+
+        :param counted: How many of the events are in ``unwritten_events``.
+        :type counted: int
+        """
+        if not util.in_loop(self.loop):
+            try:
+                self.loop.call_soon_threadsafe(
+                    self._events_written, client_addr, deliveries, counted, written)
+            except RuntimeError:  # The loop is closed.
+                pass
+            return
+        for delivery in deliveries:
+            delivery.written(client_addr, written)
+        if counted:
+            self.unwritten_events -= counted
+            self._update_event_room()
 
     def config_changed(self):
         """Notify the driver that the accessory's configuration has changed.
@@ -425,6 +945,7 @@ class AccessoryDriver:
         to fetch new data.
         """
         self.state.config_version += 1
+        self.stateless_topics.clear()
         self.persist()
         self.update_advertisement()
 
@@ -481,15 +1002,55 @@ class AccessoryDriver:
         """
         logger.info("Unpairing client %s.", client_uuid)
         self.state.remove_paired_client(client_uuid)
+        self.session_cache.remove_client(client_uuid)
         self.persist()
         self.update_advertisement()
+        if not self.state.paired:
+            self.prepare_srp_verifier()
+
+    def _create_srp_verifier(self):
+        """Create an SRP verifier for the accessory's info.
+
+        Computes a new salt, the verifier, k and an ephemeral (b, B) pair.
+        """
+        return hap_workers.create_srp_verifier(self.state.pincode)
+
+    def prepare_srp_verifier(self):
+        """Start precomputing the SRP verifier of the next pair setup attempt.
 
-    def setup_srp_verifier(self):
-        """Create an SRP verifier for the accessory's info."""
-        # TODO: Move the below hard-coded values somewhere nice.
-        ctx = get_srp_context(3072, hashlib.sha512, 16)
-        verifier = SrpServer(ctx, b'Pair-Setup', self.state.pincode)
-        self.srp_verifier = verifier
+        The verifier is created in the executor, or the crypto pool if there is
+        one, so that pair setup can answer the first request of the controller
+        right away.
+        """
+        with self.srp_lock:
+            if self.next_srp_verifier is not None:
+                return
+            try:
+                if self.crypto_pool is not None:
+                    self.next_srp_verifier = self.crypto_pool.submit(
+                        hap_workers.create_srp_verifier, self.state.pincode)
+                else:
+                    self.next_srp_verifier = self.executer.submit(
+                        self._create_srp_verifier)
+            except RuntimeError:  # The executor is shut down.
+                pass
+
+    def new_srp_verifier(self):
+        """Return the SRP verifier for a new pair setup attempt.
+
+        Uses the precomputed verifier, waiting for it if it is not ready yet, and
+        starts precomputing the next one. Each attempt gets its own verifier, with a
+        fresh salt and ephemeral (b, B) pair, which the connection of the attempt
+        keeps. Thus, concurrent attempts do not interfere.
+
+        :rtype: pyhap.hsrp.Server
+        """
+        with self.srp_lock:
+            future, self.next_srp_verifier = self.next_srp_verifier, None
+        verifier = future.result() if future is not None \
+            else self._create_srp_verifier()
+        self.prepare_srp_verifier()
+        return verifier
 
     def get_accessories(self):
         """Returns the accessory in HAP format.
@@ -519,14 +1080,16 @@ class AccessoryDriver:
         hap_rep = self.accessory.to_HAP()
         if not isinstance(hap_rep, list):
             hap_rep = [hap_rep, ]
-        logger.debug('Get accessories response:\n%s', json.dumps(hap_rep, indent=3))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Get accessories response:\n%s', json.dumps(hap_rep, indent=3))
         return {HAP_REPR_ACCS: hap_rep}
 
     def get_characteristics(self, char_ids):
         """Returns values for the required characteristics.
 
-        :param char_ids: A list of characteristic "paths", e.g. "1.2" is aid 1, iid 2.
-        :type char_ids: list<str>
+        :param char_ids: A list of characteristic (aid, iid) pairs, or "paths", e.g.
+            "1.2" is aid 1, iid 2.
+        :type char_ids: list<tuple<int, int>> or list<str>
 
         :return: Status success for each required characteristic. For example:
 
@@ -544,20 +1107,52 @@ class AccessoryDriver:
         """
         chars = []
         for id in char_ids:
-            aid, iid = (int(i) for i in id.split('.'))
+            if isinstance(id, str):
+                aid, iid = (int(i) for i in id.split('.'))
+            else:
+                aid, iid = id
             rep = {HAP_REPR_AID: aid, HAP_REPR_IID: iid}
             char = self.accessory.get_characteristic(aid, iid)
             try:
                 rep[HAP_REPR_VALUE] = char.get_value()
                 rep[HAP_REPR_STATUS] = CHAR_STAT_OK
             except CharacteristicError:
-                logger.error("Error getting value for characteristic %s.", id)
+                logger.error("Error getting value for characteristic %s.",
+                             (aid, iid))
                 rep[HAP_REPR_STATUS] = SERVICE_COMMUNICATION_FAILURE
 
             chars.append(rep)
-        logger.debug("Get chars response: %s", json.dumps(chars, indent=3))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Get chars response: %s", json.dumps(chars, indent=3))
         return {HAP_REPR_CHARS: chars}
 
+    def get_characteristics_json(self, char_ids):
+        """Like ``get_characteristics``, but return the response body as JSON.
+
+        The body is joined from the cached JSON prefix and value of each
+        characteristic, without building dicts or encoding values again.
+
+        :rtype: bytes
+        """
+        chars = []
+        for id in char_ids:
+            if isinstance(id, str):
+                aid, iid = (int(i) for i in id.split('.'))
+            else:
+                aid, iid = id
+            char = self.accessory.get_characteristic(aid, iid)
+            try:
+                char.get_value()
+                chars.append(self._char_prefix((aid, iid)) + char.value_bytes
+                             + CHAR_STAT_OK_SUFFIX)
+            except CharacteristicError:
+                logger.error("Error getting value for characteristic %s.",
+                             (aid, iid))
+                chars.append(CHAR_STAT_ERROR_JSON % (
+                    aid, iid, SERVICE_COMMUNICATION_FAILURE))
+        logger.debug("Get chars response: %s", chars)
+        return event_payload(chars)
+
     def set_characteristics(self, chars_query, client_addr):
         """Called from ``HAPServerHandler`` when iOS configures the characteristics.
 
@@ -582,15 +1177,14 @@ class AccessoryDriver:
             char = self.accessory.get_characteristic(aid, iid)
 
             if HAP_PERMISSION_NOTIFY in cq:
-                char_topic = get_topic(aid, iid)
-                logger.debug('Subscribed client %s to topic %s',
-                             client_addr, char_topic)
+                logger.debug('Subscribed client %s to topic %s.%s',
+                             client_addr, aid, iid)
                 self.subscribe_client_topic(
-                    client_addr, char_topic, cq[HAP_PERMISSION_NOTIFY])
+                    client_addr, (aid, iid), cq[HAP_PERMISSION_NOTIFY])
 
             if HAP_REPR_VALUE in cq:
                 # TODO: status needs to be based on success of set_value
-                char.client_update_value(cq[HAP_REPR_VALUE])
+                char.client_update_value(cq[HAP_REPR_VALUE], client_addr)
 
     def signal_handler(self, _signal, _frame):
         """Stops the AccessoryDriver for a given signal.
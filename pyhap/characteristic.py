@@ -4,13 +4,16 @@ All things for a HAP characteristic.
 A Characteristic is the smallest unit of the smart home, e.g.
 a temperature measuring or a device status.
 """
+import asyncio
 import logging
+import time
 
 from uuid import UUID
 
 from pyhap.const import (
     HAP_PERMISSION_READ, HAP_REPR_DESC, HAP_REPR_FORMAT, HAP_REPR_IID,
     HAP_REPR_MAX_LEN, HAP_REPR_PERM, HAP_REPR_TYPE, HAP_REPR_VALUE)
+from pyhap.util import json_bytes
 
 logger = logging.getLogger(__name__)
 
@@ -64,6 +67,41 @@ PROP_VALID_VALUES = 'ValidValues'
 
 PROP_NUMERIC = (PROP_MAX_VALUE, PROP_MIN_VALUE, PROP_MIN_STEP, PROP_UNIT)
 
+# ### Notification policy properties ###
+# Not part of the HAP representation. They filter the notifications of `set_value`.
+PROP_SKIP_UNCHANGED = 'skipUnchanged'  # bool, do not notify the same value again
+# Numerics: notify only if the value moved by at least this much since the last
+# notification. Setting it implies skipUnchanged. With skipUnchanged alone, minStep is
+# used, i.e. changes that controllers would not display are not sent.
+PROP_DEADBAND = 'deadband'
+# Numerics: notify only if the value moved by at least this fraction of the last
+# notified value, e.g. 0.05. Implies skipUnchanged.
+PROP_RELATIVE_DEADBAND = 'relativeDeadband'
+# Seconds between notifications at least. A value set in between is sent once the
+# interval is over, unless a later value supersedes it.
+PROP_MIN_NOTIFY_INTERVAL = 'minNotifyInterval'
+DEADBAND_TOLERANCE = 1e-6  # relative, for floating point errors
+# The delivery priority of the events, one of the EVENT_PRIORITY_* values. When set
+# with override_properties, a name of EVENT_PRIORITIES, e.g. 'high', can be given
+# instead. Defaults for the HAP types are set by the loader, see
+# resources/event_priorities.json.
+PROP_PRIORITY = 'priority'
+# bool, each value is news of its own, e.g. a button press, thus a newer value does not
+# replace a queued one and the same value is notified again. Set by the loader for the
+# HAP types, see resources/event_priorities.json.
+PROP_STATELESS = 'stateless'
+
+# ### Event priorities ###
+# Queued events of a higher priority (lower number) are sent first.
+EVENT_PRIORITY_HIGH = 0  # alerts, e.g. a doorbell press or detected motion
+EVENT_PRIORITY_NORMAL = 1
+EVENT_PRIORITY_LOW = 2  # telemetry, e.g. temperature or air quality readings
+EVENT_PRIORITIES = {
+    'high': EVENT_PRIORITY_HIGH,
+    'normal': EVENT_PRIORITY_NORMAL,
+    'low': EVENT_PRIORITY_LOW,
+}
+
 
 class CharacteristicError(Exception):
     """Generic exception class for characteristic errors."""
@@ -79,7 +117,8 @@ class Characteristic:
     """
 
     __slots__ = ('broker', 'display_name', 'properties', 'type_id',
-                 'value', 'getter_callback', 'setter_callback')
+                 '_value', '_value_bytes', 'getter_callback', 'setter_callback',
+                 'notified_value', 'notified_at', 'notify_pending')
 
     def __init__(self, display_name, type_id, properties):
         """Initialise with the given properties.
@@ -99,15 +138,44 @@ class Characteristic:
         self.display_name = display_name
         self.properties = properties
         self.type_id = type_id
+        self._value_bytes = None  # the JSON of _value, encoded on first use
         self.value = self._get_default_value()
         self.getter_callback = None
         self.setter_callback = None
+        self.notified_value = None  # the value of the last notification, if any
+        self.notified_at = None  # time.monotonic() of the last notification
+        # Whether the latest value is to be sent once minNotifyInterval is over
+        self.notify_pending = False
 
     def __repr__(self):
         """Return the representation of the characteristic."""
         return '<characteristic display_name={} value={} properties={}>' \
             .format(self.display_name, self.value, self.properties)
 
+    @property
+    def value(self):
+        """The current value."""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        if self._value_bytes is not None and (
+                value != self._value or value.__class__ is not self._value.__class__):
+            self._value_bytes = None
+        self._value = value
+
+    @property
+    def value_bytes(self):
+        """The JSON encoding of the current value, cached until the value changes.
+
+        Events and reads of the characteristic embed these bytes as they are.
+
+        :rtype: bytes
+        """
+        if self._value_bytes is None:
+            self._value_bytes = json_bytes(self._value)
+        return self._value_bytes
+
     def _get_default_value(self):
         """Return default value for format."""
         if self.properties.get(PROP_VALID_VALUES):
@@ -158,12 +226,19 @@ class Characteristic:
         :param valid_values: Dictionary with values to override the existing
             valid_values. Valid values will be set to new dictionary.
         :type valid_values: dict
+
+        :raise ValueError: If PROP_PRIORITY is neither a name of EVENT_PRIORITIES
+            nor one of their values.
         """
         if not properties and not valid_values:
             raise ValueError(
                 'No properties or valid_values specified to override.')
 
         if properties:
+            if PROP_PRIORITY in properties:
+                properties = dict(properties)
+                properties[PROP_PRIORITY] = \
+                    self._to_priority(properties[PROP_PRIORITY])
             self.properties.update(properties)
 
         if valid_values:
@@ -174,6 +249,17 @@ class Characteristic:
         except ValueError:
             self.value = self._get_default_value()
 
+    @staticmethod
+    def _to_priority(priority):
+        """Return the event priority of the given name or value."""
+        if isinstance(priority, str):
+            if priority in EVENT_PRIORITIES:
+                return EVENT_PRIORITIES[priority]
+        elif priority in EVENT_PRIORITIES.values() and not isinstance(priority, bool):
+            return priority
+        raise ValueError('{} is not an event priority, expected one of {}'
+                         .format(priority, ', '.join(sorted(EVENT_PRIORITIES))))
+
     def set_value(self, value, should_notify=True):
         """Set the given raw value. It is checked if it is a valid value.
 
@@ -190,35 +276,129 @@ class Characteristic:
         :type value: Depends on properties["Format"]
 
         :param should_notify: Whether a the change should be sent to
-            subscribed clients. Notify will be performed if the broker is set.
+            subscribed clients. Notify will be performed if the broker is set,
+            subject to the notification policy properties, e.g. PROP_DEADBAND.
         :type should_notify: bool
         """
         logger.debug('set_value: %s to %s', self.display_name, value)
         value = self.to_valid_value(value)
         self.value = value
         if should_notify and self.broker:
+            self._notify_by_policy()
+
+    def async_set_value(self, value):
+        """Like ``set_value``, but return a future of the delivery of the value to the
+        subscribed clients.
+
+        Must be called in the event loop. The value is sent regardless of the
+        notification policy.
+
+        .. seealso:: AccessoryDriver.async_publish
+
+        :param value: The value to assign as this Characteristic's value.
+        :type value: Depends on properties["Format"]
+
+        :return: A future, whose result is True once the value is written to all
+            subscribed clients (right away if the characteristic has no broker yet),
+            False if it could not be written to any of them.
+        :rtype: asyncio.Future
+        """
+        logger.debug('async_set_value: %s to %s', self.display_name, value)
+        self.value = self.to_valid_value(value)
+        if not self.broker:
+            future = asyncio.Future()
+            future.set_result(True)
+            return future
+        self.notified_value = self.value
+        self.notified_at = time.monotonic()
+        return self.broker.async_publish(self.value, self)
+
+    def _notify_by_policy(self):
+        """Notify, unless the notification policy holds the current value back."""
+        if not self._is_notable():
+            return
+        min_interval = self.properties.get(PROP_MIN_NOTIFY_INTERVAL)
+        if min_interval and self.notified_at is not None:
+            wait = self.notified_at + min_interval - time.monotonic()
+            if wait > 0:
+                # The flag spares most calls into the loop; the driver does not
+                # schedule a pending callback twice, should two threads race here.
+                if not self.notify_pending:
+                    self.notify_pending = True
+                    self.broker.driver.call_later(wait, self._notify_trailing,
+                                                  self._cancel_trailing)
+                return
+        self.notify()
+
+    def _notify_trailing(self):
+        """Send the value that was held back by PROP_MIN_NOTIFY_INTERVAL."""
+        # Reset first, so that a value set from now on is sent or schedules a call.
+        self.notify_pending = False
+        if self.broker and self._is_notable():
             self.notify()
 
-    def client_update_value(self, value):
+    def _cancel_trailing(self):
+        """Forget the value held back, as the driver will not send it."""
+        self.notify_pending = False
+
+    def _is_notable(self):
+        """Whether the value differs enough from the last notified one."""
+        props = self.properties
+        deadband = props.get(PROP_DEADBAND)
+        relative_deadband = props.get(PROP_RELATIVE_DEADBAND)
+        if not props.get(PROP_SKIP_UNCHANGED) and deadband is None \
+                and relative_deadband is None:
+            return True
+        last = self.notified_value
+        if last is None:
+            return True
+        if self.value == last:
+            return False
+        if props[PROP_FORMAT] not in HAP_FORMAT_NUMERICS \
+                or props.get(PROP_VALID_VALUES):
+            return True
+        change = abs(self.value - last)
+        if deadband is None:
+            deadband = props.get(PROP_MIN_STEP, 0)
+        # A bit of tolerance, so that e.g. 20.2 - 20.1 counts as a step of 0.1.
+        change *= 1 + DEADBAND_TOLERANCE
+        if change < deadband:
+            return False
+        return relative_deadband is None or change >= relative_deadband * abs(last)
+
+    def client_update_value(self, value, sender_client_addr=None):
         """Called from broker for value change in Home app.
 
         Change self.value to value and call callback.
+
+        :param sender_client_addr: The client that wrote the value. It is not notified
+            of its own write.
+        :type sender_client_addr: tuple <str, int>
         """
         logger.debug('client_update_value: %s to %s',
                      self.display_name, value)
         self.value = value
-        self.notify()
+        self.notify(sender_client_addr)
         if self.setter_callback:
             # pylint: disable=not-callable
             self.setter_callback(value)
 
-    def notify(self):
+    def notify(self, sender_client_addr=None):
         """Notify clients about a value change. Sends the value.
 
         .. seealso:: accessory.publish
         .. seealso:: accessory_driver.publish
+
+        :param sender_client_addr: The client that wrote the value, if any. It is not
+            notified.
+        :type sender_client_addr: tuple <str, int>
         """
-        self.broker.publish(self.value, self)
+        self.notified_value = self.value
+        self.notified_at = time.monotonic()
+        if sender_client_addr is None:  # also for brokers that take no sender client
+            self.broker.publish(self.value, self)
+        else:
+            self.broker.publish(self.value, self, sender_client_addr)
 
     # pylint: disable=invalid-name
     def to_HAP(self):
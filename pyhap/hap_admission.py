@@ -0,0 +1,130 @@
+"""Limits the pairing handshakes that the accessory handles, to survive pairing storms.
+
+Pair setup (SRP with a 3072-bit group) and pair verify (X25519 and Ed25519) are by far
+the most expensive requests. A flood of them, e.g. pair setup attempts while the
+accessory is not paired, would otherwise starve the encrypted requests of controllers.
+
+``HandshakeAdmission`` admits a request that starts a handshake only if:
+
+- fewer than ``max_concurrent`` handshake requests are being handled, and
+- the address it comes from has a token left. Each address gets ``burst`` tokens,
+  refilled at ``rate`` tokens per second, and starting a handshake takes one.
+
+The later steps of an admitted handshake are always admitted, so that a full cap
+does not keep the handshakes in progress from finishing.
+
+Rejected requests are answered right away with a TLV error, so that the controller
+retries later.
+"""
+import collections
+import math
+import threading
+import time
+
+DEFAULT_MAX_HANDSHAKES = 4  # handshake requests handled at the same time
+DEFAULT_HANDSHAKE_RATE = 2.0  # handshakes per second per address, sustained
+DEFAULT_HANDSHAKE_BURST = 10  # handshakes per address in a burst
+MAX_TRACKED_ADDRESSES = 256  # token buckets kept, least recently used are dropped
+
+REJECT_BUSY = "busy"  # too many concurrent handshakes
+REJECT_BACKOFF = "backoff"  # the address has no tokens left
+
+
+class HandshakeRejected(Exception):
+    """A handshake request is not admitted."""
+
+    def __init__(self, reason, retry_delay):
+        """
+        :param reason: ``REJECT_BUSY`` or ``REJECT_BACKOFF``.
+        :type reason: str
+
+        :param retry_delay: Seconds after which the request would be admitted.
+        :type retry_delay: int
+        """
+        super(HandshakeRejected, self).__init__(reason, retry_delay)
+        self.reason = reason
+        self.retry_delay = retry_delay
+
+
+class HandshakeAdmission:
+    """A concurrency cap and per-address token buckets for handshakes, thread-safe."""
+
+    def __init__(self, max_concurrent=DEFAULT_MAX_HANDSHAKES,
+                 rate=DEFAULT_HANDSHAKE_RATE, burst=DEFAULT_HANDSHAKE_BURST):
+        """
+        :param max_concurrent: How many handshake requests may be handled at the same
+            time. None for no limit.
+        :type max_concurrent: int
+
+        :param rate: How many handshakes per second an address may start, sustained.
+            None for no limit.
+        :type rate: float
+
+        :param burst: How many handshakes an address may start at once.
+        :type burst: int
+        """
+        self.max_concurrent = max_concurrent
+        self.rate = rate
+        self.burst = burst
+        self.active = 0
+        self.buckets = collections.OrderedDict()  # address: (tokens, time.monotonic())
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.rejected_busy = 0
+        self.rejected_backoff = 0
+
+    def acquire(self, address, new_handshake=True):
+        """Admit a handshake request from the given address, or reject it.
+
+        Call ``release`` when an admitted request is handled.
+
+        :param address: The IP address of the client.
+        :type address: str
+
+        :param new_handshake: Whether the request starts a handshake, which is subject
+            to the limits, or continues one, which is always admitted.
+        :type new_handshake: bool
+
+        :raise HandshakeRejected: If the request is not admitted.
+        """
+        with self.lock:
+            if new_handshake:
+                if self.max_concurrent is not None \
+                        and self.active >= self.max_concurrent:
+                    self.rejected_busy += 1
+                    raise HandshakeRejected(REJECT_BUSY, 1)
+                if self.rate is not None:
+                    self._take_token(address)
+            self.active += 1
+            self.admitted += 1
+
+    def _take_token(self, address):
+        now = time.monotonic()
+        tokens, last = self.buckets.pop(address, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1:
+            self.buckets[address] = (tokens, now)
+            self.rejected_backoff += 1
+            raise HandshakeRejected(REJECT_BACKOFF,
+                                    math.ceil((1 - tokens) / self.rate))
+        self.buckets[address] = (tokens - 1, now)
+        while len(self.buckets) > MAX_TRACKED_ADDRESSES:
+            self.buckets.popitem(last=False)
+
+    def release(self):
+        """Record that an admitted handshake request is handled."""
+        with self.lock:
+            self.active -= 1
+
+    def stats(self):
+        """Return the counts of active, admitted and rejected handshake requests.
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "active": self.active,
+                "admitted": self.admitted,
+                "rejected_busy": self.rejected_busy,
+                "rejected_backoff": self.rejected_backoff,
+            }
@@ -0,0 +1,556 @@
+"""Keeps track of the connections of the HAP servers.
+
+The ``ConnectionRegistry`` knows every live connection of a server, when it was
+last active and whether it is encrypted. It enforces a maximum number of connections,
+finds idle ones to reap and tells the driver when a client is gone, so that its
+subscriptions are dropped too.
+
+Events are queued per connection in an ``EventBacklog``, limited by the server's
+``SlowConsumerPolicy``.
+"""
+import collections
+import json
+import logging
+import socket
+import threading
+import time
+
+from pyhap.const import HAP_REPR_AID, HAP_REPR_CHARS, HAP_REPR_IID
+
+logger = logging.getLogger(__name__)
+
+# TCP keepalive, so that controllers that vanished (e.g. left the Wi-Fi) are detected
+# even if no event is sent to them: probe after KEEPALIVE_IDLE seconds of silence,
+# every KEEPALIVE_INTERVAL seconds, and give up after KEEPALIVE_COUNT probes.
+KEEPALIVE_IDLE = 60
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+DEFAULT_EVENT_SEND_TIMEOUT = 10  # seconds in which an event must be sent
+DEFAULT_MAX_EVENT_BACKLOG = 100  # events queued for a client
+DEFAULT_MAX_EVENT_BACKLOG_BYTES = 0x40000  # bytes of events queued for a client
+
+SLOW_CONSUMER_DROP = "drop"
+SLOW_CONSUMER_COALESCE = "coalesce"
+SLOW_CONSUMER_DISCONNECT = "disconnect"
+
+
+def set_keepalive(sock, idle=KEEPALIVE_IDLE, interval=KEEPALIVE_INTERVAL,
+                  count=KEEPALIVE_COUNT):
+    """Enable TCP keepalive on the given socket, with the timings where supported.
+
+    :param sock: The connected socket.
+    :type sock: socket.socket
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, "TCP_KEEPALIVE"):  # macOS
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, "TCP_KEEPCNT"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError as e:
+        logger.debug("Could not enable TCP keepalive: %s", e)
+
+
+def coalesce_events(payloads):
+    """Merge EVENT payloads into one, with the latest value of each characteristic.
+
+    :param payloads: The JSON bodies of EVENT messages, oldest first.
+    :type payloads: iterable <bytes>
+
+    :rtype: bytes
+    """
+    chars = collections.OrderedDict()  # (aid, iid): characteristic
+    for payload in payloads:
+        for char in json.loads(payload.decode())[HAP_REPR_CHARS]:
+            key = (char[HAP_REPR_AID], char[HAP_REPR_IID])
+            chars.pop(key, None)
+            chars[key] = char
+    return json.dumps({HAP_REPR_CHARS: list(chars.values())}).encode()
+
+
+class SlowConsumerPolicy:
+    """What to do about clients that do not read their events fast enough, thread-safe.
+
+    A server shares one policy among its connections. A send to a client must finish
+    within ``send_timeout``. Once the events queued for a client exceed
+    ``max_events`` or ``max_bytes``, depending on ``action``:
+
+    - ``SLOW_CONSUMER_DROP`` drops its oldest queued events,
+    - ``SLOW_CONSUMER_COALESCE`` merges its queued events into one, with the latest
+      value of each characteristic, and drops the oldest if that is still too much,
+    - ``SLOW_CONSUMER_DISCONNECT`` closes its connection.
+
+    Clients whose send times out are always disconnected, which drops all of their
+    subscriptions.
+    """
+
+    ACTIONS = (SLOW_CONSUMER_DROP, SLOW_CONSUMER_COALESCE, SLOW_CONSUMER_DISCONNECT)
+
+    def __init__(self, action=SLOW_CONSUMER_COALESCE,
+                 max_events=DEFAULT_MAX_EVENT_BACKLOG,
+                 max_bytes=DEFAULT_MAX_EVENT_BACKLOG_BYTES,
+                 send_timeout=DEFAULT_EVENT_SEND_TIMEOUT):
+        """
+        :param action: One of ``ACTIONS``.
+        :type action: str
+
+        :param max_events: How many events may be queued for a client. None for no
+            limit.
+        :type max_events: int
+
+        :param max_bytes: How many bytes of events may be queued for a client. None for
+            no limit.
+        :type max_bytes: int
+
+        :param send_timeout: Seconds in which a send to a client must finish. None to
+            wait forever.
+        :type send_timeout: float
+        """
+        if action not in self.ACTIONS:
+            raise ValueError("Unknown slow consumer action: {}".format(action))
+        self.action = action
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.send_timeout = send_timeout
+        self.evicted = 0  # clients disconnected because of their backlog
+        self.timed_out = 0  # clients disconnected because a send timed out
+        self.dropped = 0  # events dropped from backlogs
+        self.coalesced = 0  # events merged into others
+        self.lock = threading.Lock()
+
+    def overflows(self, events, nbytes):
+        """Whether a backlog of the given size exceeds the limits."""
+        return (self.max_events is not None and events > self.max_events) \
+            or (self.max_bytes is not None and nbytes > self.max_bytes)
+
+    def evict(self, client_addr, timed_out=False):
+        """Record that the given client is disconnected as a slow consumer."""
+        with self.lock:
+            if timed_out:
+                self.timed_out += 1
+            else:
+                self.evicted += 1
+        logger.warning("Disconnecting %s: %s.", client_addr,
+                       "event send timed out" if timed_out else "too many queued events")
+
+    def count(self, dropped=0, coalesced=0):
+        """Record dropped and merged events."""
+        with self.lock:
+            self.dropped += dropped
+            self.coalesced += coalesced
+
+    def stats(self):
+        """Return the counts of evicted clients and dropped and merged events.
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "evicted": self.evicted,
+                "timed_out": self.timed_out,
+                "dropped": self.dropped,
+                "coalesced": self.coalesced,
+            }
+
+
+class EventBacklog:
+    """The event payloads queued for a client, limited by a ``SlowConsumerPolicy``,
+    thread-safe.
+
+    A payload may come with an ``on_written`` callback. It is called with True once
+    the payload, or the payload it was merged into, is written, and with False if it
+    is dropped.
+    """
+
+    def __init__(self, policy):
+        """
+        :type policy: SlowConsumerPolicy
+        """
+        self.policy = policy
+        self.events = collections.deque()
+        self.callbacks = collections.deque()  # list of on_written or None, per event
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def put(self, bytesdata, on_written=None):
+        """Queue an event payload, applying the policy if the backlog overflows.
+
+        :param on_written: Called with whether the payload was written.
+        :type on_written: callable
+
+        :return: False if the client should be disconnected, True otherwise.
+        :rtype: bool
+        """
+        dropped_callbacks = []
+        with self.lock:
+            self.events.append(bytesdata)
+            self.callbacks.append([on_written] if on_written is not None else None)
+            self.nbytes += len(bytesdata)
+            policy = self.policy
+            if not policy.overflows(len(self.events), self.nbytes):
+                return True
+            if policy.action == SLOW_CONSUMER_DISCONNECT:
+                return False
+            dropped = coalesced = 0
+            if policy.action == SLOW_CONSUMER_COALESCE and len(self.events) > 1:
+                coalesced = len(self.events) - 1
+                merged = coalesce_events(self.events)
+                self.events = collections.deque((merged,))
+                self.callbacks = collections.deque(
+                    ([on_written for callbacks in self.callbacks if callbacks
+                      for on_written in callbacks] or None,))
+                self.nbytes = len(merged)
+            while len(self.events) > 1 \
+                    and policy.overflows(len(self.events), self.nbytes):
+                self.nbytes -= len(self.events.popleft())
+                dropped_callbacks.extend(self.callbacks.popleft() or ())
+                dropped += 1
+        policy.count(dropped, coalesced)
+        notify_written(dropped_callbacks, False)
+        return True
+
+    def pop_all(self):
+        """Remove and return the queued event payloads, oldest first, and their
+        ``on_written`` callbacks.
+
+        :rtype: tuple <list <bytes>, list <callable>>
+        """
+        with self.lock:
+            events = list(self.events)
+            callbacks = [on_written for callbacks in self.callbacks if callbacks
+                         for on_written in callbacks]
+            self.events.clear()
+            self.callbacks.clear()
+            self.nbytes = 0
+        return events, callbacks
+
+    def clear(self):
+        """Drop the queued events."""
+        notify_written(self.pop_all()[1], False)
+
+
+def notify_written(callbacks, written):
+    """Call the given ``on_written`` callbacks with whether their events were written.
+    """
+    for on_written in callbacks:
+        try:
+            on_written(written)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Error in the callback of a written event")
+
+
+class EventWriter:
+    """The outbound event queue of a connection, sent from its own thread or from a
+    shared pool of threads.
+
+    A controller that reads slowly, or not at all, only delays its own events, and in
+    a pool at most the worker sending to it, for up to the send timeout.
+    """
+
+    def __init__(self, client_addr, send, on_error, policy=None, submit=None):
+        """Start the writer thread, unless ``submit`` is given.
+
+        :param client_addr: The client (address, port) of the connection.
+        :type client_addr: tuple <str, int>
+
+        :param send: Sends the given event payloads to the client, in one go.
+        :type send: callable
+
+        :param on_error: Called with the exception if sending fails. The writer
+            stops; the connection should be closed.
+        :type on_error: callable
+
+        :param policy: Limits the queued events. Defaults to a ``SlowConsumerPolicy``.
+        :type policy: SlowConsumerPolicy
+
+        :param submit: Runs the given callable in a pool thread. If given, queued
+            events are sent by a task submitted to the pool, instead of by a thread of
+            the writer.
+        :type submit: callable
+        """
+        self.client_addr = client_addr
+        self.send = send
+        self.on_error = on_error
+        self.backlog = EventBacklog(policy or SlowConsumerPolicy())
+        self.closed = False
+        self.submit = submit
+        self.draining = False  # whether a drain task is submitted, with submit
+        self.lock = threading.Lock()  # for draining
+        self.wakeup = threading.Event()  # set when events are queued or on close
+        self.thread = None
+        if submit is None:
+            self.thread = threading.Thread(
+                target=self._run, daemon=True,
+                name="EventWriter-{}:{}".format(*client_addr))
+            self.thread.start()
+
+    def __len__(self):
+        """Return the number of queued events."""
+        return len(self.backlog)
+
+    def put(self, bytesdata, on_written=None):
+        """Queue an event payload.
+
+        :param on_written: Called with whether the payload was sent, from the thread
+            that sent it.
+        :type on_written: callable
+
+        :return: False if the writer is closed or the client should be disconnected
+            as a slow consumer, True otherwise.
+        :rtype: bool
+        """
+        if self.closed or not self.backlog.put(bytesdata, on_written):
+            return False
+        if self.submit is None:
+            self.wakeup.set()
+            return True
+        with self.lock:
+            if self.draining:
+                return True
+            self.draining = True
+        self.submit(self._drain)
+        return True
+
+    def close(self):
+        """Stop the writer once the queued events are sent."""
+        self.closed = True
+        self.wakeup.set()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            if not self._send_queued():
+                return
+            if self.closed and not self.backlog:
+                return
+
+    def _drain(self):
+        """Send the queued events until there are none, in a pool thread."""
+        while True:
+            with self.lock:
+                if not self.backlog:
+                    self.draining = False
+                    return
+            if not self._send_queued():
+                return
+
+    def _send_queued(self):
+        """Send the queued events in one go.
+
+        :return: False if sending failed and the writer stopped, True otherwise.
+        :rtype: bool
+        """
+        events, callbacks = self.backlog.pop_all()
+        if not events:
+            return True
+        try:
+            self.send(events)
+        except (OSError, socket.timeout) as e:
+            self.closed = True
+            notify_written(callbacks, False)
+            self.backlog.clear()
+            self.on_error(e)
+            return False
+        notify_written(callbacks, True)
+        return True
+
+
+class ConnectionRegistry:
+    """The live connections of a server, by client (address, port), thread-safe.
+
+    A connection is anything the server uses to talk to the client, e.g. a socket or
+    a protocol. Reads (``get``, ``in``, ``len``) behave like a dict.
+    """
+
+    def __init__(self, max_connections=None, idle_timeout=None, on_remove=None):
+        """
+        :param max_connections: How many connections may be open at the same time.
+            None for no limit.
+        :type max_connections: int
+
+        :param idle_timeout: Seconds without requests or events after which a
+            connection is reaped. None to keep idle connections. Note that
+            controllers keep connections open to receive events.
+        :type idle_timeout: float
+
+        :param on_remove: Called with the client (address, port) when its connection
+            is removed, e.g. to drop its subscriptions.
+        :type on_remove: callable
+        """
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.on_remove = on_remove
+        self.connections = {}  # (address, port): connection
+        self.last_active = {}  # (address, port): time.monotonic() of last activity
+        self.encrypted = set()  # (address, port) of encrypted connections
+        # (address, port): what belongs to the connection, e.g. its EventWriter, which
+        # is closed along with it
+        self.attached = {}
+        self.reaped = 0  # connections closed because they were idle
+        self.rejected = 0  # connections refused because of max_connections
+        self.lock = threading.Lock()
+
+    def __contains__(self, client_addr):
+        return client_addr in self.connections
+
+    def __getitem__(self, client_addr):
+        return self.connections[client_addr]
+
+    def __len__(self):
+        return len(self.connections)
+
+    def get(self, client_addr, default=None):
+        """Return the connection of the given client, if any."""
+        return self.connections.get(client_addr, default)
+
+    def values(self):
+        """Return a list of the connections."""
+        return list(self.connections.values())
+
+    def add(self, client_addr, connection):
+        """Register a new connection, unless there are too many already.
+
+        :return: Whether the connection was registered. If not, close it.
+        :rtype: bool
+        """
+        with self.lock:
+            if self.max_connections is not None \
+                    and len(self.connections) >= self.max_connections:
+                self.rejected += 1
+                logger.warning("Rejecting connection with %s: already %d connections.",
+                               client_addr, len(self.connections))
+                return False
+            self.connections[client_addr] = connection
+            self.last_active[client_addr] = time.monotonic()
+            self.encrypted.discard(client_addr)
+            return True
+
+    def attach(self, client_addr, create):
+        """Return what is attached to the connection of the given client, attaching
+        ``create()`` if there is nothing yet.
+
+        This is atomic with ``remove``: nothing is attached to a removed connection.
+
+        :param create: Returns the object to attach, which has a ``close`` method.
+        :type create: callable
+
+        :return: The attached object, None if the client is not connected.
+        """
+        with self.lock:
+            if client_addr not in self.connections:
+                return None
+            attached = self.attached.get(client_addr)
+            if attached is None:
+                attached = self.attached[client_addr] = create()
+            return attached
+
+    def attachments(self):
+        """Return the attached objects, by client (address, port).
+
+        :rtype: dict
+        """
+        with self.lock:
+            return dict(self.attached)
+
+    def replace(self, client_addr, connection, encrypted=False):
+        """Replace the connection of the given client, e.g. with an encrypted socket."""
+        with self.lock:
+            self.connections[client_addr] = connection
+            if encrypted:
+                self.encrypted.add(client_addr)
+
+    def set_encrypted(self, client_addr):
+        """Mark the connection of the given client as encrypted."""
+        with self.lock:
+            if client_addr in self.connections:
+                self.encrypted.add(client_addr)
+
+    def touch(self, client_addr):
+        """Record activity on the connection of the given client."""
+        if client_addr in self.last_active:
+            self.last_active[client_addr] = time.monotonic()
+
+    def remove(self, client_addr, connection=None):
+        """Unregister the connection of the given client, close what is attached to it
+        and call ``on_remove``.
+
+        :param connection: If given, only remove the client if this is its current
+            connection, e.g. not a new one from the same address and port.
+
+        :return: The removed connection, None if there was none.
+        """
+        with self.lock:
+            current = self.connections.get(client_addr)
+            if current is None or (connection is not None and current is not connection):
+                return None
+            del self.connections[client_addr]
+            self.last_active.pop(client_addr, None)
+            self.encrypted.discard(client_addr)
+            attached = self.attached.pop(client_addr, None)
+        if attached is not None:
+            attached.close()
+        if self.on_remove is not None:
+            self.on_remove(client_addr)
+        return current
+
+    def clear(self):
+        """Remove all connections.
+
+        :return: The removed connections.
+        :rtype: list
+        """
+        removed = []
+        for client_addr in list(self.connections):
+            connection = self.remove(client_addr)
+            if connection is not None:
+                removed.append(connection)
+        return removed
+
+    def reap_idle(self, now=None):
+        """Find the connections that are idle for longer than ``idle_timeout``.
+
+        They are counted as reaped, but stay registered until the server closes and
+        removes them.
+
+        :return: The (address, port) and connection of each idle client.
+        :rtype: list <tuple <tuple <str, int>, object>>
+        """
+        if self.idle_timeout is None:
+            return []
+        if now is None:
+            now = time.monotonic()
+        deadline = now - self.idle_timeout
+        idle = []
+        with self.lock:
+            for client_addr, last_active in list(self.last_active.items()):
+                if last_active <= deadline:
+                    # Reap each connection once, even if closing it takes a while.
+                    del self.last_active[client_addr]
+                    idle.append((client_addr, self.connections[client_addr]))
+            self.reaped += len(idle)
+        for client_addr, _ in idle:
+            logger.info("Closing connection with %s: idle for %ss.",
+                        client_addr, self.idle_timeout)
+        return idle
+
+    def stats(self):
+        """Return the counts of live, encrypted, reaped and rejected connections.
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "live": len(self.connections),
+                "encrypted": len(self.encrypted),
+                "reaped": self.reaped,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,633 @@
+"""This module implements the crypto primitives used by HAP.
+
+HAP needs ChaCha20-Poly1305 (transport and pairing encryption), HKDF-SHA512 (key
+expansion), X25519 (pair verify key exchange) and Ed25519 (long term signatures).
+
+The pure-python implementations from `tlslite` are slow, which matters a lot on small
+devices like the Raspberry Pi. Thus, the primitives are provided through a
+``CryptoProvider``, which is selected from the fastest library available:
+
+- `cryptography` - OpenSSL bindings, used if installed.
+- `PyNaCl` - libsodium bindings, used if installed and `cryptography` is not.
+- `tlslite-ng`, `pycryptodome`, `curve25519-donna` and `ed25519` - the default
+  dependencies of HAP-python, always available.
+
+Install the fast backend with ``pip install HAP-python[NativeCrypto]``.
+"""
+import collections
+import functools
+import logging
+import struct
+import threading
+import time
+
+from Crypto.Hash import SHA512
+from Crypto.Protocol.KDF import HKDF
+import curve25519
+import ed25519
+from tlslite.utils.chacha20_poly1305 import CHACHA20_POLY1305
+
+try:
+    from cryptography.exceptions import InvalidSignature, InvalidTag
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+        Ed25519PrivateKey, Ed25519PublicKey)
+    from cryptography.hazmat.primitives.asymmetric.x25519 import (
+        X25519PrivateKey, X25519PublicKey)
+    from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF as CryptographyHKDF
+    SUPPORT_CRYPTOGRAPHY = True
+except ImportError:
+    SUPPORT_CRYPTOGRAPHY = False
+
+try:
+    import nacl.bindings
+    from nacl.exceptions import CryptoError
+    SUPPORT_NACL = True
+except ImportError:
+    SUPPORT_NACL = False
+
+logger = logging.getLogger(__name__)
+
+BACKEND_CRYPTOGRAPHY = 'cryptography'
+BACKEND_NACL = 'nacl'
+BACKEND_PYTHON = 'python'
+
+HKDF_KEYLEN = 32  # bytes, length of expanded HKDF keys
+TAG_LENGTH = 16  # bytes, length of the Poly1305 authentication tag
+TLS_NONCE_LEN = 12  # bytes, length of TLS encryption nonce
+
+DEFAULT_KEY_POOL_SIZE = 8  # X25519 key pairs kept ready for pair verify
+
+
+def pad_tls_nonce(nonce, total_len=TLS_NONCE_LEN):
+    """Pads a nonce with zeroes so that total_len is reached."""
+    return nonce.rjust(total_len, b"\x00")
+
+
+class CryptoProvider:
+    """The interface of the crypto primitives needed by HAP.
+
+    This implementation uses the default dependencies of HAP-python. Subclasses
+    override the primitives for which they have faster implementations.
+    """
+
+    name = BACKEND_PYTHON
+
+    @staticmethod
+    def aead(key):
+        """Return a ChaCha20-Poly1305 cipher for the given key.
+
+        The cipher has ``seal(nonce, data, aad)``, returning the ciphertext with the
+        tag appended, and ``open(nonce, data, aad)``, returning the plaintext or None
+        if the data could not be authenticated. Both accept any bytes-like object.
+
+        :param key: The 32 byte key.
+        :type key: bytes
+
+        :rtype: object
+        """
+        return _PythonAEAD(key)
+
+    @staticmethod
+    def hkdf(key, salt, info):
+        """Expand the given key with HKDF-SHA512 to ``HKDF_KEYLEN`` bytes."""
+        return HKDF(key, HKDF_KEYLEN, salt, SHA512, context=info)
+
+    @staticmethod
+    def x25519_generate():
+        """Generate an ephemeral X25519 key pair.
+
+        :return: The private key (only meaningful to this provider) and the raw
+            32 bytes of the public key.
+        :rtype: tuple <object, bytes>
+        """
+        private_key = curve25519.Private()
+        return private_key, private_key.get_public().serialize()
+
+    @staticmethod
+    def x25519_exchange(private_key, peer_public):
+        """Return the raw shared secret between our private and the peer's public key.
+
+        :param private_key: A private key returned by ``x25519_generate``.
+
+        :param peer_public: The raw 32 bytes of the peer's public key.
+        :type peer_public: bytes
+
+        :rtype: bytes
+        """
+        # Key is hashed before being returned, we don't want it; This fixes that.
+        return private_key.get_shared_key(curve25519.Public(peer_public), lambda x: x)
+
+    @staticmethod
+    def ed25519_sign(signing_key, data):
+        """Sign the data with the given long term key.
+
+        :param signing_key: The accessory long term key.
+        :type signing_key: ed25519.SigningKey
+
+        :rtype: bytes
+        """
+        return signing_key.sign(data)
+
+    @staticmethod
+    def ed25519_verify(public_key, signature, data):
+        """Check the signature of the data against the raw 32 byte public key.
+
+        :return: Whether the signature is valid.
+        :rtype: bool
+        """
+        try:
+            ed25519.VerifyingKey(public_key).verify(signature, data)
+        except ed25519.BadSignatureError:
+            return False
+        return True
+
+
+class _PythonAEAD:
+    """Adapts the tlslite ChaCha20-Poly1305 to the provider interface."""
+
+    __slots__ = ('_cipher',)
+
+    def __init__(self, key):
+        self._cipher = CHACHA20_POLY1305(key, "python")
+
+    def seal(self, nonce, data, aad):
+        return bytes(self._cipher.seal(nonce, bytearray(data), aad))
+
+    def open(self, nonce, data, aad):
+        plaintext = self._cipher.open(nonce, bytearray(data), aad)
+        return None if plaintext is None else bytes(plaintext)
+
+
+class CryptographyProvider(CryptoProvider):
+    """Primitives backed by `cryptography`, i.e. by OpenSSL."""
+
+    name = BACKEND_CRYPTOGRAPHY
+
+    @staticmethod
+    def aead(key):
+        return _CryptographyAEAD(key)
+
+    @staticmethod
+    def hkdf(key, salt, info):
+        return CryptographyHKDF(
+            algorithm=hashes.SHA512(), length=HKDF_KEYLEN, salt=salt, info=info,
+            backend=default_backend()).derive(key)
+
+    @staticmethod
+    def x25519_generate():
+        private_key = X25519PrivateKey.generate()
+        public_key = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw)
+        return private_key, public_key
+
+    @staticmethod
+    def x25519_exchange(private_key, peer_public):
+        return private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+
+    @staticmethod
+    def ed25519_sign(signing_key, data):
+        return _cryptography_signing_key(signing_key.to_seed()).sign(data)
+
+    @staticmethod
+    def ed25519_verify(public_key, signature, data):
+        try:
+            Ed25519PublicKey.from_public_bytes(public_key).verify(signature, data)
+        except InvalidSignature:
+            return False
+        return True
+
+
+@functools.lru_cache(maxsize=4)
+def _cryptography_signing_key(seed):
+    """Load (once) the long term key into `cryptography`."""
+    return Ed25519PrivateKey.from_private_bytes(seed)
+
+
+class _CryptographyAEAD:
+
+    __slots__ = ('_cipher',)
+
+    def __init__(self, key):
+        self._cipher = ChaCha20Poly1305(bytes(key))
+
+    def seal(self, nonce, data, aad):
+        return self._cipher.encrypt(nonce, data, aad)
+
+    def open(self, nonce, data, aad):
+        try:
+            return self._cipher.decrypt(nonce, data, aad)
+        except InvalidTag:
+            return None
+
+
+class NaclProvider(CryptoProvider):
+    """Primitives backed by `PyNaCl`, i.e. by libsodium.
+
+    libsodium has no HKDF, so the default implementation is used for it.
+    """
+
+    name = BACKEND_NACL
+
+    @staticmethod
+    def aead(key):
+        return _NaclAEAD(key)
+
+    @staticmethod
+    def x25519_generate():
+        public_key, private_key = nacl.bindings.crypto_box_keypair()
+        return private_key, public_key
+
+    @staticmethod
+    def x25519_exchange(private_key, peer_public):
+        return nacl.bindings.crypto_scalarmult(private_key, peer_public)
+
+    @staticmethod
+    def ed25519_sign(signing_key, data):
+        secret_key = _nacl_signing_key(signing_key.to_seed())
+        return nacl.bindings.crypto_sign(data, secret_key)[:64]
+
+    @staticmethod
+    def ed25519_verify(public_key, signature, data):
+        try:
+            nacl.bindings.crypto_sign_open(signature + data, public_key)
+        except CryptoError:
+            return False
+        return True
+
+
+@functools.lru_cache(maxsize=4)
+def _nacl_signing_key(seed):
+    """Expand (once) the long term key seed into a libsodium secret key."""
+    return nacl.bindings.crypto_sign_seed_keypair(seed)[1]
+
+
+class _NaclAEAD:
+
+    __slots__ = ('_key',)
+
+    def __init__(self, key):
+        self._key = bytes(key)
+
+    def seal(self, nonce, data, aad):
+        return nacl.bindings.crypto_aead_chacha20poly1305_ietf_encrypt(
+            bytes(data), aad, nonce, self._key)
+
+    def open(self, nonce, data, aad):
+        try:
+            return nacl.bindings.crypto_aead_chacha20poly1305_ietf_decrypt(
+                bytes(data), aad, nonce, self._key)
+        except CryptoError:
+            return None
+
+
+PROVIDERS = {BACKEND_PYTHON: CryptoProvider}
+if SUPPORT_NACL:
+    PROVIDERS[BACKEND_NACL] = NaclProvider
+if SUPPORT_CRYPTOGRAPHY:
+    PROVIDERS[BACKEND_CRYPTOGRAPHY] = CryptographyProvider
+
+# Fastest first.
+_PREFERENCE = (BACKEND_CRYPTOGRAPHY, BACKEND_NACL, BACKEND_PYTHON)
+
+_provider = None
+
+
+def get_provider():
+    """Return the crypto provider in use.
+
+    If not set with ``set_provider``, the fastest available one is selected.
+
+    :rtype: CryptoProvider
+    """
+    # pylint: disable=global-statement
+    global _provider
+    if _provider is None:
+        name = next(name for name in _PREFERENCE if name in PROVIDERS)
+        logger.debug('Using crypto backend %s', name)
+        _provider = PROVIDERS[name]
+    return _provider
+
+
+def set_provider(name):
+    """Use the crypto provider with the given name.
+
+    :param name: One of ``BACKEND_CRYPTOGRAPHY``, ``BACKEND_NACL`` or
+        ``BACKEND_PYTHON``.
+    :type name: str
+
+    :raise ValueError: If the backend is not installed.
+    """
+    # pylint: disable=global-statement
+    global _provider
+    if name not in PROVIDERS:
+        raise ValueError('Crypto backend {} is not available.'.format(name))
+    _provider = PROVIDERS[name]
+
+
+def hap_hkdf(key, salt, info):
+    """Expand the key with HKDF-SHA512, using the current provider."""
+    return get_provider().hkdf(key, salt, info)
+
+
+class X25519KeyPool:
+    """Ephemeral X25519 key pairs, generated ahead of time in an executor.
+
+    When many controllers reconnect at once, e.g. after the router restarted, each
+    pair verify can take a ready key pair instead of generating one. Each key pair is
+    handed out once. Thread-safe.
+    """
+
+    def __init__(self, size=DEFAULT_KEY_POOL_SIZE, refill_rate=None, executor=None):
+        """
+        :param size: How many key pairs to keep ready. 0 to generate each one when
+            it is needed.
+        :type size: int
+
+        :param refill_rate: How many key pairs per second to generate at most, so that
+            refilling does not compete with serving requests. None for no limit.
+        :type refill_rate: float
+
+        :param executor: Where to generate the key pairs. None to only generate them
+            when they are needed.
+        :type executor: concurrent.futures.Executor
+        """
+        self.size = size
+        self.refill_rate = refill_rate
+        self.executor = executor
+        self.keys = collections.deque()  # (provider, private key, public key)
+        self.lock = threading.Lock()  # for refilling and the counts
+        self.refilling = False
+        self.closed = False
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def take(self):
+        """Return a new key pair, from the pool if one is ready, and start a refill.
+
+        :return: The private and public key, as ``CryptoProvider.x25519_generate``.
+        :rtype: tuple
+        """
+        provider = get_provider()
+        key_pair = None
+        while self.keys:
+            try:
+                key_provider, private_key, public_key = self.keys.popleft()
+            except IndexError:  # Taken by another thread.
+                break
+            if key_provider is provider:  # Else, the provider was changed.
+                key_pair = (private_key, public_key)
+                break
+        with self.lock:
+            if key_pair is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.refill()
+        return key_pair or provider.x25519_generate()
+
+    def refill(self):
+        """Start generating key pairs in the executor until the pool is full."""
+        with self.lock:
+            if self.refilling or self.closed or self.executor is None \
+                    or len(self.keys) >= self.size:
+                return
+            try:
+                self.executor.submit(self._refill)
+            except RuntimeError:  # The executor is shut down.
+                return
+            self.refilling = True
+
+    def _refill(self):
+        try:
+            while not self.closed and len(self.keys) < self.size:
+                provider = get_provider()
+                self.keys.append((provider,) + provider.x25519_generate())
+                if self.refill_rate:
+                    time.sleep(1 / self.refill_rate)
+        finally:
+            with self.lock:
+                self.refilling = False
+
+    def close(self):
+        """Stop refilling and drop the ready key pairs."""
+        self.closed = True
+        self.keys.clear()
+
+    def stats(self):
+        """Return the counts of ready key pairs, and of takes that found one or not.
+
+        :rtype: dict
+        """
+        with self.lock:
+            return {
+                "available": len(self.keys),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class HAPFrameDecoder:
+    """Decrypts the inbound frames of an encrypted HAP session.
+
+    After pair verify, the stream consists of frames: a two byte little-endian length
+    ``n`` (also used as additional authenticated data), followed by ``n`` bytes of
+    ciphertext and the authentication tag.
+
+    Ciphertext is received straight into a reusable buffer (see ``get_buffer`` and
+    ``buffer_updated``) and complete frames are decrypted through memoryviews into the
+    caller's buffer in ``read_into``. Only plaintext that does not fit there is kept.
+    """
+
+    LENGTH_LENGTH = 2
+    BUFFER_SIZE = 0x4000  # bytes, initial size of the ciphertext buffer
+    MIN_FREE = 0x800  # bytes, compact the buffer when less than this is free
+
+    def __init__(self, cipher):
+        """Initialise with the given inbound cipher.
+
+        :param cipher: The AEAD used to open the frames, as returned by
+            ``CryptoProvider.aead``.
+        """
+        self._cipher = cipher
+        self._count = 0
+        self._buffer = bytearray(self.BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # Start of the unprocessed ciphertext
+        self._end = 0  # End of the received ciphertext
+        self._plaintext = bytearray()  # Decrypted data not yet read
+
+    @property
+    def pending(self):
+        """Number of decrypted bytes that can be read without receiving more."""
+        return len(self._plaintext)
+
+    def get_buffer(self):
+        """Return a writable memoryview to receive ciphertext into.
+
+        Call ``buffer_updated`` with the number of bytes written into it.
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+        free = len(self._buffer) - self._end
+        needed = self._frame_length()
+        if free < self.MIN_FREE or self._start + needed > len(self._buffer):
+            self._compact(needed)
+        return self._view[self._end:]
+
+    def buffer_updated(self, nbytes):
+        """Mark ``nbytes`` of the buffer returned by ``get_buffer`` as received."""
+        self._end += nbytes
+
+    def feed(self, data):
+        """Copy the given ciphertext into the buffer."""
+        data = memoryview(data)
+        while data:
+            buffer = self.get_buffer()
+            nbytes = min(len(buffer), len(data))
+            buffer[:nbytes] = data[:nbytes]
+            self.buffer_updated(nbytes)
+            data = data[nbytes:]
+
+    def read_into(self, buffer):
+        """Decrypt into the given buffer as much as is available.
+
+        :param buffer: A writable bytes-like object.
+
+        :return: The number of bytes written, 0 if a whole frame is yet to be received.
+        :rtype: int
+
+        :raise ValueError: If a frame could not be authenticated.
+        """
+        out = memoryview(buffer).cast('B')
+        size = len(out)
+        written = min(size, len(self._plaintext))
+        if written:
+            out[:written] = self._plaintext[:written]
+            del self._plaintext[:written]
+
+        while written < size:
+            plaintext = self._open_next()
+            if plaintext is None:
+                break
+            nbytes = min(size - written, len(plaintext))
+            if nbytes == len(plaintext):
+                out[written:written + nbytes] = plaintext
+            else:
+                plaintext = memoryview(plaintext)
+                out[written:written + nbytes] = plaintext[:nbytes]
+                self._plaintext += plaintext[nbytes:]
+            written += nbytes
+        return written
+
+    def read(self):
+        """Decrypt and return everything that is available.
+
+        :rtype: bytes
+
+        :raise ValueError: If a frame could not be authenticated.
+        """
+        chunks = [bytes(self._plaintext)]
+        del self._plaintext[:]
+        plaintext = self._open_next()
+        while plaintext is not None:
+            chunks.append(plaintext)
+            plaintext = self._open_next()
+        return b"".join(chunks)
+
+    def _frame_length(self):
+        """Total length of the frame at the start of the buffer, 0 if not known."""
+        if self._end - self._start < self.LENGTH_LENGTH:
+            return 0
+        length = self._buffer[self._start] | (self._buffer[self._start + 1] << 8)
+        return self.LENGTH_LENGTH + length + TAG_LENGTH
+
+    def _compact(self, needed):
+        """Move the unprocessed ciphertext to the front, growing the buffer if needed."""
+        remaining = self._buffer[self._start:self._end]
+        size = len(self._buffer)
+        if max(needed, len(remaining)) + self.MIN_FREE > size:
+            size = max(2 * size, needed + self.MIN_FREE)
+            self._view.release()
+            self._buffer = bytearray(size)
+            self._view = memoryview(self._buffer)
+        self._buffer[:len(remaining)] = remaining
+        self._start = 0
+        self._end = len(remaining)
+
+    def _open_next(self):
+        """Decrypt and consume the next complete frame, if there is one."""
+        total = self._frame_length()
+        if not total or self._end - self._start < total:
+            return None
+        start = self._start
+        aad = bytes(self._view[start:start + self.LENGTH_LENGTH])
+        nonce = pad_tls_nonce(struct.pack("Q", self._count))
+        plaintext = self._cipher.open(
+            nonce, self._view[start + self.LENGTH_LENGTH:start + total], aad)
+        if plaintext is None:
+            raise ValueError("Could not authenticate inbound frame.")
+        self._count += 1
+        self._start += total
+        return plaintext
+
+
+class HAPFrameEncoder:
+    """Encrypts the outbound data of an encrypted HAP session into frames.
+
+    .. seealso:: HAPFrameDecoder
+    """
+
+    LENGTH_LENGTH = 2
+    MAX_BLOCK_LENGTH = 0x400
+
+    def __init__(self, cipher):
+        """Initialise with the given outbound cipher.
+
+        :param cipher: The AEAD used to seal the frames, as returned by
+            ``CryptoProvider.aead``.
+        """
+        self._cipher = cipher
+        self._count = 0
+
+    def encrypt(self, buffers):
+        """Seal the concatenation of the given buffers.
+
+        The frames are written into a single, preallocated buffer, so that they can be
+        sent with one call.
+
+        :param buffers: Bytes-like objects to be sent, e.g. the status line, the headers
+            and the body of a response.
+        :type buffers: iterable
+
+        :return: The length-prefixed frames.
+        :rtype: bytearray
+        """
+        buffers = [buffer for buffer in buffers if buffer]
+        if not buffers:
+            return bytearray()
+        # Joining once in C is much cheaper than gathering blocks that span buffers.
+        data = memoryview(buffers[0] if len(buffers) == 1 else b"".join(buffers))
+        data = data.cast('B')
+        total = len(data)
+        num_blocks = -(-total // self.MAX_BLOCK_LENGTH)
+        result = bytearray(total + num_blocks * (self.LENGTH_LENGTH + TAG_LENGTH))
+
+        seal = self._cipher.seal
+        offset = 0
+        for start in range(0, total, self.MAX_BLOCK_LENGTH):
+            block = data[start:start + self.MAX_BLOCK_LENGTH]
+            length_bytes = struct.pack("H", len(block))
+            nonce = pad_tls_nonce(struct.pack("Q", self._count))
+            sealed = seal(nonce, block, length_bytes)
+            end = offset + self.LENGTH_LENGTH + len(sealed)
+            result[offset:end] = length_bytes + sealed
+            offset = end
+            self._count += 1
+        return result
@@ -0,0 +1,206 @@
+"""Keeps track of the subscriptions of the controllers and of the characteristic
+changes that are waiting to be sent to them.
+
+Topics are (aid, iid) tuples of characteristics. ``SubscriptionRegistry`` knows the
+clients subscribed to each topic. Its per-topic sets are immutable, thus publishing
+and dispatching read them without a lock.
+
+Controllers are interested in the current value of a characteristic, not in every
+value it had. ``LatestValueQueue`` keeps at most one pending event per topic: a newer
+value replaces the queued, unsent one, which keeps its place in line. Thus the queue
+holds at most one event per subscribed characteristic, however chatty an accessory is.
+Events of stateless characteristics, e.g. the presses of a programmable switch, are
+queued in order instead, as each of them is news to the controllers.
+Events of a higher priority, e.g. a doorbell press, are taken before the queued
+telemetry. The queue is owned by the event loop of the driver, which dispatches the
+events, and is not thread-safe.
+
+Publishers that wait for their event to reach the controllers get a future, which an
+``EventDelivery`` resolves once the event is written to all of its clients.
+"""
+import collections
+import threading
+
+from pyhap.characteristic import EVENT_PRIORITIES
+
+EMPTY = frozenset()
+
+
+class LatestValueQueue:
+    """A queue of (topic, ..., priority) tuples, where a newer event of a topic
+    replaces the queued one, unless it is queued without superseding.
+
+    Events are taken by priority, 0 first, then in the order their topics were queued.
+    """
+
+    def __init__(self, priorities=len(EVENT_PRIORITIES)):
+        """
+        :param priorities: How many priorities there are, 0 to ``priorities - 1``.
+        :type priorities: int
+        """
+        # key: event, oldest first, for each priority. The key is the topic, or a
+        # (topic, sequence) tuple for events that are not superseded.
+        self.events = [collections.OrderedDict() for _ in range(priorities)]
+        self.priority_of = {}  # key: priority of its queued event
+        self.superseded = 0  # events replaced before they were sent
+        self.sequence = 0  # of the events that are not superseded
+        self.unsuperseded = 0  # queued events that are not superseded
+
+    def __len__(self):
+        return len(self.priority_of)
+
+    def put(self, item, supersede=True):
+        """Queue the given event, replacing the queued event of its topic, if any.
+
+        :param supersede: False to queue the event after the queued events of its
+            topic, e.g. for stateless characteristics. It is not replaced either.
+        :type supersede: bool
+        """
+        topic, priority = item[0], item[-1]
+        if not supersede:
+            self.sequence += 1
+            key = (topic, self.sequence)
+            self.events[priority][key] = item
+            self.priority_of[key] = priority
+            self.unsuperseded += 1
+            return
+        queued_priority = self.priority_of.get(topic)
+        if queued_priority is not None:
+            self.superseded += 1
+            if queued_priority != priority:
+                del self.events[queued_priority][topic]
+        self.events[priority][topic] = item
+        self.priority_of[topic] = priority
+
+    def get(self):
+        """Remove and return the next event.
+
+        :raise IndexError: If the queue is empty.
+        """
+        for events in self.events:
+            if events:
+                key, item = events.popitem(last=False)
+                del self.priority_of[key]
+                if key != item[0]:
+                    self.unsuperseded -= 1
+                return item
+        raise IndexError("get from an empty LatestValueQueue")
+
+    def peek(self):
+        """Return the next event, without removing it.
+
+        :raise IndexError: If the queue is empty.
+        """
+        for events in self.events:
+            if events:
+                return next(iter(events.values()))
+        raise IndexError("peek from an empty LatestValueQueue")
+
+    def stats(self):
+        """Return the number of queued events, by priority, and of superseded events.
+
+        :rtype: dict
+        """
+        return {"queued": [len(events) for events in self.events],
+                "superseded": self.superseded}
+
+
+class EventDelivery:
+    """The futures of the publishers of an event, resolved once the event is written
+    to each of its clients, or failed for any of them. Used in the event loop only.
+
+    The result of the futures is True if the event was written to all clients, False
+    otherwise. Futures that are done already, e.g. cancelled, are left alone.
+    """
+
+    def __init__(self, futures, clients):
+        """
+        :param futures: The futures of the publishers of the event.
+        :type futures: list <asyncio.Future>
+
+        :param clients: The (address, port) of the clients the event is sent to.
+        :type clients: iterable <tuple <str, int>>
+        """
+        self.futures = futures
+        self.pending = set(clients)  # clients the event is not written to yet
+        self.delivered = True
+        if not self.pending:
+            self._resolve()
+
+    def written(self, client, written):
+        """Record whether the event was written to the given client.
+
+        Only the first outcome for each client counts.
+        """
+        if client not in self.pending:
+            return
+        self.pending.discard(client)
+        self.delivered = self.delivered and written
+        if not self.pending:
+            self._resolve()
+
+    def _resolve(self):
+        for future in self.futures:
+            if not future.done():
+                future.set_result(self.delivered)
+
+
+class SubscriptionRegistry:
+    """The clients subscribed to each topic, and the topics of each client.
+
+    Changes are thread-safe. A topic's clients are a frozenset, which is replaced on
+    change, so that reads (``get``, ``in``) need no lock.
+    """
+
+    def __init__(self):
+        self.topics = {}  # (aid, iid): frozenset of (address, port) of clients
+        self.clients = {}  # (address, port): set of (aid, iid) topics
+        self.lock = threading.Lock()  # for changes
+
+    def __contains__(self, topic):
+        return topic in self.topics
+
+    def __len__(self):
+        return len(self.topics)
+
+    def get(self, topic):
+        """Return the clients subscribed to the given topic.
+
+        :rtype: frozenset <tuple <str, int>>
+        """
+        return self.topics.get(topic, EMPTY)
+
+    def subscribe(self, client, topic, subscribe=True):
+        """(Un)Subscribe the given client from the given topic.
+
+        :param client: A client (address, port) tuple.
+        :type client: tuple <str, int>
+
+        :param topic: The (aid, iid) of the characteristic.
+        :type topic: tuple <int, int>
+        """
+        with self.lock:
+            if subscribe:
+                self.topics[topic] = self.topics.get(topic, EMPTY) | {client}
+                self.clients.setdefault(client, set()).add(topic)
+                return
+            client_topics = self.clients.get(client)
+            if client_topics is None or topic not in client_topics:
+                return
+            client_topics.discard(topic)
+            if not client_topics:
+                del self.clients[client]
+            self._discard(topic, client)
+
+    def unsubscribe_client(self, client):
+        """Unsubscribe the given client from all of its topics."""
+        with self.lock:
+            for topic in self.clients.pop(client, ()):
+                self._discard(topic, client)
+
+    def _discard(self, topic, client):
+        clients = self.topics[topic] - {client}
+        if clients:
+            self.topics[topic] = clients
+        else:
+            del self.topics[topic]
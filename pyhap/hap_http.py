@@ -0,0 +1,132 @@
+"""Parses the HTTP/1.1 requests of HAP controllers.
+
+HAP uses a handful of methods, paths and headers, thus the requests are parsed
+directly from bytes, instead of with the generic ``http.server`` machinery (an
+``email`` message for the headers, ``urlparse`` and ``parse_qs`` for the path).
+"""
+from urllib.parse import unquote
+
+MAX_LINE_LENGTH = 65536  # bytes, like http.client
+MAX_HEADERS = 100  # like http.client
+
+SUPPORTED_VERSIONS = ("HTTP/1.0", "HTTP/1.1")
+DIGITS = frozenset("0123456789")
+
+
+class HTTPParseError(ValueError):
+    """A request cannot be parsed. Has the HTTP status code to respond with."""
+
+    def __init__(self, status, message):
+        super(HTTPParseError, self).__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Headers(dict):
+    """Request headers by lower-case name, that can be looked up in any case."""
+
+    def __getitem__(self, name):
+        return dict.__getitem__(self, name.lower())
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name.lower())
+
+    def get(self, name, default=None):
+        return dict.get(self, name.lower(), default)
+
+
+def _is_number(string):
+    """Whether the given string consists of ASCII digits only.
+
+    Unlike with ``str.isdigit``, other digits, e.g. "\xb2", are not accepted.
+    """
+    return bool(string) and DIGITS.issuperset(string)
+
+
+def _is_version(version):
+    """Whether the given string is a well-formed HTTP version, e.g. "HTTP/2.0"."""
+    major, _, minor = version[5:].partition(".")
+    return version.startswith("HTTP/") and _is_number(major) and _is_number(minor)
+
+
+def parse_request_line(line):
+    """Parse the request line, e.g. ``b"GET /accessories HTTP/1.1\\r\\n"``.
+
+    :param line: The request line, with or without the line terminator.
+    :type line: bytes
+
+    :return: The method, target (path and query) and version.
+    :rtype: tuple <str, str, str>
+
+    :raise HTTPParseError: If the line is not a HTTP/1.x request line.
+    """
+    words = line.split()
+    if len(words) != 3:
+        raise HTTPParseError(400, "Bad request syntax ({!r})".format(line))
+    method, target, version = (word.decode("iso-8859-1") for word in words)
+    if version not in SUPPORTED_VERSIONS:
+        if _is_version(version):
+            raise HTTPParseError(505, "Invalid HTTP version ({})".format(version))
+        raise HTTPParseError(400, "Bad request version ({!r})".format(version))
+    return method, target, version
+
+
+def read_headers(rfile):
+    """Read the header lines, up to and including the empty line.
+
+    :param rfile: A file object positioned after the request line.
+
+    :return: The headers. If a header is repeated, the last value wins.
+    :rtype: Headers
+
+    :raise HTTPParseError: If a line is too long or there are too many headers.
+    """
+    headers = Headers()
+    for _ in range(MAX_HEADERS + 1):
+        line = rfile.readline(MAX_LINE_LENGTH + 1)
+        if len(line) > MAX_LINE_LENGTH:
+            raise HTTPParseError(431, "Line too long")
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, sep, value = line.partition(b":")
+        if not sep:
+            raise HTTPParseError(400, "Bad header line ({!r})".format(line))
+        headers[name.strip().decode("iso-8859-1").lower()] = \
+            value.strip().decode("iso-8859-1")
+    raise HTTPParseError(431, "Too many headers")
+
+
+def content_length(headers):
+    """Return the value of the Content-Length header, 0 if not given.
+
+    :raise HTTPParseError: If the value is not a non-negative integer.
+    """
+    value = headers.get("content-length")
+    if value is None:
+        return 0
+    if not _is_number(value):
+        raise HTTPParseError(400, "Bad Content-Length ({!r})".format(value))
+    return int(value)
+
+
+def parse_char_ids(query):
+    """Parse the ``id`` parameter of a ``GET /characteristics`` query.
+
+    :param query: The query part of the path, e.g. ``"id=1.9,2.10&ev=1"``.
+    :type query: str
+
+    :return: The (aid, iid) pair of each requested characteristic.
+    :rtype: list <tuple <int, int>>
+
+    :raise ValueError: If there is no ``id`` parameter or it is malformed.
+    """
+    for param in query.split("&"):
+        if param.startswith("id="):
+            if "%" in param:
+                param = unquote(param)
+            char_ids = []
+            for char_id in param[3:].split(","):
+                aid, _, iid = char_id.partition(".")
+                char_ids.append((int(aid), int(iid)))
+            return char_ids
+    raise ValueError("No id parameter in query {!r}".format(query))
@@ -0,0 +1,442 @@
+"""This module implements the HAP server on top of asyncio.
+
+Instead of a thread per connection, all connections are served by the
+``AccessoryDriver`` event loop:
+
+- ``AsyncHAPServer`` listens for controllers and pushes events to them.
+- ``HAPServerProtocol`` does the framing of a connection - HTTP messages and, after
+  pair verify, the encryption - and processes its requests one at a time.
+- ``AsyncHAPServerHandler`` is the ``HAPServerHandler`` of a connection. It keeps the
+  pairing state and handles the requests in the executor, as they may call blocking
+  accessory callbacks.
+"""
+import asyncio
+import io
+import logging
+
+import pyhap.hap_connections as hap_connections
+import pyhap.hap_crypto as hap_crypto
+from pyhap import util
+from pyhap.hap_server import HAPServer, HAPServerHandler, HAPSocket
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncHAPServerHandler(HAPServerHandler):
+    """A ``HAPServerHandler`` that is fed requests by a ``HAPServerProtocol``.
+
+    Responses are collected instead of sent, as the protocol owns the transport.
+    """
+
+    def __init__(self, client_addr, server, accessory_handler):
+        """Initialise the handler state, without handling any request yet."""
+        self.response = []  # buffers of the current response
+        self.upgrade_key = None  # set when the transport should become encrypted
+        super(AsyncHAPServerHandler, self).__init__(
+            None, client_addr, server, accessory_handler)
+
+    # BaseRequestHandler would handle the connection in __init__.
+    def setup(self):
+        self.wfile = io.BytesIO()
+
+    def handle(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def parse_head(self, head):
+        """Parse the request line and headers of a request.
+
+        :param head: The request head, including the terminating empty line.
+        :type head: bytes
+
+        :return: Whether the request can be handled. If not, an error response is in
+            ``self.response``.
+        :rtype: bool
+        """
+        self.response = []
+        self.rfile = io.BytesIO(head)
+        self.raw_requestline = self.rfile.readline(65537)
+        if self.parse_request():
+            return True
+        self._collect_response()
+        self.close_connection = True
+        return False
+
+    def handle_request(self, body):
+        """Handle the request with the given body, that was last parsed.
+
+        :return: The response buffers.
+        :rtype: list
+        """
+        self.rfile = io.BytesIO(body)
+        self.response = []
+        method = getattr(self, 'do_' + self.command, None)
+        try:
+            if method is None:
+                self.send_error(501, "Unsupported method ({})".format(self.command))
+            else:
+                method()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception("Error while handling request from %s.",
+                             self.client_address)
+            self._headers_buffer = []
+            self.send_error(500)
+            self.close_connection = True
+        if getattr(self, '_headers_buffer', None):
+            # A response was started without a body, e.g. a 403.
+            self.end_response(b'', self.close_connection)
+        self._collect_response()
+        return self.response
+
+    def send_buffers(self, buffers):
+        """Collect the response buffers for the protocol to send."""
+        self._collect_response()
+        self.response.extend(buffers)
+
+    def _collect_response(self):
+        """Move anything written directly into wfile, e.g. errors, to the response."""
+        written = self.wfile.getvalue()
+        if written:
+            self.response.append(written)
+            self.wfile = io.BytesIO()
+
+    def _upgrade_to_encrypted(self):
+        """Encrypt the transport once the current response is sent."""
+        self.upgrade_key = self.enc_context["shared_key"]
+        self.is_encrypted = True
+
+
+class HAPServerProtocol(asyncio.Protocol):
+    """The asyncio protocol of a HAP connection.
+
+    Requests are processed in order. While a request is handled in the executor,
+    further data is only buffered. Responses and events are written from the loop,
+    thus the outbound frames of the connection are always sealed in order.
+
+    Events have their own outbound queue per connection. They are written when the
+    transport accepts more data, so a controller that does not read only holds up its
+    own events. If the transport stays paused for longer than the send timeout of the
+    server's ``SlowConsumerPolicy``, the connection is aborted.
+    """
+
+    MAX_HEAD_LENGTH = 0x10000  # bytes, larger request heads close the connection
+    HEAD_END = b"\r\n\r\n"
+
+    def __init__(self, loop, server, accessory_handler):
+        """Initialise a protocol for a new connection of the given server."""
+        self.loop = loop
+        self.server = server
+        self.accessory_handler = accessory_handler
+        self.transport = None
+        self.peername = None
+        self.handler = None
+        self.request_buffer = bytearray()  # received plaintext, not yet handled
+        self.decoder = None
+        self.encoder = None
+        self.handling = False  # whether a request is being handled
+        # event payloads not yet written
+        self.events = hap_connections.EventBacklog(server.slow_consumer)
+        self.flush_scheduled = False  # whether _flush_events is scheduled
+        self.paused = False  # whether the transport asked to stop writing
+        self.send_deadline = None  # aborts the connection if paused for too long
+
+    def connection_made(self, transport):
+        """Register the new connection with the server."""
+        self.transport = transport
+        self.peername = transport.get_extra_info('peername')[:2]
+        logger.info("Got connection with %s.", self.peername)
+        if not self.server.connections.add(self.peername, self):
+            self.close()
+            return
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            hap_connections.set_keepalive(sock)
+        self.handler = AsyncHAPServerHandler(
+            self.peername, self.server, self.accessory_handler)
+
+    def connection_lost(self, exc):
+        """Unregister the connection from the server."""
+        logger.debug("Connection with %s lost: %s", self.peername, exc)
+        self.server.connections.remove(self.peername, self)
+        if self.handler is not None:
+            self.handler.end_pair_setup()
+        self.transport = None
+        self._cancel_send_deadline()
+        self.events.clear()
+
+    def pause_writing(self):
+        """Hold back events until the transport's write buffer drains."""
+        self.paused = True
+        send_timeout = self.server.slow_consumer.send_timeout
+        if send_timeout is not None and self.send_deadline is None:
+            self.send_deadline = self.loop.call_later(send_timeout,
+                                                      self._send_timed_out)
+
+    def resume_writing(self):
+        """Write the events that were held back."""
+        self.paused = False
+        self._cancel_send_deadline()
+        self._flush_events()
+
+    def _cancel_send_deadline(self):
+        if self.send_deadline is not None:
+            self.send_deadline.cancel()
+            self.send_deadline = None
+
+    def _send_timed_out(self):
+        """The controller did not read in time, give up on it."""
+        self.send_deadline = None
+        self.server.slow_consumer.evict(self.peername, timed_out=True)
+        self.abort()
+
+    def data_received(self, data):
+        """Buffer (and decrypt) the data and handle the next request if complete."""
+        if self.handler is None:  # rejected
+            return
+        if self.decoder is None:
+            self.request_buffer += data
+        else:
+            self.decoder.feed(data)
+            try:
+                self.request_buffer += self.decoder.read()
+            except ValueError:
+                logger.warning("Closing connection with %s: could not decrypt data.",
+                               self.peername)
+                self.close()
+                return
+        self._process_next()
+
+    def write(self, buffers):
+        """Send the given buffers to the controller, encrypted if needed."""
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.encoder is None:
+            self.transport.writelines([buffer for buffer in buffers if buffer])
+        else:
+            self.transport.write(self.encoder.encrypt(buffers))
+
+    def send_event(self, bytesdata):
+        """Push the given event payload to the controller."""
+        self.write(HAPServer.create_hap_event_buffers(bytesdata))
+        self.server.connections.touch(self.peername)
+
+    def queue_event(self, bytesdata, on_written=None):
+        """Queue the given event payload and make sure it is written, thread-safe.
+
+        :param on_written: Called in the event loop with whether the payload was
+            written to the transport.
+        :type on_written: callable
+
+        :return: False if the controller should be disconnected as a slow consumer,
+            True otherwise.
+        :rtype: bool
+
+        :raise RuntimeError: If the loop is closed.
+        """
+        if not self.events.put(bytesdata, on_written):
+            return False
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            if util.in_loop(self.loop):
+                self.loop.call_soon(self._flush_events)
+            else:
+                self.loop.call_soon_threadsafe(self._flush_events)
+        return True
+
+    def _flush_events(self):
+        """Write the queued events in one go, unless the transport is paused."""
+        self.flush_scheduled = False
+        if self.paused:
+            return
+        events, callbacks = self.events.pop_all()
+        if not events:
+            return
+        written = self.transport is not None and not self.transport.is_closing()
+        buffers = []
+        for bytesdata in events:
+            buffers.extend(HAPServer.create_hap_event_buffers(bytesdata))
+        self.write(buffers)
+        self.server.connections.touch(self.peername)
+        hap_connections.notify_written(callbacks, written)
+
+    def close(self):
+        """Close the connection."""
+        if self.transport is not None:
+            self.transport.close()
+
+    def abort(self):
+        """Close the connection right away, discarding the unsent data."""
+        if self.transport is not None:
+            self.transport.abort()
+
+    def _process_next(self):
+        """Start handling the next complete request in the buffer, if any."""
+        if self.handling or self.transport is None:
+            return
+        head_end = self.request_buffer.find(self.HEAD_END)
+        if head_end == -1:
+            if len(self.request_buffer) > self.MAX_HEAD_LENGTH:
+                self.close()
+            return
+        head_end += len(self.HEAD_END)
+        head = bytes(self.request_buffer[:head_end])
+        if not self.handler.parse_head(head):
+            self.write(self.handler.response)
+            self.close()
+            return
+        body_end = head_end + self.handler.content_length
+        if len(self.request_buffer) < body_end:
+            return
+        body = bytes(self.request_buffer[head_end:body_end])
+        del self.request_buffer[:body_end]
+
+        self.handling = True
+        task = self.loop.run_in_executor(None, self.handler.handle_request, body)
+        task.add_done_callback(self._request_done)
+
+    def _request_done(self, task):
+        """Send the response and continue with the next request."""
+        self.handling = False
+        if task.cancelled() or task.exception() is not None:
+            self.close()
+            return
+        self.write(task.result())
+        if self.handler.upgrade_key is not None:
+            self._upgrade_to_encrypted(self.handler.upgrade_key)
+            self.handler.upgrade_key = None
+        if self.handler.close_connection:
+            self.close()
+            return
+        self._process_next()
+
+    def _upgrade_to_encrypted(self, shared_key):
+        """Encrypt everything after the pair verify response."""
+        provider = hap_crypto.get_provider()
+        out_key = provider.hkdf(shared_key, HAPSocket.CIPHER_SALT,
+                                HAPSocket.OUT_CIPHER_INFO)
+        in_key = provider.hkdf(shared_key, HAPSocket.CIPHER_SALT,
+                               HAPSocket.IN_CIPHER_INFO)
+        self.encoder = hap_crypto.HAPFrameEncoder(provider.aead(out_key))
+        self.decoder = hap_crypto.HAPFrameDecoder(provider.aead(in_key))
+        self.server.connections.set_encrypted(self.peername)
+        logger.debug("Switched to encrypted transport with %s.", self.peername)
+        if self.request_buffer:
+            # Already received data belongs to the encrypted session.
+            self.decoder.feed(self.request_buffer)
+            self.request_buffer = bytearray(self.decoder.read())
+
+
+class AsyncHAPServer:
+    """Point of contact for HAP clients, served by an asyncio event loop.
+
+    .. seealso:: HAPServer
+    """
+
+    REAP_INTERVAL = 1  # seconds, how often to look for idle connections
+
+    def __init__(self, addr_port, accessory_handler, max_connections=None,
+                 idle_timeout=None, slow_consumer=None):
+        """Initialise the server. It listens once ``async_start`` is called.
+
+        :param addr_port: The address and port to listen on.
+        :type addr_port: tuple <str, int>
+
+        :param accessory_handler: The driver that handles the requests.
+        :type accessory_handler: AccessoryDriver
+
+        :param max_connections: How many connections may be open at the same time.
+            Further connections are closed right away.
+        :type max_connections: int
+
+        :param idle_timeout: Seconds without requests or events after which a
+            connection is closed.
+        :type idle_timeout: float
+
+        :param slow_consumer: Limits the events queued for each client and the time to
+            send them. Defaults to a ``SlowConsumerPolicy``.
+        :type slow_consumer: hap_connections.SlowConsumerPolicy
+        """
+        self.addr_port = addr_port
+        self.slow_consumer = slow_consumer or hap_connections.SlowConsumerPolicy()
+        self.accessory_handler = accessory_handler
+        # (address, port): HAPServerProtocol
+        self.connections = hap_connections.ConnectionRegistry(
+            max_connections, idle_timeout,
+            on_remove=accessory_handler.unsubscribe_client)
+        self.loop = None
+        self.server = None
+        self.reap_handle = None
+
+    async def async_start(self, loop):
+        """Start listening for connections on the given loop."""
+        self.loop = loop
+        self.server = await loop.create_server(
+            lambda: HAPServerProtocol(loop, self, self.accessory_handler),
+            self.addr_port[0], self.addr_port[1], reuse_address=True)
+        logger.info("Started HAP server on %s:%s", *self.addr_port)
+        if self.connections.idle_timeout is not None:
+            self.reap_handle = loop.call_later(self.REAP_INTERVAL, self._reap_idle)
+
+    def _reap_idle(self):
+        """Close the idle connections, then check again later."""
+        for _, protocol in self.connections.reap_idle():
+            protocol.close()
+        self.reap_handle = self.loop.call_later(self.REAP_INTERVAL, self._reap_idle)
+
+    async def async_stop(self):
+        """Stop listening and close all connections."""
+        logger.info("Stopping HAP server")
+        if self.reap_handle is not None:
+            self.reap_handle.cancel()
+            self.reap_handle = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+        for protocol in self.connections.clear():
+            protocol.close()
+
+    def push_event(self, bytesdata, client_addr, on_written=None):
+        """Send an event to the given client, thread-safe.
+
+        The event is put in the outbound queue of the connection and written from
+        the event loop.
+
+        :param bytesdata: The data to send.
+        :type bytesdata: bytes
+
+        :param client_addr: A client (address, port) tuple to which to send the data.
+        :type client_addr: tuple <str, int>
+
+        :param on_written: If the event is queued, called in the event loop with
+            whether it was written to the transport.
+        :type on_written: callable
+
+        :return: False if the client is not connected, or is disconnected as a slow
+            consumer, True otherwise.
+        :rtype: bool
+        """
+        protocol = self.connections.get(client_addr)
+        if protocol is None:
+            return False
+        try:
+            if protocol.queue_event(bytesdata, on_written):
+                return True
+            self.slow_consumer.evict(client_addr)
+            if util.in_loop(self.loop):
+                protocol.abort()
+            else:
+                self.loop.call_soon_threadsafe(protocol.abort)
+        except RuntimeError:  # The loop is closed.
+            pass
+        return False
+
+    def event_queue_depths(self):
+        """Return the number of events queued for each client.
+
+        :rtype: dict <tuple <str, int>, int>
+        """
+        return {protocol.peername: len(protocol.events)
+                for protocol in self.connections.values()}
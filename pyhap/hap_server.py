@@ -7,21 +7,27 @@ The HAPSocket is a socket implementation that manages the "TLS" of the connectio
 from http.server import HTTPServer, BaseHTTPRequestHandler
 from http import HTTPStatus
 import logging
+import os
 import socket
-import struct
 import json
 import errno
+import functools
+import io
+import queue
+import selectors
+import time
 import uuid
-from urllib.parse import urlparse, parse_qs
 import socketserver
 import threading
 
-from tlslite.utils.chacha20_poly1305 import CHACHA20_POLY1305
-from Crypto.Protocol.KDF import HKDF
 from Crypto.Hash import SHA512
-import curve25519
-import ed25519
 
+import pyhap.hap_admission as hap_admission
+import pyhap.hap_connections as hap_connections
+import pyhap.hap_crypto as hap_crypto
+import pyhap.hap_http as hap_http
+import pyhap.hap_sessions as hap_sessions
+import pyhap.hap_workers as hap_workers
 import pyhap.tlv as tlv
 from pyhap.util import long_to_bytes
 
@@ -38,7 +44,9 @@ class HAP_TLV_TAGS:
     ENCRYPTED_DATA = b'\x05'
     SEQUENCE_NUM = b'\x06'
     ERROR_CODE = b'\x07'
+    RETRY_DELAY = b'\x08'
     PROOF = b'\x0A'
+    SESSION_ID = b'\x0E'
 
 
 # Status codes for underlying HAP calls
@@ -59,23 +67,27 @@ class HAP_SERVER_STATUS:
 # Error codes and the like, guessed by packet inspection
 class HAP_OPERATION_CODE:
     INVALID_REQUEST = b'\x02'
+    BACKOFF = b'\x03'
     INVALID_SIGNATURE = b'\x04'
+    BUSY = b'\x07'
+
+
+# Limit of buffers per sendmsg call, POSIX guarantees at least 16 (IOV_MAX).
+SENDMSG_MAX_BUFFERS = 16
 
 
 class HAP_CRYPTO:
-    HKDF_KEYLEN = 32  # bytes, length of expanded HKDF keys
+    HKDF_KEYLEN = hap_crypto.HKDF_KEYLEN  # bytes, length of expanded HKDF keys
     HKDF_HASH = SHA512  # Hash function to use in key expansion
-    TLS_NONCE_LEN = 12  # bytes, length of TLS encryption nonce
+    TLS_NONCE_LEN = hap_crypto.TLS_NONCE_LEN  # bytes, length of TLS encryption nonce
 
 
-def _pad_tls_nonce(nonce, total_len=HAP_CRYPTO.TLS_NONCE_LEN):
-    """Pads a nonce with zeroes so that total_len is reached."""
-    return nonce.rjust(total_len, b"\x00")
+_pad_tls_nonce = hap_crypto.pad_tls_nonce
 
 
 def hap_hkdf(key, salt, info):
     """Just a shorthand."""
-    return HKDF(key, HAP_CRYPTO.HKDF_KEYLEN, salt, HAP_CRYPTO.HKDF_HASH, context=info)
+    return hap_crypto.hap_hkdf(key, salt, info)
 
 
 class UnprivilegedRequestException(Exception):
@@ -128,6 +140,17 @@ class HAPServerHandler(BaseHTTPRequestHandler):
 
     PVERIFY_2_NONCE = _pad_tls_nonce(b"PV-Msg03")
 
+    PAIR_RESUME_METHOD = b"\x06"
+    PRESUME_SESSION_ID_SALT = b"Pair-Verify-ResumeSessionID-Salt"
+    PRESUME_SESSION_ID_INFO = b"Pair-Verify-ResumeSessionID-Info"
+    PRESUME_1_INFO = b"Pair-Resume-Request-Info"
+    PRESUME_1_NONCE = _pad_tls_nonce(b"PR-Msg01")
+    PRESUME_2_INFO = b"Pair-Resume-Response-Info"
+    PRESUME_2_NONCE = _pad_tls_nonce(b"PR-Msg02")
+    PRESUME_SHARED_SECRET_INFO = b"Pair-Resume-Shared-Secret-Info"
+
+    PAIR_SETUP_TIMEOUT = 60  # seconds from the first to the last pair setup request
+
     def __init__(self, sock, client_addr, server, accessory_handler):
         """
         @param accessory_handler: An object that controls an accessory's state.
@@ -137,14 +160,71 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         self.state = self.accessory_handler.state
         self.enc_context = None
         self.is_encrypted = False
+        self.srp_verifier = None  # of the pair setup on this connection
+        self.srp_expiry = None  # time.monotonic() after which the pair setup expires
+        self.routes = self._get_routes()
+        self.route_path = None  # the path of the current request, without the query
+        self.query = ""  # the query of the current request
+        self.content_length = 0  # of the current request
         # Redirect separate handlers to the dispatch method
         self.do_GET = self.do_POST = self.do_PUT = self.dispatch
 
         super(HAPServerHandler, self).__init__(sock, client_addr, server)
 
+    def finish(self):
+        """End the pair setup in progress, if any, and close the file handles."""
+        self.end_pair_setup()
+        super(HAPServerHandler, self).finish()
+
+    @classmethod
+    def _get_routes(cls):
+        """Return the (method, path): handler function table, built once per class."""
+        routes = cls.__dict__.get("_routes")
+        if routes is None:
+            routes = {(method, path): getattr(cls, name)
+                      for method, paths in cls.HANDLERS.items()
+                      for path, name in paths.items()}
+            cls._routes = routes
+        return routes
+
     def log_message(self, format, *args):
         logger.info("%s - %s", self.address_string(), format % args)
 
+    def parse_request(self):
+        """Parse the request line and headers, in raw_requestline and rfile.
+
+        Replaces the generic ``BaseHTTPRequestHandler`` parser with ``hap_http``.
+        Sets ``command``, ``path``, ``request_version``, ``headers``, ``route_path``,
+        ``query`` and ``content_length``.
+
+        @return: Whether the request was parsed. If not, an error was sent.
+        @rtype: bool
+        """
+        self.command = None
+        self.request_version = self.default_request_version
+        self.close_connection = True
+        self.requestline = str(self.raw_requestline, "iso-8859-1").rstrip("\r\n")
+        try:
+            self.command, self.path, self.request_version = \
+                hap_http.parse_request_line(self.raw_requestline)
+            self.headers = hap_http.read_headers(self.rfile)
+            self.content_length = hap_http.content_length(self.headers)
+        except hap_http.HTTPParseError as e:
+            self.send_error(e.status, e.message)
+            return False
+        self.route_path, _, self.query = self.path.partition("?")
+        self.server.connections.touch(self.client_address)
+
+        # Same connection semantics as BaseHTTPRequestHandler.
+        keep_alive = self.protocol_version >= "HTTP/1.1"
+        conntype = self.headers.get("Connection", "").lower()
+        if conntype == "close":
+            keep_alive = False
+        elif self.request_version < "HTTP/1.1" and conntype != "keep-alive":
+            keep_alive = False
+        self.close_connection = not keep_alive
+        return True
+
     def _set_encryption_ctx(self, client_public, private_key, public_key, shared_key,
                             pre_session_key):
         """Sets the encryption context.
@@ -183,25 +263,40 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         # Recreate the file handles over the socket
         # TODO: consider calling super().setup(), although semantically not correct
         self.connection = self.request
-        self.rfile = self.connection.makefile('rb', self.rbufsize)
+        self.rfile = self._make_rfile()
         self.wfile = self.connection.makefile('wb')
         self.is_encrypted = True
 
+    def _make_rfile(self):
+        """Return the file to read requests from the connection with."""
+        return self.connection.makefile('rb', self.rbufsize)
+
     def end_response(self, bytesdata, close_connection=False):
-        """Combines adding a length header and actually sending the data."""
+        """Combines adding a length header and actually sending the data.
+
+        The status line, headers and body are sent together, with a single call.
+        """
         self.send_header("Content-Length", len(bytesdata))
-        self.end_headers()
-        self.wfile.write(bytesdata)
+        self._headers_buffer.append(b"\r\n")
+        self.send_buffers((b"".join(self._headers_buffer), bytesdata))
+        self._headers_buffer = []
         self.close_connection = 1 if close_connection else 0
 
+    def send_buffers(self, buffers):
+        """Send the given response buffers to the client."""
+        self.wfile.flush()
+        send_buffers(self.connection, buffers)
+
     def dispatch(self):
         """Dispatch the request to the appropriate handler method."""
         logger.debug("Request %s from address '%s' for path '%s'.",
                      self.command, self.client_address, self.path)
-        path = urlparse(self.path).path
-        assert path in self.HANDLERS[self.command]
+        handler = self.routes.get((self.command, self.route_path))
+        if handler is None:
+            self.send_error(404)
+            return
         try:
-            getattr(self, self.HANDLERS[self.command][path])()
+            handler(self)
         except NotAllowedInStateException:
             self.send_response(403)
         except UnprivilegedRequestException:
@@ -216,16 +311,61 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         if self.state.paired:
             raise NotAllowedInStateException
 
-        length = int(self.headers["Content-Length"])
+        length = self.content_length
         tlv_objects = tlv.decode(self.rfile.read(length))
         sequence = tlv_objects[HAP_TLV_TAGS.SEQUENCE_NUM]
+        if not self._admit_handshake(sequence, self.srp_verifier is not None):
+            return
 
-        if sequence == b'\x01':
-            self._pairing_one()
-        elif sequence == b'\x03':
-            self._pairing_two(tlv_objects)
-        elif sequence == b'\x05':
-            self._pairing_three(tlv_objects)
+        try:
+            if sequence == b'\x01':
+                self._pairing_one()
+            elif sequence == b'\x03':
+                self._pairing_two(tlv_objects)
+            elif sequence == b'\x05':
+                try:
+                    self._pairing_three(tlv_objects)
+                finally:
+                    self.end_pair_setup()
+        finally:
+            self.accessory_handler.handshake_admission.release()
+
+    def _admit_handshake(self, sequence, in_progress):
+        """Admit a pair setup or pair verify request, or answer that it is rejected.
+
+        A request continues a handshake only if this connection has one in progress,
+        whatever its sequence number says; any other request starts a handshake. The
+        controller is told to retry later with a Busy or Backoff error.
+
+        @param sequence: The sequence number of the request.
+        @type sequence: bytes
+
+        @param in_progress: Whether a handshake of the kind of the request is in
+            progress on this connection, i.e. its state is kept.
+        @type in_progress: bool
+
+        @return: Whether the request is admitted. If so, release it when handled.
+        @rtype: bool
+        """
+        try:
+            self.accessory_handler.handshake_admission.acquire(
+                self.client_address[0],
+                new_handshake=sequence == b'\x01' or not in_progress)
+            return True
+        except hap_admission.HandshakeRejected as e:
+            logger.debug("Rejecting %s request from %s: %s, retry in %ss.",
+                         self.route_path, self.client_address, e.reason,
+                         e.retry_delay)
+            error_code = HAP_OPERATION_CODE.BUSY \
+                if e.reason == hap_admission.REJECT_BUSY else HAP_OPERATION_CODE.BACKOFF
+            response = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, bytes([sequence[0] + 1]),
+                                  HAP_TLV_TAGS.ERROR_CODE, error_code,
+                                  HAP_TLV_TAGS.RETRY_DELAY,
+                                  bytes([min(e.retry_delay, 255)]))
+            self.send_response(200)
+            self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
+            self.end_response(response)
+            return False
 
     def _pairing_one(self):
         """Send the SRP salt and public key to the client.
@@ -233,8 +373,13 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         The SRP verifier is created at this step.
         """
         logger.debug("Pairing [1/5]")
-        self.accessory_handler.setup_srp_verifier()
-        salt, B = self.accessory_handler.srp_verifier.get_challenge()
+        self.end_pair_setup()  # of a previous attempt, if any
+        self.srp_verifier = self.accessory_handler.new_srp_verifier()
+        self.srp_expiry = time.monotonic() + self.PAIR_SETUP_TIMEOUT
+        # Do not keep the verifier of an abandoned pair setup until the next request.
+        self.accessory_handler.call_later(self.PAIR_SETUP_TIMEOUT,
+                                          self._expire_pair_setup)
+        salt, B = self.srp_verifier.get_challenge()
 
         data = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, b'\x02',
                           HAP_TLV_TAGS.SALT, salt,
@@ -244,6 +389,33 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
         self.end_response(data, False)
 
+    def _get_srp_verifier(self):
+        """Return the SRP verifier of the pair setup on this connection.
+
+        @return: The verifier, None if pair setup was not started on this connection
+            or it expired.
+        @rtype: pyhap.hsrp.Server
+        """
+        if self.srp_verifier is not None and time.monotonic() > self.srp_expiry:
+            self._expire_pair_setup()
+        return self.srp_verifier
+
+    def _expire_pair_setup(self):
+        """Drop the SRP verifier of the pair setup, which took too long."""
+        if self.srp_verifier is not None:
+            logger.warning("Pair setup with %s expired.", self.client_address)
+            self.end_pair_setup()
+
+    def end_pair_setup(self):
+        """Drop the SRP verifier of the pair setup on this connection, if any.
+
+        Called when the pair setup is over or the connection closes.
+        """
+        if self.srp_verifier is None:
+            return
+        self.srp_verifier = None
+        self.accessory_handler.cancel_call_later(self._expire_pair_setup)
+
     def _pairing_two(self, tlv_objects):
         """Obtain the challenge from the client (A) and client's proof that it
         knows the password (M). Verify M and generate the server's proof based on
@@ -255,12 +427,23 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         logger.debug("Pairing [2/5]")
         A = tlv_objects[HAP_TLV_TAGS.PUBLIC_KEY]
         M = tlv_objects[HAP_TLV_TAGS.PASSWORD_PROOF]
-        verifier = self.accessory_handler.srp_verifier
-        verifier.set_A(A)
-
-        hamk = verifier.verify(M)
+        verifier = self._get_srp_verifier()
+        crypto_pool = self.accessory_handler.crypto_pool
+        try:
+            if verifier is None:
+                raise ValueError("No pair setup in progress")
+            premaster_secret = None
+            if crypto_pool is not None:
+                premaster_secret = crypto_pool.run(hap_workers.srp_premaster_secret,
+                                                   verifier, A)
+            verifier.set_A(A, premaster_secret)
+            hamk = verifier.verify(M)
+        except ValueError as e:  # Also if A % N == 0, which would make K known.
+            logger.error("Pairing with %s failed: %s", self.client_address, e)
+            hamk = None
 
         if hamk is None:  # Probably the provided pincode was wrong.
+            self.end_pair_setup()
             response = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, b'\x04',
                                   HAP_TLV_TAGS.ERROR_CODE,
                                   HAP_OPERATION_CODE.INVALID_REQUEST)
@@ -285,15 +468,27 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         logger.debug("Pairing [3/5]")
         encrypted_data = tlv_objects[HAP_TLV_TAGS.ENCRYPTED_DATA]
 
-        session_key = self.accessory_handler.srp_verifier.get_session_key()
+        verifier = self._get_srp_verifier()
+        if verifier is None or verifier.HAMK is None:
+            logger.error("Pairing with %s failed: no verified pair setup in progress",
+                         self.client_address)
+            response = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, b'\x06',
+                                  HAP_TLV_TAGS.ERROR_CODE,
+                                  HAP_OPERATION_CODE.INVALID_REQUEST)
+            self.send_response(200)
+            self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
+            self.end_response(response)
+            return
+
+        session_key = verifier.get_session_key()
         hkdf_enc_key = hap_hkdf(long_to_bytes(session_key),
                                 self.PAIRING_3_SALT, self.PAIRING_3_INFO)
 
-        cipher = CHACHA20_POLY1305(hkdf_enc_key, "python")
-        decrypted_data = cipher.open(self.PAIRING_3_NONCE, bytearray(encrypted_data), b"")
+        cipher = hap_crypto.get_provider().aead(hkdf_enc_key)
+        decrypted_data = cipher.open(self.PAIRING_3_NONCE, encrypted_data, b"")
         assert decrypted_data is not None
 
-        dec_tlv_objects = tlv.decode(bytes(decrypted_data))
+        dec_tlv_objects = tlv.decode(decrypted_data)
         client_username = dec_tlv_objects[HAP_TLV_TAGS.USERNAME]
         client_ltpk = dec_tlv_objects[HAP_TLV_TAGS.PUBLIC_KEY]
         client_proof = dec_tlv_objects[HAP_TLV_TAGS.PROOF]
@@ -318,18 +513,14 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         @type encryption_key: bytes
         """
         logger.debug("Pairing [4/5]")
-        session_key = self.accessory_handler.srp_verifier.get_session_key()
+        session_key = self.srp_verifier.get_session_key()
         output_key = hap_hkdf(long_to_bytes(session_key),
                               self.PAIRING_4_SALT, self.PAIRING_4_INFO)
 
         data = output_key + client_username + client_ltpk
-        verifying_key = ed25519.VerifyingKey(client_ltpk)
-
-        try:
-            verifying_key.verify(client_proof, data)
-        except ed25519.BadSignatureError:
+        if not hap_crypto.get_provider().ed25519_verify(client_ltpk, client_proof, data):
             logger.error("Bad signature, abort.")
-            raise
+            raise ValueError("Bad signature")
 
         self._pairing_five(client_username, client_ltpk, encryption_key)
 
@@ -340,7 +531,7 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         Parameters are as for _pairing_four.
         """
         logger.debug("Pairing [5/5]")
-        session_key = self.accessory_handler.srp_verifier.get_session_key()
+        session_key = self.srp_verifier.get_session_key()
         output_key = hap_hkdf(long_to_bytes(session_key),
                               self.PAIRING_5_SALT, self.PAIRING_5_INFO)
 
@@ -348,16 +539,15 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         mac = self.state.mac.encode()
 
         material = output_key + mac + server_public
-        private_key = self.state.private_key
-        server_proof = private_key.sign(material)
+        provider = hap_crypto.get_provider()
+        server_proof = provider.ed25519_sign(self.state.private_key, material)
 
         message = tlv.encode(HAP_TLV_TAGS.USERNAME, mac,
                              HAP_TLV_TAGS.PUBLIC_KEY, server_public,
                              HAP_TLV_TAGS.PROOF, server_proof)
 
-        cipher = CHACHA20_POLY1305(encryption_key, "python")
-        aead_message = bytes(
-            cipher.seal(self.PAIRING_5_NONCE, bytearray(message), b""))
+        cipher = provider.aead(encryption_key)
+        aead_message = cipher.seal(self.PAIRING_5_NONCE, message, b"")
 
         client_uuid = uuid.UUID(str(client_username, "utf-8"))
         should_confirm = self.accessory_handler.pair(client_uuid, client_ltpk)
@@ -380,15 +570,25 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         if not self.state.paired:
             raise NotAllowedInStateException
 
-        length = int(self.headers["Content-Length"])
+        length = self.content_length
         tlv_objects = tlv.decode(self.rfile.read(length))
         sequence = tlv_objects[HAP_TLV_TAGS.SEQUENCE_NUM]
-        if sequence == b'\x01':
-            self._pair_verify_one(tlv_objects)
-        elif sequence == b'\x03':
-            self._pair_verify_two(tlv_objects)
-        else:
-            raise
+        in_progress = self.enc_context is not None and not self.is_encrypted
+        if not self._admit_handshake(sequence, in_progress):
+            return
+
+        try:
+            if sequence == b'\x01':
+                if tlv_objects.get(HAP_TLV_TAGS.REQUEST_TYPE) == \
+                        self.PAIR_RESUME_METHOD and self._pair_resume(tlv_objects):
+                    return
+                self._pair_verify_one(tlv_objects)
+            elif sequence == b'\x03':
+                self._pair_verify_two(tlv_objects)
+            else:
+                raise
+        finally:
+            self.accessory_handler.handshake_admission.release()
 
     def _pair_verify_one(self, tlv_objects):
         """Generate new session key pair and send a proof to the client.
@@ -397,33 +597,37 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         @type tlv_object: dict
         """
         logger.debug("Pair verify [1/2].")
+        started = time.perf_counter()
         client_public = tlv_objects[HAP_TLV_TAGS.PUBLIC_KEY]
 
-        private_key = curve25519.Private()
-        public_key = private_key.get_public()
-        shared_key = private_key.get_shared_key(
-            curve25519.Public(client_public),
-            # Key is hashed before being returned, we don't want it; This fixes that.
-            lambda x: x)
-
+        provider = hap_crypto.get_provider()
         mac = self.state.mac.encode()
-        material = public_key.serialize() + mac + client_public
-        server_proof = self.state.private_key.sign(material)
+        crypto_pool = self.accessory_handler.crypto_pool
+        if crypto_pool is None:
+            private_key, public_key = self.accessory_handler.keypair_pool.take()
+            shared_key = provider.x25519_exchange(private_key, client_public)
+        else:
+            private_key = None  # stays in the worker process
+            public_key, shared_key = crypto_pool.run(
+                hap_workers.pair_verify_exchange, provider.name, client_public)
+        # The long term key is only used here, it never leaves this process.
+        material = public_key + mac + client_public
+        server_proof = provider.ed25519_sign(self.state.private_key, material)
 
         output_key = hap_hkdf(shared_key, self.PVERIFY_1_SALT, self.PVERIFY_1_INFO)
 
         self._set_encryption_ctx(client_public, private_key, public_key,
                                  shared_key, output_key)
+        self.enc_context["handshake_time"] = time.perf_counter() - started
 
         message = tlv.encode(HAP_TLV_TAGS.USERNAME, mac,
                              HAP_TLV_TAGS.PROOF, server_proof)
 
-        cipher = CHACHA20_POLY1305(output_key, "python")
-        aead_message = bytes(
-            cipher.seal(self.PVERIFY_1_NONCE, bytearray(message), b""))
+        cipher = provider.aead(output_key)
+        aead_message = cipher.seal(self.PVERIFY_1_NONCE, message, b"")
         data = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, b'\x02',
                           HAP_TLV_TAGS.ENCRYPTED_DATA, aead_message,
-                          HAP_TLV_TAGS.PUBLIC_KEY, public_key.serialize())
+                          HAP_TLV_TAGS.PUBLIC_KEY, public_key)
         self.send_response(200)
         self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
         self.end_response(data)
@@ -435,16 +639,18 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         @type tlv_object: dict
         """
         logger.debug("Pair verify [2/2]")
+        started = time.perf_counter()
         encrypted_data = tlv_objects[HAP_TLV_TAGS.ENCRYPTED_DATA]
-        cipher = CHACHA20_POLY1305(self.enc_context["pre_session_key"], "python")
-        decrypted_data = cipher.open(self.PVERIFY_2_NONCE, bytearray(encrypted_data), b"")
+        provider = hap_crypto.get_provider()
+        cipher = provider.aead(self.enc_context["pre_session_key"])
+        decrypted_data = cipher.open(self.PVERIFY_2_NONCE, encrypted_data, b"")
         assert decrypted_data is not None  # TODO:
 
-        dec_tlv_objects = tlv.decode(bytes(decrypted_data))
+        dec_tlv_objects = tlv.decode(decrypted_data)
         client_username = dec_tlv_objects[HAP_TLV_TAGS.USERNAME]
         material = self.enc_context["client_public"] \
             + client_username \
-            + self.enc_context["public_key"].serialize()
+            + self.enc_context["public_key"]
 
         client_uuid = uuid.UUID(str(client_username, "ascii"))
         perm_client_public = self.state.paired_clients.get(client_uuid)
@@ -457,10 +663,15 @@ class HAPServerHandler(BaseHTTPRequestHandler):
             self.end_response(data)
             return
 
-        verifying_key = ed25519.VerifyingKey(perm_client_public)
-        try:
-            verifying_key.verify(dec_tlv_objects[HAP_TLV_TAGS.PROOF], material)
-        except ed25519.BadSignatureError:
+        crypto_pool = self.accessory_handler.crypto_pool
+        if crypto_pool is None:
+            verified = provider.ed25519_verify(
+                perm_client_public, dec_tlv_objects[HAP_TLV_TAGS.PROOF], material)
+        else:
+            verified = crypto_pool.run(
+                hap_workers.ed25519_verify, provider.name, perm_client_public,
+                dec_tlv_objects[HAP_TLV_TAGS.PROOF], material)
+        if not verified:
             logger.error("Bad signature, abort.")
             self.send_response(200)
             self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
@@ -471,6 +682,15 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         logger.debug("Pair verify with client '%s' completed. Switching to "
                      "encrypted transport.", self.client_address)
 
+        shared_key = self.enc_context["shared_key"]
+        session_id = hap_hkdf(shared_key, self.PRESUME_SESSION_ID_SALT,
+                              self.PRESUME_SESSION_ID_INFO)
+        session_cache = self.accessory_handler.session_cache
+        session_cache.add(session_id[:hap_sessions.SESSION_ID_LENGTH], shared_key,
+                          client_uuid)
+        session_cache.record_full_verify(
+            self.enc_context["handshake_time"] + time.perf_counter() - started)
+
         data = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, b'\x04')
         self.send_response(200)
         self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
@@ -478,6 +698,68 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         self._upgrade_to_encrypted()
         del self.enc_context
 
+    def _pair_resume(self, tlv_objects):
+        """Resume a cached session, if the client proves it knows its secret.
+
+        The new session is derived from the cached secret. Its ID is sent to the
+        client, so it can be resumed again.
+
+        @param tlv_objects: The TLV data received from the client.
+        @type tlv_object: dict
+
+        @return: Whether the session was resumed. If not, nothing was sent and a full
+            pair verify should follow.
+        @rtype: bool
+        """
+        started = time.perf_counter()
+        session_cache = self.accessory_handler.session_cache
+        session_id = tlv_objects.get(HAP_TLV_TAGS.SESSION_ID)
+        session = session_cache.get(session_id)
+        if session is None or session[1] not in self.state.paired_clients:
+            logger.debug("Pair resume: no session to resume, falling back to verify.")
+            session_cache.record_resume(False)
+            return False
+        shared_key, client_uuid = session
+        client_public = tlv_objects[HAP_TLV_TAGS.PUBLIC_KEY]
+        provider = hap_crypto.get_provider()
+
+        request_key = hap_hkdf(shared_key, client_public + session_id,
+                               self.PRESUME_1_INFO)
+        if provider.aead(request_key).open(
+                self.PRESUME_1_NONCE,
+                tlv_objects.get(HAP_TLV_TAGS.ENCRYPTED_DATA, b""), b"") is None:
+            logger.debug("Pair resume: bad proof, falling back to verify.")
+            session_cache.record_resume(False)
+            return False
+        # Only now, so that a bad proof does not spoil the session of the client.
+        if session_cache.pop(session_id) is None:
+            logger.debug("Pair resume: session resumed already, falling back to "
+                         "verify.")
+            session_cache.record_resume(False)
+            return False
+
+        new_session_id = os.urandom(hap_sessions.SESSION_ID_LENGTH)
+        salt = client_public + new_session_id
+        response_key = hap_hkdf(shared_key, salt, self.PRESUME_2_INFO)
+        proof = provider.aead(response_key).seal(self.PRESUME_2_NONCE, b"", b"")
+        resumed_key = hap_hkdf(shared_key, salt, self.PRESUME_SHARED_SECRET_INFO)
+        session_cache.add(new_session_id, resumed_key, client_uuid)
+        session_cache.record_resume(True, time.perf_counter() - started)
+        logger.debug("Pair resume with client '%s' completed. Switching to "
+                     "encrypted transport.", self.client_address)
+
+        data = tlv.encode(HAP_TLV_TAGS.SEQUENCE_NUM, b'\x02',
+                          HAP_TLV_TAGS.REQUEST_TYPE, self.PAIR_RESUME_METHOD,
+                          HAP_TLV_TAGS.SESSION_ID, new_session_id,
+                          HAP_TLV_TAGS.ENCRYPTED_DATA, proof)
+        self.send_response(200)
+        self.send_header("Content-Type", self.PAIRING_RESPONSE_TYPE)
+        self.end_response(data)
+        self.enc_context = {"shared_key": resumed_key}
+        self._upgrade_to_encrypted()
+        del self.enc_context
+        return True
+
     def handle_accessories(self):
         """Handles a client request to get the accessories."""
         if not self.is_encrypted:
@@ -494,11 +776,17 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         if not self.is_encrypted:
             raise UnprivilegedRequestException
 
-        # Check that char exists and ...
-        params = parse_qs(urlparse(self.path).query)
-        chars = self.accessory_handler.get_characteristics(params["id"][0].split(","))
-
-        data = json.dumps(chars).encode("utf-8")
+        try:
+            char_ids = hap_http.parse_char_ids(self.query)
+        except ValueError:
+            logger.warning("Bad characteristics query from %s: %s",
+                           self.client_address, self.query)
+            response = {"status": HAP_SERVER_STATUS.INVALID_VALUE_IN_REQUEST}
+            self.send_response(HTTPStatus.BAD_REQUEST)
+            self.send_header("Content-Type", self.JSON_RESPONSE_TYPE)
+            self.end_response(json.dumps(response).encode("utf-8"))
+            return
+        data = self.accessory_handler.get_characteristics_json(char_ids)
         self.send_response(207)
         self.send_header("Content-Type", self.JSON_RESPONSE_TYPE)
         self.end_response(data)
@@ -511,7 +799,7 @@ class HAPServerHandler(BaseHTTPRequestHandler):
             self.send_response(HTTPStatus.UNAUTHORIZED)
             self.end_response(b'', close_connection=True)
 
-        data_len = int(self.headers['Content-Length'])
+        data_len = self.content_length
         requested_chars = json.loads(
             self.rfile.read(data_len).decode('utf-8'))
         logger.debug('Set characteristics content: %s', requested_chars)
@@ -532,7 +820,7 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         if not self.is_encrypted:
             raise UnprivilegedRequestException
 
-        data_len = int(self.headers["Content-Length"])
+        data_len = self.content_length
         tlv_objects = tlv.decode(self.rfile.read(data_len))
         request_type = tlv_objects[HAP_TLV_TAGS.REQUEST_TYPE][0]
         if request_type == 3:
@@ -576,7 +864,7 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         if not hasattr(self.accessory_handler.accessory, 'get_snapshot'):
             raise ValueError('Got a request for snapshot, but the Accessory '
                              'does not define a "get_snapshot" method')
-        data_len = int(self.headers['Content-Length'])
+        data_len = self.content_length
         image_size = json.loads(
                         self.rfile.read(data_len).decode('utf-8'))
         image = self.accessory_handler.accessory.get_snapshot(image_size)
@@ -585,6 +873,89 @@ class HAPServerHandler(BaseHTTPRequestHandler):
         self.end_response(image)
 
 
+class PooledHAPServerHandler(HAPServerHandler):
+    """A ``HAPServerHandler`` that handles one request at a time, when told so.
+
+    Used by a ``HAPServer`` with a worker pool: the handler, and with it the state of
+    the connection, lives as long as the connection, but no thread is dedicated to it.
+    """
+
+    REQUEST_TIMEOUT = 10  # seconds in which a started request must be received
+
+    def setup(self):
+        """Set up the file handles, with an ``rfile`` whose reads have a deadline."""
+        super(PooledHAPServerHandler, self).setup()
+        self.rfile.close()
+        self.rfile = self._make_rfile()
+
+    def _make_rfile(self):
+        """Return a buffered ``DeadlineSocketIO`` of the connection."""
+        return io.BufferedReader(DeadlineSocketIO(self.connection),
+                                 io.DEFAULT_BUFFER_SIZE)
+
+    def handle(self):
+        """Do nothing; the server calls ``handle_next`` when a request arrives."""
+        self.close_connection = False
+
+    def finish(self):
+        """Do nothing; the server calls ``close`` when the connection ends."""
+        pass
+
+    def handle_next(self):
+        """Handle the next request of the connection.
+
+        The connection is closed if the whole request is not received within
+        ``REQUEST_TIMEOUT``, however the client spreads it out, so that a client that
+        sends part of a request, or drips it a byte at a time, does not hold on to a
+        worker.
+
+        @return: Whether the connection should be kept open.
+        @rtype: bool
+        """
+        self._set_read_deadline(time.monotonic() + self.REQUEST_TIMEOUT)
+        try:
+            self.handle_one_request()
+        finally:
+            # The request may have upgraded the connection to a HAPSocket over the
+            # same file descriptor, whose timeout is left over from the reads.
+            self._set_read_deadline(None)
+            self.connection.settimeout(None)
+        return not self.close_connection
+
+    def _set_read_deadline(self, deadline):
+        """Set the time.monotonic() by which the reads of ``rfile`` must be done."""
+        self.rfile.raw.deadline = deadline
+        if self.is_encrypted:
+            # A HAPSocket reads until a whole block is received.
+            self.connection.read_deadline = deadline
+
+    def has_buffered_request(self):
+        """Whether more request data is already received, without blocking.
+
+        Such data may sit in ``rfile`` or in the ``HAPSocket`` decoder, where a
+        selector cannot see it.
+        """
+        sock = self.connection
+        # Events are pushed from other threads, only over encrypted connections.
+        with getattr(sock, "out_lock", None) or threading.Lock():
+            timeout = sock.gettimeout()
+            sock.settimeout(0)
+            try:
+                return bool(self.rfile.peek(1))
+            except (OSError, ValueError):
+                return False
+            finally:
+                sock.settimeout(timeout)
+
+    def close(self):
+        """End the pair setup in progress, if any, and close the file handles of the
+        connection."""
+        try:
+            super(PooledHAPServerHandler, self).finish()
+        except (OSError, ValueError):
+            pass
+
+
 class HAPSocket(socket.socket):
     """A socket implementing the HAP crypto. Just feed it as if it is a normal socket.
 
@@ -618,28 +989,29 @@ class HAPSocket(socket.socket):
         self._closed = False
 
         self.shared_key = shared_key
-        self.out_count = 0
-        self.in_count = 0
         self.out_cipher = None
         self.in_cipher = None
         self.out_lock = threading.RLock()  # for locking send operations
+        self.read_deadline = None  # time.monotonic() by which reads must be done
         # NOTE: Some future python implementation of HTTP Server or Server Handler can use
         # methods different than the ones we lock now (send, sendall).
         # This will break the encryption/decryption before introducing a race condition,
         # but don't forget locking these other methods after fixing the crypto.
 
         self._set_ciphers()
-        self.curr_in_total = None  # Length of the current incoming block
-        self.num_in_recv = None  # Number of bytes received from the incoming block
-        self.curr_in_block = None  # Bytes of the current incoming block
+        self.decoder = hap_crypto.HAPFrameDecoder(self.in_cipher)
+        self.encoder = hap_crypto.HAPFrameEncoder(self.out_cipher)
 
     def _set_ciphers(self):
         """Generate out/inbound encryption keys and initialise respective ciphers."""
-        outgoing_key = hap_hkdf(self.shared_key, self.CIPHER_SALT, self.OUT_CIPHER_INFO)
-        self.out_cipher = CHACHA20_POLY1305(outgoing_key, "python")
+        provider = hap_crypto.get_provider()
+        outgoing_key = provider.hkdf(self.shared_key, self.CIPHER_SALT,
+                                     self.OUT_CIPHER_INFO)
+        self.out_cipher = provider.aead(outgoing_key)
 
-        incoming_key = hap_hkdf(self.shared_key, self.CIPHER_SALT, self.IN_CIPHER_INFO)
-        self.in_cipher = CHACHA20_POLY1305(incoming_key, "python")
+        incoming_key = provider.hkdf(self.shared_key, self.CIPHER_SALT,
+                                     self.IN_CIPHER_INFO)
+        self.in_cipher = provider.aead(incoming_key)
 
     # socket.socket interface
 
@@ -650,67 +1022,37 @@ class HAPSocket(socket.socket):
                 return func(self, *args, **kwargs)
         return _wrapper
 
-    def recv_into(self, buffer, nbytes=1042, flags=0):
-        """Receive and decrypt up to nbytes in the given buffer."""
-        data = self.recv(nbytes, flags)
-        for i, b in enumerate(data):
-            buffer[i] = b
-        return len(data)
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        """Receive and decrypt up to nbytes in the given buffer.
+
+        Ciphertext is received in large chunks and every complete block in it is
+        decrypted straight into ``buffer``. Blocks that do not fit are kept for the
+        next call. Blocks until at least one byte of plaintext is available.
+        """
+        assert not flags
+        view = memoryview(buffer)
+        if nbytes:
+            view = view[:nbytes]
+        while True:
+            read = self.decoder.read_into(view)
+            if read or not view:
+                return read
+            if self.read_deadline is not None:
+                settimeout_by(self, self.read_deadline)
+            received = socket.socket.recv_into(self, self.decoder.get_buffer())
+            if not received:
+                return 0
+            self.decoder.buffer_updated(received)
 
     def recv(self, buflen=1042, flags=0):
-        """Receive up to buflen bytes.
-
-        The received full cipher blocks are decrypted and returned and partial cipher
-        blocks are buffered locally.
-        """
-        assert not flags and buflen > self.LENGTH_LENGTH
-
-        result = b""
-        # Read from the socket until the given amount of bytes is read.
-        while buflen > 1:
-            # If we are not processing a block already, we need to first get the
-            # length of the next block, which is the first two bytes before it.
-            if self.curr_in_block is None:
-                if buflen < self.LENGTH_LENGTH:
-                    # It may be that we already read some data and we have
-                    # 1 byte left, return whatever we have.
-                    return result
-                block_length_bytes = socket.socket.recv(self, self.LENGTH_LENGTH)
-                if not block_length_bytes:
-                    return result
-                # TODO: handle this
-                assert len(block_length_bytes) == self.LENGTH_LENGTH
-                # Init. info about the block we just started.
-                # Note we are setting the total length to block_length + mac length
-                self.curr_in_total = \
-                    struct.unpack("H", block_length_bytes)[0] + self.in_cipher.tagLength
-                self.num_in_recv = 0
-                self.curr_in_block = b""
-                buflen -= self.LENGTH_LENGTH
-            else:
-                # Read as much from the current block as possible.
-                part = socket.socket.recv(self,
-                                          min(buflen,
-                                              self.curr_in_total - self.num_in_recv))
-                # Check what is actually received
-                actual_len = len(part)
-                self.curr_in_block += part
-                buflen -= actual_len
-                self.num_in_recv += actual_len
-                if self.num_in_recv == self.curr_in_total:
-                    # We read a whole block. Decrypt it and append it to the result.
-                    nonce = _pad_tls_nonce(struct.pack("Q", self.in_count))
-                    # Note we are removing the mac length from the total length
-                    block_length = self.curr_in_total - self.in_cipher.tagLength
-                    plaintext = self.in_cipher.open(
-                        nonce, bytearray(self.curr_in_block),
-                        struct.pack("H", block_length))
-                    result += plaintext
-                    self.in_count += 1
-                    self.curr_in_block = None
-                    break
-
-        return result
+        """Receive and decrypt up to buflen bytes.
+
+        .. seealso:: HAPSocket.recv_into
+        """
+        buffer = bytearray(buflen)
+        read = self.recv_into(buffer, buflen, flags)
+        del buffer[read:]
+        return bytes(buffer)
 
     @_with_out_lock
     def send(self, data, flags=0):
@@ -724,21 +1066,128 @@ class HAPSocket(socket.socket):
     def sendall(self, data, flags=0):
         """Encrypt and send the given data."""
         assert not flags
-        result = b""
-        offset = 0
-        total = len(data)
-        while offset < total:
-            length = min(total - offset, self.MAX_BLOCK_LENGTH)
-            length_bytes = struct.pack("H", length)
-            block = bytearray(data[offset: offset + length])
-            nonce = _pad_tls_nonce(struct.pack("Q", self.out_count))
-            ciphertext = length_bytes \
-                + self.out_cipher.seal(nonce, block, length_bytes)
-            offset += length
-            self.out_count += 1
-            result += ciphertext
-        socket.socket.sendall(self, result)
-        return total
+        self.send_buffers((data,))
+        return len(data)
+
+    @_with_out_lock
+    def send_buffers(self, buffers, timeout=None):
+        """Encrypt the concatenation of the given buffers and send it in one call.
+
+        @param timeout: Seconds in which the data must be sent, see ``send_within``.
+        @type timeout: float
+        """
+        data = self.encoder.encrypt(buffers)
+        if timeout is None:
+            socket.socket.sendall(self, data)
+        else:
+            send_within(self, data, timeout)
+
+
+class DeadlineSocketIO(socket.SocketIO):
+    """A raw reader of a socket, whose reads must all be done by a deadline.
+
+    A socket timeout bounds each read on its own, thus a client that sends a request
+    a byte at a time could take as long as it likes to send it.
+    """
+
+    def __init__(self, sock):
+        super(DeadlineSocketIO, self).__init__(sock, "rb")
+        self.deadline = None  # time.monotonic() by which reads must be done, if any
+
+    def readinto(self, b):
+        """Read into the given buffer, within the time left until the deadline.
+
+        :raise socket.timeout: If the deadline passes.
+        """
+        if self.deadline is not None:
+            settimeout_by(self._sock, self.deadline)
+        return super(DeadlineSocketIO, self).readinto(b)
+
+
+def settimeout_by(sock, deadline):
+    """Set the timeout of the socket to the time left until the given deadline.
+
+    :param deadline: A time.monotonic().
+    :type deadline: float
+
+    :raise socket.timeout: If the deadline has passed.
+    """
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("timed out")
+    socket.socket.settimeout(sock, remaining)
+
+
+def send_within(sock, data, timeout):
+    """Send all of the data over the blocking socket within the given time.
+
+    Unlike ``settimeout``, this does not affect a thread that is reading from the
+    socket at the same time. If it times out, part of the data may have been sent,
+    so the connection should be closed.
+
+    :param timeout: Seconds in which the data must be sent.
+    :type timeout: float
+
+    :raise socket.timeout: If the data could not be sent in time.
+    """
+    if not hasattr(socket, "MSG_DONTWAIT"):  # e.g. Windows, no deadline
+        socket.socket.sendall(sock, data)
+        return
+    deadline = time.monotonic() + timeout
+    view = memoryview(data).cast("B")
+    selector = None
+    try:
+        while view:
+            try:
+                view = view[socket.socket.send(sock, view, socket.MSG_DONTWAIT):]
+                continue
+            except BlockingIOError:
+                pass
+            if selector is None:
+                selector = selectors.DefaultSelector()
+                selector.register(sock, selectors.EVENT_WRITE)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                raise socket.timeout("Could not send within {}s".format(timeout))
+    finally:
+        if selector is not None:
+            selector.close()
+
+
+def send_buffers(sock, buffers, timeout=None):
+    """Send the given buffers over the socket, as if they were concatenated.
+
+    Plain sockets use scatter/gather I/O (``sendmsg``) where available, so that the
+    buffers are neither joined nor sent with separate system calls.
+
+    :param sock: The socket to send over.
+    :type sock: socket.socket or HAPSocket
+
+    :param buffers: Bytes-like objects to send.
+    :type buffers: list
+
+    :param timeout: If given, seconds in which the buffers must be sent, see
+        ``send_within``.
+    :type timeout: float
+    """
+    if isinstance(sock, HAPSocket):
+        sock.send_buffers(buffers, timeout)
+        return
+    if timeout is not None:
+        send_within(sock, b"".join(buffers), timeout)
+        return
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(buffer).cast("B") for buffer in buffers if buffer]
+    first = 0
+    while first < len(views):
+        sent = sock.sendmsg(views[first:first + SENDMSG_MAX_BUFFERS])
+        while sent and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
 
 
 class HAPServer(socketserver.ThreadingMixIn,
@@ -770,18 +1219,78 @@ class HAPServer(socketserver.ThreadingMixIn,
         @param data: Payload of the request.
         @type data: bytes
         """
-        return cls.EVENT_MSG_STUB \
-            + str(len(bytesdata)).encode("utf-8") \
-            + b"\r\n" * 2 \
-            + bytesdata
+        return b"".join(cls.create_hap_event_buffers(bytesdata))
+
+    @classmethod
+    def create_hap_event_buffers(cls, bytesdata):
+        """Like ``create_hap_event``, but return the header and payload separately.
+
+        @param data: Payload of the request.
+        @type data: bytes
+        """
+        return (cls.EVENT_MSG_STUB + b"%d\r\n\r\n" % len(bytesdata), bytesdata)
+
+    ACCEPT_QUEUE_SIZE = 32  # default accept_queue_size of the worker pool
+    POLL_INTERVAL = 0.5  # seconds, how often the selector thread checks for shutdown
 
     def __init__(self,
                  addr_port,
                  accessory_handler,
-                 handler_type=HAPServerHandler):
+                 handler_type=None,
+                 max_workers=None,
+                 accept_queue_size=None,
+                 max_connections=None,
+                 idle_timeout=None,
+                 slow_consumer=None):
+        """
+        @param max_workers: If given, serve all connections with this many worker
+            threads instead of a thread per connection. Connections waiting for a
+            request are watched by a selector and ready ones are serviced one request
+            at a time, in the order they became ready.
+        @type max_workers: int
+
+        @param accept_queue_size: With ``max_workers``, the number of accepted
+            connections that may wait for a worker. Further connections are closed
+            right away. Also used as the listen backlog. Defaults to
+            ``ACCEPT_QUEUE_SIZE``.
+        @type accept_queue_size: int
+
+        @param max_connections: How many connections may be open at the same time.
+            Further connections are closed right away.
+        @type max_connections: int
+
+        @param idle_timeout: Seconds without requests or events after which a
+            connection is closed.
+        @type idle_timeout: float
+
+        @param slow_consumer: Limits the events queued for each client and the time to
+            send them. Defaults to a ``SlowConsumerPolicy``.
+        @type slow_consumer: hap_connections.SlowConsumerPolicy
+        """
+        if handler_type is None:
+            handler_type = PooledHAPServerHandler if max_workers else HAPServerHandler
+        self.max_workers = max_workers
+        if max_workers:
+            self.request_queue_size = accept_queue_size or self.ACCEPT_QUEUE_SIZE
+        self.accept_queue_size = self.request_queue_size
         super(HAPServer, self).__init__(addr_port, handler_type)
-        self.connections = {}  # (address, port): socket
+        # (address, port): socket
+        self.connections = hap_connections.ConnectionRegistry(
+            max_connections, idle_timeout,
+            on_remove=accessory_handler.unsubscribe_client)
         self.accessory_handler = accessory_handler
+        self.slow_consumer = slow_consumer or hap_connections.SlowConsumerPolicy()
+
+        # Worker pool state, see max_workers
+        self.workers = []
+        self.ready = queue.Queue()  # callables for the workers, None stops a worker
+        self.accepting = 0  # accepted connections not yet picked up by a worker
+        self.pool_lock = threading.Lock()  # for accepting and to_register
+        self.to_register = []  # handlers to watch again
+        self.selector = None
+        self.selector_thread = None
+        self.wakeup_r, self.wakeup_w = None, None
+        self.pool_shutdown = threading.Event()
 
     def _close_socket(self, sock):
         """Shutdown and close the given socket."""
@@ -801,39 +1310,213 @@ class HAPServer(socketserver.ThreadingMixIn,
         # NOTE: In python <3.3 socket.timeout is not OSError, hence the above.
         # Also, when it is actually an OSError, it MAY not have an errno equal to
         # ETIMEDOUT.
-        sock = self.connections.pop(client_addr, None)
-        if sock is not None:
-            self._close_socket(sock)
+        self._remove_connection(client_addr)
         if not isinstance(exception, socket.timeout) \
                 and exception.errno not in self.TIMEOUT_ERRNO_CODES:
             raise exception
 
+    def _remove_connection(self, client_addr):
+        """Unregister and close the connection of the given client, if any."""
+        sock = self.connections.remove(client_addr)
+        if sock is not None:
+            self._close_socket(sock)
+
     def get_request(self):
-        """Calls the super's method, caches the connection and returns."""
+        """Calls the super's method, logs the connection and returns."""
         client_socket, client_addr = super(HAPServer, self).get_request()
         logger.info("Got connection with %s.", client_addr)
-        self.connections[client_addr] = client_socket
         return (client_socket, client_addr)
 
+    def verify_request(self, request, client_address):
+        """Register the new connection, unless there are too many already."""
+        if not self.connections.add(client_address, request):
+            return False
+        hap_connections.set_keepalive(request)
+        return True
+
     def finish_request(self, sock, client_addr):
         try:
-            self.RequestHandlerClass(sock, client_addr, self, self.accessory_handler)
+            handler = self.RequestHandlerClass(sock, client_addr, self,
+                                               self.accessory_handler)
         except (OSError, socket.timeout) as e:
             self._handle_sock_timeout(client_addr, e)
             logger.debug("Connection timeout")
+            return None
+        if not self.max_workers:
+            # The connection was handled until it closed.
+            self._remove_connection(client_addr)
+        return handler
+
+    def service_actions(self):
+        """Close the idle connections. Called by serve_forever every poll interval.
+
+        The sockets are only shut down; the threads serving them see the connection
+        end, then remove and close it.
+        """
+        for _, sock in self.connections.reap_idle():
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def serve_forever(self, poll_interval=0.5):
+        """Start the worker pool, if any, and handle connections until shutdown."""
+        if self.max_workers:
+            self._start_pool()
+        super(HAPServer, self).serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        """Hand the new connection to the worker pool, if any, else start a thread."""
+        if not self.max_workers:
+            super(HAPServer, self).process_request(request, client_address)
+            return
+        with self.pool_lock:
+            if self.accepting >= self.accept_queue_size:
+                logger.warning("Rejecting connection with %s: accept queue is full.",
+                               client_address)
+                self.connections.remove(client_address)
+                self.shutdown_request(request)
+                return
+            self.accepting += 1
+        self.ready.put(functools.partial(self._open_connection, request, client_address))
+
+    def _start_pool(self):
+        """Start the selector thread and the worker threads."""
+        self.pool_shutdown.clear()
+        self.selector = selectors.DefaultSelector()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        self.selector_thread = threading.Thread(target=self._select_ready,
+                                                name="HAPServerSelector")
+        self.selector_thread.start()
+        self.workers = [threading.Thread(target=self._work,
+                                         name="HAPServerWorker-{}".format(i))
+                        for i in range(self.max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _stop_pool(self):
+        """Stop the pool threads and close the connections they serve."""
+        if self.selector_thread is None:
+            return
+        self.pool_shutdown.set()
+        self._wakeup()
+        self.selector_thread.join()
+        for _ in self.workers:
+            self.ready.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.selector_thread = None
+        handlers = [key.data for key in self.selector.get_map().values()
+                    if key.data is not None]
+        self.selector.close()
+        for handler in handlers + self.to_register:
+            self._close_connection(handler)
+        self.to_register = []
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+    def _wakeup(self):
+        """Interrupt the selector thread."""
+        try:
+            self.wakeup_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _select_ready(self):
+        """Watch the idle connections and queue the ready ones for the workers.
+
+        A connection is unregistered while it is queued or serviced, thus at most one
+        worker handles a connection at any time and its requests stay in order.
+        """
+        while not self.pool_shutdown.is_set():
+            with self.pool_lock:
+                to_register, self.to_register = self.to_register, []
+            for handler in to_register:
+                self.selector.register(handler.connection, selectors.EVENT_READ,
+                                       handler)
+            for key, _ in self.selector.select(self.POLL_INTERVAL):
+                if key.data is None:
+                    try:
+                        while self.wakeup_r.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                self.ready.put(functools.partial(self._service, key.data))
+
+    def _watch(self, handler):
+        """Let the selector thread watch the connection for the next request."""
+        with self.pool_lock:
+            self.to_register.append(handler)
+        self._wakeup()
+
+    def _work(self):
+        """Run the queued tasks until told to stop."""
+        while True:
+            task = self.ready.get()
+            if task is None:
+                return
+            try:
+                task()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Error in HAP server worker.")
+
+    def _open_connection(self, sock, client_addr):
+        """Create the handler of a new connection and watch it for requests."""
+        with self.pool_lock:
+            self.accepting -= 1
+        handler = self.finish_request(sock, client_addr)
+        if handler is None:
+            self.shutdown_request(sock)
+        elif self.pool_shutdown.is_set():
+            self._close_connection(handler)
+        else:
+            self._watch(handler)
+
+    def _service(self, handler):
+        """Handle one request of the connection, then requeue or watch it again.
+
+        A connection with more requests already received goes to the back of the
+        queue, so that all ready connections are serviced in turn.
+        """
+        try:
+            keep_open = handler.handle_next()
+        except (OSError, socket.timeout) as e:
+            logger.debug("Connection with %s failed: %s", handler.client_address, e)
+            keep_open = False
+        if not keep_open or self.pool_shutdown.is_set():
+            self._close_connection(handler)
+        elif handler.has_buffered_request():
+            self.ready.put(functools.partial(self._service, handler))
+        else:
+            self._watch(handler)
+
+    def _close_connection(self, handler):
+        """Close the connection of the given handler."""
+        handler.close()
+        sock = self.connections.remove(handler.client_address) or handler.connection
+        self._close_socket(sock)
+        logger.debug("Closed connection with %s.", handler.client_address)
 
     def server_close(self):
         """Close all connections."""
         logger.info("Stopping HAP server")
         super(HAPServer, self).server_close()
-        for sock in self.connections.values():
+        self._stop_pool()
+        for sock in self.connections.clear():
             self._close_socket(sock)
-        self.connections.clear()
 
-    def push_event(self, bytesdata, client_addr):
-        """Send an event to the current connection with the provided data.
+    def push_event(self, bytesdata, client_addr, on_written=None):
+        """Queue an event for the given client, to be sent by its ``EventWriter``.
 
-        .. note: Sets a timeout of PUSH_EVENT_TIMEOUT for the duration of socket.sendall.
+        Each connection has its own writer, thus a client that does not read its events
+        does not delay the events of the others. The writer sends from its own thread,
+        or with ``max_workers`` from the worker pool. A client whose backlog or send
+        exceeds the limits of ``slow_consumer`` is disconnected.
 
         :param bytesdata: The data to send.
         :type bytesdata: bytes
@@ -841,19 +1524,56 @@ class HAPServer(socketserver.ThreadingMixIn,
         :param client_addr: A client (address, port) tuple to which to send the data.
         :type client_addr: tuple <str, int>
 
-        :return: True if sending was successful, False otherwise.
+        :param on_written: If the event is queued, called from the sending thread with
+            whether it was sent.
+        :type on_written: callable
+
+        :return: False if the client is not connected, or is disconnected as a slow
+            consumer, True otherwise.
         :rtype: bool
         """
-        client_socket = self.connections.get(client_addr)
-        if client_socket is None:
+        writer = self.connections.attach(
+            client_addr, functools.partial(self._create_event_writer, client_addr))
+        if writer is None:
             return False
-        data = self.create_hap_event(bytesdata)
-        try:
-            client_socket.sendall(data)
+        if writer.put(bytesdata, on_written):
             return True
-        except (OSError, socket.timeout) as e:
-            self._handle_sock_timeout(client_addr, e)
-            return False
+        if not writer.closed:
+            self.slow_consumer.evict(client_addr)
+            self._remove_connection(client_addr)
+        return False
+
+    def _create_event_writer(self, client_addr):
+        return hap_connections.EventWriter(
+            client_addr, functools.partial(self._send_events, client_addr),
+            functools.partial(self._event_failed, client_addr), self.slow_consumer,
+            self.ready.put if self.max_workers else None)
+
+    def _send_events(self, client_addr, events):
+        """Send the given event payloads to the current socket of the given client."""
+        client_socket = self.connections.get(client_addr)
+        if client_socket is None:
+            raise ConnectionError("Not connected")
+        buffers = []
+        for bytesdata in events:
+            buffers.extend(self.create_hap_event_buffers(bytesdata))
+        send_buffers(client_socket, buffers, self.slow_consumer.send_timeout)
+        self.connections.touch(client_addr)
+
+    def _event_failed(self, client_addr, exception):
+        if isinstance(exception, socket.timeout):
+            self.slow_consumer.evict(client_addr, timed_out=True)
+        else:
+            logger.debug("Could not send event to %s: %s", client_addr, exception)
+        self._remove_connection(client_addr)
+
+    def event_queue_depths(self):
+        """Return the number of events queued for each client.
+
+        :rtype: dict <tuple <str, int>, int>
+        """
+        return {client_addr: len(writer)
+                for client_addr, writer in self.connections.attachments().items()}
 
     def upgrade_to_encrypted(self, client_address, shared_key):
         """Replace the socket for the given client with HAPSocket.
@@ -866,5 +1586,5 @@ class HAPServer(socketserver.ThreadingMixIn,
         """
         client_socket = self.connections[client_address]
         hap_socket = HAPSocket(client_socket, shared_key)
-        self.connections[client_address] = hap_socket
+        self.connections.replace(client_address, hap_socket, encrypted=True)
         return hap_socket
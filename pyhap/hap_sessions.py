@@ -0,0 +1,148 @@
+"""Caches pair verify sessions, so that controllers can resume them.
+
+A full pair verify needs a new X25519 key pair and exchange, an Ed25519 signature and
+verification and several HKDFs. After one, the session's shared secret is cached under
+a session ID. A controller that reconnects can then use pair resume, which proves
+knowledge of the cached secret and derives a new one with only a few HKDFs.
+"""
+import collections
+import threading
+import time
+
+DEFAULT_MAX_SESSIONS = 32
+DEFAULT_SESSION_TTL = 24 * 3600  # seconds
+
+SESSION_ID_LENGTH = 8  # bytes
+
+
+class SessionCache:
+    """A least-recently-used cache of resumable sessions, with expiry, thread-safe.
+
+    Each session can be resumed once; resuming it creates a new session.
+    """
+
+    def __init__(self, max_sessions=DEFAULT_MAX_SESSIONS, ttl=DEFAULT_SESSION_TTL):
+        """
+        :param max_sessions: How many sessions to keep. The least recently used ones
+            are dropped first.
+        :type max_sessions: int
+
+        :param ttl: Seconds after which a session can no longer be resumed.
+        :type ttl: float
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = collections.OrderedDict()  # id: (shared secret, client, expiry)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.full_verifies = 0
+        self.full_verify_time = 0.0  # seconds, total
+        self.resume_time = 0.0  # seconds, total of the hits
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def add(self, session_id, shared_secret, client_uuid):
+        """Cache a session that the given client may resume.
+
+        :param session_id: The ID of the session.
+        :type session_id: bytes
+
+        :param shared_secret: The secret from which the resumed session is derived.
+        :type shared_secret: bytes
+
+        :param client_uuid: The paired client of the session.
+        :type client_uuid: uuid.UUID
+        """
+        with self.lock:
+            self.sessions.pop(session_id, None)
+            self.sessions[session_id] = (shared_secret, client_uuid,
+                                         time.monotonic() + self.ttl)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def get(self, session_id):
+        """Return the session with the given ID, if it did not expire.
+
+        The session stays in the cache, e.g. until the client proved that it may
+        resume it.
+
+        :return: The shared secret and client uuid of the session, None if there is no
+            such session.
+        :rtype: tuple <bytes, uuid.UUID>
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is None or session[2] < time.monotonic():
+            return None
+        return session[:2]
+
+    def pop(self, session_id):
+        """Take the session with the given ID out of the cache, if it did not expire.
+
+        :return: The shared secret and client uuid of the session, None if there is no
+            such session.
+        :rtype: tuple <bytes, uuid.UUID>
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None or session[2] < time.monotonic():
+            return None
+        return session[:2]
+
+    def remove_client(self, client_uuid):
+        """Drop all sessions of the given client, e.g. when it is unpaired."""
+        with self.lock:
+            for session_id, session in list(self.sessions.items()):
+                if session[1] == client_uuid:
+                    del self.sessions[session_id]
+
+    def clear(self):
+        """Drop all sessions."""
+        with self.lock:
+            self.sessions.clear()
+
+    def record_full_verify(self, duration):
+        """Record a full pair verify, that took the given seconds to handle."""
+        with self.lock:
+            self.full_verifies += 1
+            self.full_verify_time += duration
+
+    def record_resume(self, resumed, duration=0.0):
+        """Record a pair resume attempt.
+
+        :param resumed: Whether the session was resumed, or a full pair verify is
+            needed.
+        :type resumed: bool
+
+        :param duration: How many seconds a resume took to handle.
+        :type duration: float
+        """
+        with self.lock:
+            if resumed:
+                self.hits += 1
+                self.resume_time += duration
+            else:
+                self.misses += 1
+
+    def stats(self):
+        """Return the resume hit rate and the handshake time it saved.
+
+        The time saved is estimated from the average time of full pair verifies.
+
+        :rtype: dict
+        """
+        with self.lock:
+            attempts = self.hits + self.misses
+            saved = 0.0
+            if self.full_verifies:
+                average_full = self.full_verify_time / self.full_verifies
+                saved = max(0.0, self.hits * average_full - self.resume_time)
+            return {
+                "sessions": len(self.sessions),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / attempts if attempts else 0.0,
+                "time_saved": saved,
+            }
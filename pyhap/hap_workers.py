@@ -0,0 +1,102 @@
+"""Runs the CPU-heavy handshake crypto in worker processes, outside of the GIL.
+
+The big-integer math of SRP and, with the pure-python backend, the X25519 exchange and
+the Ed25519 verification of pair verify hold the GIL. While a handshake is computed,
+the event loop and the other handler threads stall. With a ``CryptoProcessPool``, the
+handler thread only waits for the derived keys, and the others keep serving requests.
+
+The functions below are run in the worker processes. They take and return only
+picklable values: bytes, ints and the SRP verifier. Only ephemeral secrets are sent to
+the workers; the long term key of the accessory stays in the main process, which signs
+with it.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap.hsrp import Server as SrpServer
+from pyhap.params import HAP_SRP_PARAMS, get_srp_context
+
+logger = logging.getLogger(__name__)
+
+
+def create_srp_verifier(pincode):
+    """Create an SRP verifier for pair setup with the given pincode.
+
+    Computes a new salt, the verifier, k and an ephemeral (b, B) pair.
+
+    :rtype: pyhap.hsrp.Server
+    """
+    ctx = get_srp_context(*HAP_SRP_PARAMS)
+    return SrpServer(ctx, b'Pair-Setup', pincode)
+
+
+def srp_premaster_secret(verifier, bytes_A):
+    """Return the SRP premaster secret S, for ``verifier.set_A``.
+
+    :raise ValueError: If A is invalid.
+    """
+    verifier.set_A(bytes_A)
+    return verifier.S
+
+
+def pair_verify_exchange(provider_name, client_public):
+    """Compute the ephemeral keys of the accessory for pair verify step one.
+
+    :param provider_name: The name of the crypto provider to use.
+    :type provider_name: str
+
+    :param client_public: The controller's ephemeral X25519 public key.
+    :type client_public: bytes
+
+    :return: The ephemeral X25519 public key of the accessory and the shared secret.
+    :rtype: tuple <bytes, bytes>
+    """
+    provider = hap_crypto.PROVIDERS[provider_name]
+    private_key, public_key = provider.x25519_generate()
+    return public_key, provider.x25519_exchange(private_key, client_public)
+
+
+def ed25519_verify(provider_name, public_key, signature, data):
+    """Check the signature with the given crypto provider.
+
+    :rtype: bool
+    """
+    return hap_crypto.PROVIDERS[provider_name].ed25519_verify(public_key, signature,
+                                                              data)
+
+
+def _ready():
+    return True
+
+
+class CryptoProcessPool:
+    """A pool of worker processes for the handshake crypto."""
+
+    def __init__(self, processes):
+        """Create the pool and start its processes.
+
+        Create it before starting any thread, as the processes may be forked.
+
+        :param processes: How many worker processes to use.
+        :type processes: int
+        """
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        for _ in range(processes):
+            self.executor.submit(_ready)
+
+    def submit(self, func, *args):
+        """Run ``func(*args)`` in a worker process.
+
+        :rtype: concurrent.futures.Future
+        """
+        return self.executor.submit(func, *args)
+
+    def run(self, func, *args):
+        """Run ``func(*args)`` in a worker process and return its result."""
+        return self.executor.submit(func, *args).result()
+
+    def shutdown(self):
+        """Stop the worker processes."""
+        self.executor.shutdown()
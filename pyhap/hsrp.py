@@ -2,8 +2,20 @@
 # I remember there was a problem with an srp module that I used
 # as a guideline.
 # TODO: make it a complete implementation.
+#
+# The constants of a group (k and H(N) xor H(g)) are computed once, when its context
+# is created (see pyhap.params.get_srp_context). Modular exponentiation uses gmpy2 if
+# it is installed (``pip install HAP-python[FastSRP]``), the builtin pow otherwise.
 import os
 
+from pyhap.util import long_to_bytes
+
+try:
+    import gmpy2
+    SUPPORT_GMPY2 = True
+except ImportError:
+    SUPPORT_GMPY2 = False
+
 #
 # s - bytes
 # x - int
@@ -14,15 +26,16 @@ import os
 # p - bytes
 
 
-def padN(bytestr, ctx):
-    return bytestr.rjust(ctx["N_len"] // 8, b'\x00')
+if SUPPORT_GMPY2:
+    def modpow(base, exp, mod):
+        """Return base ** exp % mod, computed with GMP."""
+        return int(gmpy2.powmod(base, exp, mod))
+else:
+    modpow = pow
 
 
-def _bytes_to_long(s):
-    n = ord(s[0])
-    for b in (ord(x) for x in s[1:]):
-        n = (n << 8) | b
-    return n
+def padN(bytestr, ctx):
+    return bytestr.rjust(ctx["N_len"] // 8, b'\x00')
 
 
 def bytes_to_long(s):
@@ -30,43 +43,45 @@ def bytes_to_long(s):
     return int.from_bytes(s, byteorder="big")
 
 
-def long_to_bytes(n):
-    byteList = list()
-    x = 0
-    off = 0
-    while x != n:
-        b = (n >> off) & 0xFF
-        byteList.append(b)
-        x = x | (b << off)
-        off += 8
-    byteList.reverse()
-    return bytes(byteList)
+def _hash(ctx, data):
+    """Return the digest of data with the hash function of the context."""
+    return ctx["hashfunc"](data).digest()
+
+
+def _hash_to_long(ctx, data):
+    return bytes_to_long(_hash(ctx, data))
 
 
 def get_x(u, p, s, ctx):
-    hf = ctx["hashfunc"]()
-    hf.update(u + b":" + p)
-    up = hf.digest()
-    hf = ctx["hashfunc"]()
-    hf.update(s + up)
-    return int(hf.hexdigest(), 16)
+    return _hash_to_long(ctx, s + _hash(ctx, u + b":" + p))
 
 
 def get_verifier(u, p, s, ctx):
     x = get_x(u, p, s, ctx)
-    return pow(ctx['g'], x, ctx['N'])
+    return modpow(ctx['g'], x, ctx['N'])
 
 
 def get_k(ctx):
-    hf = ctx["hashfunc"]()
-    hf.update(long_to_bytes(ctx["N"]) + padN(long_to_bytes(ctx["g"]), ctx))
-    return int(hf.hexdigest(), 16)
+    """Return k = H(N | PAD(g)), cached in the context if created by get_srp_context."""
+    k = ctx.get("k")
+    if k is None:
+        k = _hash_to_long(ctx, long_to_bytes(ctx["N"]) +
+                          padN(long_to_bytes(ctx["g"]), ctx))
+    return k
+
+
+def get_group_hash(ctx):
+    """Return H(N) xor H(g), cached in the context if created by get_srp_context."""
+    group_hash = ctx.get("group_hash")
+    if group_hash is None:
+        hN = _hash(ctx, long_to_bytes(ctx['N']))
+        hG = _hash(ctx, long_to_bytes(ctx['g']))
+        group_hash = bytes(a ^ b for a, b in zip(hN, hG))
+    return group_hash
 
 
 def get_session_key(S, ctx):
-    hf = ctx['hashfunc']()
-    hf.update(long_to_bytes(S))
-    return int(hf.hexdigest(), 16)
+    return _hash_to_long(ctx, long_to_bytes(S))
 
 
 class Server(object):
@@ -80,14 +95,19 @@ class Server(object):
         self.k = get_k(ctx)
         self.b = bytes_to_long(os.urandom(256))  # TODO: specify length
         self.B = self.derive_B()
+        self.HAMK = None  # set once the client proof is verified
 
     def derive_B(self):
-        return (self.k * self.v + pow(self.ctx["g"], self.b, self.ctx["N"])) \
+        return (self.k * self.v + modpow(self.ctx["g"], self.b, self.ctx["N"])) \
             % self.ctx["N"]
 
-    def set_A(self, bytes_A):
+    def set_A(self, bytes_A, premaster_secret=None):
+        # premaster_secret may be derived elsewhere, e.g. in a worker process.
         self.A = int.from_bytes(bytes_A, byteorder="big")
-        self.S = self.derive_premaster_secret()
+        if self.A % self.ctx["N"] == 0:
+            raise ValueError("Invalid SRP public key A")
+        self.S = self.derive_premaster_secret() if premaster_secret is None \
+            else premaster_secret
         self.K = get_session_key(self.S, self.ctx)
         self.M = self.get_M()
 
@@ -95,28 +115,16 @@ class Server(object):
         return (self.s, self.B)
 
     def derive_premaster_secret(self):
-        hf = self.ctx['hashfunc']()
-        hf.update(padN(long_to_bytes(self.A), self.ctx) +
-                  padN(long_to_bytes(self.B), self.ctx))
-        U = int(hf.hexdigest(), 16)
-        Avu = self.A * pow(self.v, U, self.ctx["N"])
-        return pow(Avu, self.b, self.ctx["N"])
+        U = _hash_to_long(self.ctx, padN(long_to_bytes(self.A), self.ctx) +
+                          padN(long_to_bytes(self.B), self.ctx))
+        Avu = self.A * modpow(self.v, U, self.ctx["N"])
+        return modpow(Avu, self.b, self.ctx["N"])
 
     def get_M(self):
-        hf = self.ctx['hashfunc']()
-        hf.update(long_to_bytes(self.ctx['N']))
-        hN = hf.digest()
-        hf = self.ctx['hashfunc']()
-        hf.update(long_to_bytes(self.ctx['g']))
-        hG = hf.digest()
-        hGroup = bytes(hN[i] ^ hG[i] for i in range(0, len(hN)))
-        hf = self.ctx['hashfunc']()
-        hf.update(self.u)
-        hU = hf.digest()
-        hf = self.ctx['hashfunc']()
-        hf.update(hGroup + hU + self.s + long_to_bytes(self.A) +
-                  long_to_bytes(self.B) + long_to_bytes(self.K))
-        return hf.digest()
+        hU = _hash(self.ctx, self.u)
+        return _hash(self.ctx, get_group_hash(self.ctx) + hU + self.s +
+                     long_to_bytes(self.A) + long_to_bytes(self.B) +
+                     long_to_bytes(self.K))
 
     def verify(self, M):
         if self.M != M:
@@ -125,9 +133,7 @@ class Server(object):
         return self.HAMK
 
     def get_HAMK(self):
-        hf = self.ctx['hashfunc']()
-        hf.update(long_to_bytes(self.A) + self.M + long_to_bytes(self.K))
-        return hf.digest()
+        return _hash(self.ctx, long_to_bytes(self.A) + self.M + long_to_bytes(self.K))
 
     def get_session_key(self):
         return self.K
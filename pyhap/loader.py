@@ -10,8 +10,9 @@ json file).
 import json
 import logging
 
-from pyhap import CHARACTERISTICS_FILE, SERVICES_FILE
-from pyhap.characteristic import Characteristic
+from pyhap import CHARACTERISTICS_FILE, EVENT_PRIORITIES_FILE, SERVICES_FILE
+from pyhap.characteristic import (
+    EVENT_PRIORITIES, PROP_PRIORITY, PROP_STATELESS, Characteristic)
 from pyhap.service import Service
 
 _loader = None
@@ -23,13 +24,34 @@ class Loader:
 
     .. seealso:: pyhap/resources/services.json
     .. seealso:: pyhap/resources/characteristics.json
+    .. seealso:: pyhap/resources/event_priorities.json
     """
 
     def __init__(self, path_char=CHARACTERISTICS_FILE,
-                 path_service=SERVICES_FILE):
+                 path_service=SERVICES_FILE,
+                 path_priorities=EVENT_PRIORITIES_FILE):
         """Initialize a new Loader instance."""
         self.char_types = self._read_file(path_char)
         self.serv_types = self._read_file(path_service)
+        self.char_priorities, self.serv_priorities, self.stateless_chars = \
+            self._read_priorities(path_priorities)
+
+    @classmethod
+    def _read_priorities(cls, path):
+        """Read the event priorities of the characteristic and service types, and the
+        stateless characteristic types.
+
+        :return: The priority by characteristic name and by service name, and the
+            names of the stateless characteristics.
+        :rtype: tuple <dict, dict, frozenset>
+        """
+        priorities = cls._read_file(path)
+        char_priorities, serv_priorities = (
+            {name: EVENT_PRIORITIES[priority]
+             for name, priority in priorities.get(key, {}).items()}
+            for key in ('Characteristics', 'Services'))
+        return (char_priorities, serv_priorities,
+                frozenset(priorities.get('Stateless', ())))
 
     @staticmethod
     def _read_file(path):
@@ -44,6 +66,10 @@ class Loader:
             'Permissions' not in char_dict or \
                 'UUID' not in char_dict:
             raise KeyError('Could not load char {}!'.format(name))
+        if name in self.char_priorities:
+            char_dict.setdefault(PROP_PRIORITY, self.char_priorities[name])
+        if name in self.stateless_chars:
+            char_dict.setdefault(PROP_STATELESS, True)
         return Characteristic.from_dict(name, char_dict)
 
     def get_service(self, name):
@@ -52,7 +78,11 @@ class Loader:
         if 'RequiredCharacteristics' not in service_dict or \
                 'UUID' not in service_dict:
             raise KeyError('Could not load service {}!'.format(name))
-        return Service.from_dict(name, service_dict, self)
+        service = Service.from_dict(name, service_dict, self)
+        if name in self.serv_priorities:
+            for char in service.characteristics:
+                char.properties.setdefault(PROP_PRIORITY, self.serv_priorities[name])
+        return service
 
     @classmethod
     def from_dict(cls, char_dict=None, serv_dict=None):
@@ -60,6 +90,9 @@ class Loader:
         loader = cls.__new__(Loader)
         loader.char_types = char_dict or {}
         loader.serv_types = serv_dict or {}
+        loader.char_priorities = {}
+        loader.serv_priorities = {}
+        loader.stateless_chars = frozenset()
         return loader
 
 
@@ -1,4 +1,9 @@
 # hsrp parameters
+import functools
+import hashlib
+
+from pyhap import hsrp
+
 ng_order = (1024, 2048, 3072, 4096, 8192)
 
 _ng_const = (
@@ -96,8 +101,18 @@ FC026E479558E4475677E9AA9E3050E2765694DFC81F56E880B96E71\
 )
 
 
+# The group length, hash function and salt length of the SRP of HAP pair setup, for
+# get_srp_context
+HAP_SRP_PARAMS = (3072, hashlib.sha512, 16)
+
+
+@functools.lru_cache(maxsize=None)
 def get_srp_context(ng_group_len, hashfunc, salt_len=16):
+    """Return the SRP context of the given group, hash function and salt length.
 
+    The context is created once, with the constants of the group, and must not be
+    modified.
+    """
     group = _ng_const[ng_order.index(ng_group_len)]
 
     ctx = {
@@ -107,4 +122,6 @@ def get_srp_context(ng_group_len, hashfunc, salt_len=16):
         'N_len': ng_group_len,
         'salt_len': salt_len
     }
+    ctx['k'] = hsrp.get_k(ctx)
+    ctx['group_hash'] = hsrp.get_group_hash(ctx)
     return ctx
@@ -51,7 +51,11 @@ class Service:
 
     def configure_char(self, char_name, properties=None, valid_values=None,
                        value=None, setter_callback=None, getter_callback=None):
-        """Helper method to return fully configured characteristic."""
+        """Helper method to return fully configured characteristic.
+
+        The properties may include a notification policy, e.g.
+        ``{PROP_DEADBAND: 0.5, PROP_MIN_NOTIFY_INTERVAL: 10}``, see characteristic.
+        """
         char = self.get_characteristic(char_name)
         if properties or valid_values:
             char.override_properties(properties, valid_values)
@@ -3,6 +3,7 @@ import base64
 import socket
 import random
 import binascii
+import json
 import sys
 
 
@@ -39,16 +40,7 @@ def long_to_bytes(n):
     :return: ``long int`` in ``bytes`` format.
     :rtype: bytes
     """
-    byteList = list()
-    x = 0
-    off = 0
-    while x != n:
-        b = (n >> off) & 0xFF
-        byteList.append(b)
-        x = x | (b << off)
-        off += 8
-    byteList.reverse()
-    return bytes(byteList)
+    return n.to_bytes((n.bit_length() + 7) // 8, byteorder="big")
 
 
 def generate_mac():
@@ -130,6 +122,37 @@ def byte_bool(boolv):
     return b'\x01' if boolv else b'\x00'
 
 
+def json_bytes(value):
+    """Return the JSON encoding of the given value, like ``json.dumps``.
+
+    Booleans and integers, the most common characteristic values, are encoded
+    without ``json``.
+
+    :rtype: bytes
+    """
+    if value is True:
+        return b'true'
+    if value is False:
+        return b'false'
+    if type(value) is int:  # pylint: disable=unidiomatic-typecheck
+        return b'%d' % value
+    return json.dumps(value).encode()
+
+
+def in_loop(loop):
+    """Return whether the caller runs in the given event loop, i.e. in its thread.
+
+    Before Python 3.7, which has ``asyncio.get_running_loop``, callers are taken to be
+    off the loop. They then hand over to the loop thread-safely, which is slower only.
+
+    :rtype: bool
+    """
+    try:
+        return asyncio.get_running_loop() is loop
+    except (AttributeError, RuntimeError):  # Before Python 3.7, or no running loop
+        return False
+
+
 async def event_wait(event, timeout, loop=None):
     """Wait for the given event to be set or for the timeout to expire.
 
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Measure the latency of doorbell events under a flood of temperature updates.
+
+A bridge with many temperature sensors and a doorbell is run by a driver without a
+HAP server: ``push_event`` only takes some time per client, as if the event was sent.
+The event loop of the driver runs in its own thread, which sends the events.
+Every temperature changes all the time, while the doorbell is pressed every few
+milliseconds. The latency is the time from ``set_value`` on the doorbell until its
+event is pushed to the first client. This is run with the default event priorities
+from the loader and with all events of the same priority.
+
+Usage: python3 scripts/benchmark_event_priority.py [seconds]
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+from pyhap.accessory import Accessory, Bridge
+from pyhap.accessory_driver import AccessoryDriver
+from pyhap.characteristic import EVENT_PRIORITY_NORMAL, PROP_PRIORITY
+
+SENSORS = 1000
+CLIENTS = 4
+PUSH_TIME = 0.0001  # seconds per push_event
+PRESS_INTERVAL = 0.01  # seconds between doorbell presses
+
+
+class Server:
+    """Takes PUSH_TIME per pushed event and notes when the doorbell was pushed."""
+
+    def __init__(self, doorbell_aid):
+        self.marker = '"aid": {},'.format(doorbell_aid).encode()
+        self.pressed = None  # time.perf_counter() of the pending press
+        self.latencies = []
+
+    def push_event(self, bytesdata, client_addr):
+        end = time.perf_counter() + PUSH_TIME
+        while time.perf_counter() < end:
+            pass
+        if self.pressed is not None and self.marker in bytesdata:
+            self.latencies.append(time.perf_counter() - self.pressed)
+            self.pressed = None
+        return True
+
+
+def run(seconds, priorities):
+    persist_file = os.path.join(tempfile.mkdtemp(), 'accessory.state')
+    with patch('pyhap.accessory_driver.Zeroconf'):
+        driver = AccessoryDriver(port=0, persist_file=persist_file)
+    bridge = Bridge(driver, 'Bridge')
+    temperatures = []
+    for i in range(SENSORS):
+        sensor = Accessory(driver, 'Sensor {}'.format(i))
+        temperatures.append(sensor.add_preload_service('TemperatureSensor')
+                            .get_characteristic('CurrentTemperature'))
+        bridge.add_accessory(sensor)
+    doorbell = Accessory(driver, 'Doorbell')
+    button = doorbell.add_preload_service('Doorbell') \
+        .get_characteristic('ProgrammableSwitchEvent')
+    bridge.add_accessory(doorbell)
+    driver.add_accessory(bridge)
+    chars = temperatures + [button]
+    if not priorities:
+        for char in chars:
+            char.properties[PROP_PRIORITY] = EVENT_PRIORITY_NORMAL
+    for char in chars:
+        topic = (char.broker.aid, char.broker.iid_manager.get_iid(char))
+        for port in range(CLIENTS):
+            driver.subscribe_client_topic(('127.0.0.1', port), topic)
+    server = driver.http_server = Server(doorbell.aid)
+    threading.Thread(target=driver.loop.run_forever, daemon=True).start()
+
+    stop = threading.Event()
+
+    def flood():
+        while not stop.is_set():
+            for char in temperatures:
+                char.set_value(random.uniform(15, 25))
+            time.sleep(0)
+
+    flooder = threading.Thread(target=flood)
+    flooder.start()
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        time.sleep(PRESS_INTERVAL)
+        if server.pressed is None:
+            server.pressed = time.perf_counter()
+            button.set_value(0)
+    stop.set()
+    flooder.join()
+    driver.loop.call_soon_threadsafe(driver.loop.stop)
+    return sorted(server.latencies)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('{:<24}{:>8}{:>10}{:>10}{:>10}'.format(
+        '', 'presses', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, priorities in (('same priority', False), ('priorities', True)):
+        latencies = run(seconds, priorities)
+        print('{:<24}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            name, len(latencies), latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Measure the latency of encrypted requests while pair setups are computed.
+
+An accessory is served on localhost and paired with a controller, which then sends
+encrypted ``GET /characteristics`` requests. Meanwhile, 8 threads of the same process
+handle pair setups (as in ``benchmark_pair_setup.py``). This is run with the crypto
+computed in the handler threads and in a ``CryptoProcessPool``.
+
+Usage: python3 scripts/benchmark_handshake_offload.py [seconds]
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap import tlv
+from pyhap.accessory import Accessory
+from pyhap.accessory_driver import AccessoryDriver
+from pyhap.hap_server import HAPServerHandler, HAPSocket
+
+from benchmark_pair_setup import PINCODE, Controller, pair_setup
+
+HANDSHAKE_THREADS = 8
+
+
+class Connection:
+    """A controller connection, that can be switched to encrypted transport."""
+
+    def __init__(self, port):
+        self.sock = socket.create_connection(('127.0.0.1', port))
+        self.buffer = b''
+        self.encoder = None
+        self.decoder = None
+
+    def _receive(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError('closed')
+        if self.decoder is None:
+            self.buffer += data
+        else:
+            self.decoder.feed(data)
+            self.buffer += self.decoder.read()
+
+    def request(self, method, path, body=b''):
+        head = '{} {} HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(
+            method, path, len(body)).encode()
+        if self.encoder is None:
+            self.sock.sendall(head + body)
+        else:
+            self.sock.sendall(self.encoder.encrypt([head, body]))
+        while b'\r\n\r\n' not in self.buffer:
+            self._receive()
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        length = int(head.lower().split(b'content-length:')[1].split(b'\r\n')[0])
+        while len(self.buffer) < length:
+            self._receive()
+        body, self.buffer = self.buffer[:length], self.buffer[length:]
+        return body
+
+    def encrypt(self, shared_key):
+        provider = hap_crypto.get_provider()
+        # The controller writes with the accessory's in key and reads with its out key.
+        write_key = provider.hkdf(shared_key, HAPSocket.CIPHER_SALT,
+                                  HAPSocket.IN_CIPHER_INFO)
+        read_key = provider.hkdf(shared_key, HAPSocket.CIPHER_SALT,
+                                 HAPSocket.OUT_CIPHER_INFO)
+        self.encoder = hap_crypto.HAPFrameEncoder(provider.aead(write_key))
+        self.decoder = hap_crypto.HAPFrameDecoder(provider.aead(read_key))
+
+
+def pair(port):
+    """Pair a controller and return its encrypted connection."""
+    controller = Controller()
+    conn = Connection(port)
+    m2 = tlv.decode(conn.request('POST', '/pair-setup',
+                                 tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01')))
+    conn.request('POST', '/pair-setup', controller.m3(m2))
+    conn.request('POST', '/pair-setup', controller.m5())
+    conn.sock.close()
+
+    provider = hap_crypto.get_provider()
+    conn = Connection(port)
+    private_key, public_key = provider.x25519_generate()
+    m2 = tlv.decode(conn.request('POST', '/pair-verify',
+                                 tlv.encode(b'\x06', b'\x01', b'\x03', public_key)))
+    accessory_public = m2[b'\x03']
+    shared_key = provider.x25519_exchange(private_key, accessory_public)
+    key = provider.hkdf(shared_key, HAPServerHandler.PVERIFY_1_SALT,
+                        HAPServerHandler.PVERIFY_1_INFO)
+    proof = controller.signing_key.sign(public_key + controller.username
+                                        + accessory_public)
+    sealed = provider.aead(key).seal(
+        HAPServerHandler.PVERIFY_2_NONCE,
+        tlv.encode(b'\x01', controller.username, b'\x0a', proof), b'')
+    conn.request('POST', '/pair-verify', tlv.encode(b'\x06', b'\x03', b'\x05', sealed))
+    conn.encrypt(shared_key)
+    return conn
+
+
+def measure(port, seconds, crypto_pool, handshakes):
+    """Return the sorted latencies of encrypted requests, with handshakes running."""
+    conn = pair(port)
+    stop = threading.Event()
+
+    def handshake_loop():
+        while not stop.is_set():
+            pair_setup(crypto_pool)
+
+    threads = [threading.Thread(target=handshake_loop) for _ in range(handshakes)]
+    for thread in threads:
+        thread.start()
+    latencies = []
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.perf_counter()
+        conn.request('GET', '/characteristics?id=1.9')
+        latencies.append(time.perf_counter() - start)
+        time.sleep(0.005)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    conn.sock.close()
+    return sorted(latencies)
+
+
+def run(seconds, crypto_processes, handshakes):
+    persist_file = os.path.join(tempfile.mkdtemp(), 'accessory.state')
+    with patch('pyhap.accessory_driver.Zeroconf'):
+        driver = AccessoryDriver(address='127.0.0.1', port=0, pincode=PINCODE,
+                                 persist_file=persist_file,
+                                 crypto_processes=crypto_processes)
+    driver.update_advertisement = lambda: None
+    accessory = Accessory(driver, 'Sensor')
+    accessory.add_preload_service('TemperatureSensor')
+    accessory.setup_message = lambda: None
+    driver.add_accessory(accessory)
+    thread = threading.Thread(target=driver.start)
+    thread.start()
+    while driver.http_server.server is None:
+        time.sleep(0.01)
+    port = driver.http_server.server.sockets[0].getsockname()[1]
+    try:
+        return measure(port, seconds, driver.crypto_pool, handshakes)
+    finally:
+        driver.stop()
+        thread.join()
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print('{:<28}{:>10}{:>10}{:>10}'.format('', 'p50 ms', 'p99 ms', 'max ms'))
+    for name, processes, handshakes in (
+            ('no handshakes', None, 0),
+            ('handshakes in threads', None, HANDSHAKE_THREADS),
+            ('handshakes in processes', os.cpu_count(), HANDSHAKE_THREADS)):
+        latencies = run(seconds, processes, handshakes)
+        print('{:<28}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            name, latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Measure the cost of parsing HAP requests.
+
+Compares ``pyhap.hap_http`` with the previous parsing in ``HAPServerHandler``:
+``BaseHTTPRequestHandler.parse_request`` for the request line and headers, then
+``urlparse`` for the route and ``parse_qs`` for the characteristic ids.
+
+Usage: python3 scripts/benchmark_http_parser.py [rounds]
+"""
+import io
+import sys
+import timeit
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from pyhap import hap_http
+
+REQUESTS = {
+    'GET chars': b'GET /characteristics?id=1.10,1.11,2.10,2.11,3.10 HTTP/1.1\r\n'
+                 b'Host: Bridge._hap._tcp.local\r\n\r\n',
+    'PUT chars': b'PUT /characteristics HTTP/1.1\r\nHost: Bridge._hap._tcp.local\r\n'
+                 b'Content-Type: application/hap+json\r\nContent-Length: 41\r\n\r\n',
+}
+
+
+class StdlibHandler(BaseHTTPRequestHandler):
+    """A handler that only parses, without a connection."""
+
+    def __init__(self):  # pylint: disable=super-init-not-called
+        pass
+
+
+def parse_previous(request):
+    handler = StdlibHandler()
+    handler.rfile = io.BytesIO(request)
+    handler.raw_requestline = handler.rfile.readline(65537)
+    assert handler.parse_request()
+    path = urlparse(handler.path).path
+    length = int(handler.headers.get('Content-Length', 0))
+    if handler.command == 'GET':
+        ids = parse_qs(urlparse(handler.path).query)['id'][0].split(',')
+        ids = [tuple(int(i) for i in char_id.split('.')) for char_id in ids]
+    return path, length
+
+
+def parse_current(request):
+    rfile = io.BytesIO(request)
+    command, target, _ = hap_http.parse_request_line(rfile.readline(65537))
+    headers = hap_http.read_headers(rfile)
+    length = hap_http.content_length(headers)
+    path, _, query = target.partition('?')
+    if command == 'GET':
+        hap_http.parse_char_ids(query)
+    return path, length
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print('{:<12}{:<10}{:>14}'.format('request', 'parser', 'us/request'))
+    for name, request in REQUESTS.items():
+        assert parse_previous(request) == parse_current(request)
+        for label, parse in (('previous', parse_previous), ('current', parse_current)):
+            seconds = min(timeit.repeat(lambda: parse(request), number=rounds, repeat=3))
+            print('{:<12}{:<10}{:>14.2f}'.format(name, label, seconds / rounds * 1e6))
+
+
+if __name__ == '__main__':
+    main()
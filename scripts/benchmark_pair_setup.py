@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Measure the CPU time the accessory spends on a full pair setup (M1 to M6).
+
+A controller is simulated in-process; only the time spent in the accessory's request
+handling is measured. The SRP verifier is created during M1, as it would be without
+precomputation. Runs with the builtin ``pow`` and, if installed, with gmpy2.
+
+Usage: python3 scripts/benchmark_pair_setup.py [rounds]
+"""
+import hashlib
+import os
+import sys
+import time
+import uuid
+
+import ed25519
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap import hap_workers, hsrp, tlv
+from pyhap.hap_admission import HandshakeAdmission
+from pyhap.hap_connections import ConnectionRegistry
+from pyhap.hap_protocol import AsyncHAPServerHandler
+from pyhap.params import HAP_SRP_PARAMS, get_srp_context
+from pyhap.state import State
+from pyhap.util import long_to_bytes
+
+PINCODE = b'123-45-678'
+
+
+class Driver:
+    """The parts of AccessoryDriver that pair setup uses."""
+
+    def __init__(self, crypto_pool=None):
+        self.state = State(address='127.0.0.1', pincode=PINCODE)
+        self.crypto_pool = crypto_pool
+        self.handshake_admission = HandshakeAdmission(max_concurrent=None, rate=None)
+
+    def new_srp_verifier(self):
+        if self.crypto_pool is None:
+            return hap_workers.create_srp_verifier(self.state.pincode)
+        return self.crypto_pool.run(hap_workers.create_srp_verifier,
+                                    self.state.pincode)
+
+    def call_later(self, delay, target, on_cancel=None):
+        pass  # Pair setup never expires here.
+
+    def cancel_call_later(self, target):
+        pass
+
+    def pair(self, client_uuid, client_public):
+        self.state.add_paired_client(client_uuid, client_public)
+        return True
+
+
+class Server:
+    """The parts of AsyncHAPServer that pair setup uses."""
+
+    def __init__(self):
+        self.connections = ConnectionRegistry()
+
+
+class Controller:
+    """Computes the controller side of pair setup."""
+
+    def __init__(self):
+        self.username = str(uuid.uuid4()).upper().encode()
+        self.signing_key, self.verifying_key = ed25519.create_keypair()
+        self.provider = hap_crypto.get_provider()
+        self.session_key = None
+
+    def m3(self, m2):
+        ctx = get_srp_context(*HAP_SRP_PARAMS)
+        N, g = ctx['N'], ctx['g']
+        salt = m2[b'\x02']
+        B = int.from_bytes(m2[b'\x03'], 'big')
+        a = int.from_bytes(os.urandom(32), 'big')
+        A = pow(g, a, N)
+        x = hsrp.get_x(b'Pair-Setup', PINCODE, salt, ctx)
+        u = int.from_bytes(hashlib.sha512(
+            hsrp.padN(long_to_bytes(A), ctx) + hsrp.padN(long_to_bytes(B), ctx)).digest(),
+            'big')
+        S = pow((B - hsrp.get_k(ctx) * pow(g, x, N)) % N, a + u * x, N)
+        K = hsrp.get_session_key(S, ctx)
+        M = hashlib.sha512(hsrp.get_group_hash(ctx)
+                           + hashlib.sha512(b'Pair-Setup').digest() + salt
+                           + long_to_bytes(A) + long_to_bytes(B)
+                           + long_to_bytes(K)).digest()
+        self.session_key = long_to_bytes(K)
+        return tlv.encode(b'\x06', b'\x03', b'\x03', long_to_bytes(A), b'\x04', M)
+
+    def m5(self):
+        provider = self.provider
+        encrypt_key = provider.hkdf(self.session_key, b'Pair-Setup-Encrypt-Salt',
+                                    b'Pair-Setup-Encrypt-Info')
+        sign_key = provider.hkdf(self.session_key, b'Pair-Setup-Controller-Sign-Salt',
+                                 b'Pair-Setup-Controller-Sign-Info')
+        ltpk = self.verifying_key.to_bytes()
+        proof = self.signing_key.sign(sign_key + self.username + ltpk)
+        data = tlv.encode(b'\x01', self.username, b'\x03', ltpk, b'\x0a', proof)
+        sealed = provider.aead(encrypt_key).seal(
+            hap_crypto.pad_tls_nonce(b'PS-Msg05'), data, b'')
+        return tlv.encode(b'\x06', b'\x05', b'\x05', sealed)
+
+
+def request(handler, body):
+    """Return the TLV response of the accessory and the CPU seconds to make it."""
+    head = 'POST /pair-setup HTTP/1.1\r\nContent-Length: {}\r\n\r\n'.format(
+        len(body)).encode()
+    start = time.process_time()
+    assert handler.parse_head(head)
+    response = b''.join(handler.handle_request(body))
+    cpu = time.process_time() - start
+    return tlv.decode(response.split(b'\r\n\r\n', 1)[1]), cpu
+
+
+def pair_setup(crypto_pool=None):
+    driver = Driver(crypto_pool)
+    controller = Controller()
+    handler = AsyncHAPServerHandler(('127.0.0.1', 5555), Server(), driver)
+    m2, cpu1 = request(handler, tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01'))
+    m4, cpu2 = request(handler, controller.m3(m2))
+    assert b'\x04' in m4, 'wrong proof'
+    m6, cpu3 = request(handler, controller.m5())
+    assert b'\x05' in m6 and driver.state.paired
+    return cpu1 + cpu2 + cpu3
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    engines = [('pow', pow)]
+    if hsrp.SUPPORT_GMPY2:
+        engines.append(('gmpy2', hsrp.modpow))
+    print('crypto backend: {}'.format(hap_crypto.get_provider().name))
+    print('{:<10}{:>20}'.format('modpow', 'cpu ms/pair setup'))
+    for name, modpow in engines:
+        hsrp.modpow = modpow
+        cpu = sorted(pair_setup() for _ in range(rounds))
+        print('{:<10}{:>20.1f}'.format(name, cpu[len(cpu) // 2] * 1000))
+
+
+if __name__ == '__main__':
+    main()
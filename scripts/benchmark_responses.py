@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""Measure the cost of sending encrypted HAP responses.
+
+Compares the current outbound path (one buffer list, sealed into one preallocated
+buffer, sent with one call) with the previous one (headers and body written
+separately, frames joined with ``+=``), for 1 KB, 64 KB and 512 KB bodies.
+
+Usage: python3 scripts/benchmark_responses.py [rounds]
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap.hap_server import HAPSocket, send_buffers
+
+SIZES = (1024, 64 * 1024, 512 * 1024)
+HEADERS = b"HTTP/1.1 200 OK\r\nContent-Type: application/hap+json\r\n" \
+          b"Content-Length: %d\r\n\r\n"
+
+
+def legacy_sendall(sock, cipher, counter, data):
+    """The previous HAPSocket.sendall."""
+    result = b""
+    offset = 0
+    while offset < len(data):
+        length = min(len(data) - offset, 0x400)
+        length_bytes = struct.pack("H", length)
+        nonce = hap_crypto.pad_tls_nonce(struct.pack("Q", counter[0]))
+        result += length_bytes + cipher.seal(
+            nonce, data[offset:offset + length], length_bytes)
+        offset += length
+        counter[0] += 1
+    socket.socket.sendall(sock, result)
+
+
+def drain(sock):
+    while sock.recv(1 << 20):
+        pass
+
+
+def run(size, rounds, legacy):
+    server, client = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(client,))
+    reader.start()
+    hap_socket = HAPSocket(server, os.urandom(32))
+    body = os.urandom(size)
+    headers = HEADERS % size
+    counter = [0]
+
+    latencies = []
+    cpu_start = time.process_time()
+    for _ in range(rounds):
+        start = time.perf_counter()
+        if legacy:
+            legacy_sendall(hap_socket, hap_socket.out_cipher, counter, headers)
+            legacy_sendall(hap_socket, hap_socket.out_cipher, counter, body)
+        else:
+            send_buffers(hap_socket, (headers, body))
+        latencies.append(time.perf_counter() - start)
+    cpu = time.process_time() - cpu_start
+
+    hap_socket.close()
+    reader.join()
+    client.close()
+    latencies.sort()
+    return latencies[len(latencies) // 2] * 1000, cpu / rounds * 1000
+
+
+def main():
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print('crypto backend: {}'.format(hap_crypto.get_provider().name))
+    print('{:<10}{:<10}{:>16}{:>16}'.format('body', 'path', 'median ms', 'cpu ms/resp'))
+    for size in SIZES:
+        for legacy in (True, False):
+            latency, cpu = run(size, rounds, legacy)
+            print('{:<10}{:<10}{:>16.3f}{:>16.3f}'.format(
+                '{}KB'.format(size // 1024), 'previous' if legacy else 'current',
+                latency, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -13,5 +13,9 @@ class MockDriver():
     def __init__(self):
         self.loader = Loader()
 
-    def publish(self, data):
+    def publish(self, data, sender_client_addr=None, priority=None):
+        pass
+
+    def publish_value(self, topic, value_bytes, sender_client_addr=None,
+                      priority=None):
         pass
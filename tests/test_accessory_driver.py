@@ -1,11 +1,18 @@
 """Tests for pyhap.accessory_driver."""
+import asyncio
+import json
+import socket
 import tempfile
-from unittest.mock import patch
+import threading
+import time
+from unittest.mock import MagicMock, patch
 
 import pytest
 
 from pyhap.accessory import Accessory, STANDALONE_AID
 from pyhap.accessory_driver import AccessoryDriver
+from pyhap.characteristic import CharacteristicError
+from pyhap.hap_server import HAPServer
 
 
 @pytest.fixture
@@ -75,3 +82,342 @@ def test_start_stop_async_acc(driver):
     driver.add_accessory(acc)
     driver.start()
     assert driver.loop.is_closed()
+
+
+def test_call_later(driver):
+    target = MagicMock()
+    driver.call_later(0, target)
+    driver.call_later(0, target)  # pending already
+    run_loop(driver)
+    target.assert_called_once_with()
+    assert not driver.later_calls
+
+
+def test_cancel_call_later(driver):
+    target, on_cancel = MagicMock(), MagicMock()
+    driver.call_later(0, target, on_cancel)
+    driver.cancel_call_later(target)
+    driver.cancel_call_later(MagicMock())  # not pending
+    run_loop(driver)
+    target.assert_not_called()
+    on_cancel.assert_called_once_with()
+    assert not driver.later_calls
+
+
+def test_call_later_refused(driver):
+    on_cancel = MagicMock()
+    driver.stop_event.set()
+    driver.call_later(0, MagicMock(), on_cancel)
+    on_cancel.assert_called_once_with()
+
+    on_cancel.reset_mock()
+    driver.stop_event.clear()
+    driver.loop.close()
+    driver.call_later(0, MagicMock(), on_cancel)
+    on_cancel.assert_called_once_with()
+
+
+def test_stop_cancels_call_later(driver):
+    target, on_cancel = MagicMock(), MagicMock()
+    driver.call_later(10, target, on_cancel)
+    run_loop(driver)
+    with patch.object(driver, '_do_stop', lambda: None):
+        driver.loop.create_task(driver.async_stop())
+        driver.loop.run_forever()
+    assert not driver.later_calls
+    on_cancel.assert_called_once_with()
+    run_loop(driver)
+    target.assert_not_called()
+
+
+def test_unsubscribe_client(driver):
+    client, other_client = ('127.0.0.1', 5555), ('127.0.0.1', 5556)
+    driver.subscribe_client_topic(client, (1, 9))
+    driver.subscribe_client_topic(client, (1, 10))
+    driver.subscribe_client_topic(other_client, (1, 10))
+    driver.unsubscribe_client(client)
+    assert driver.topics == {(1, 10): {other_client}}
+
+
+def test_srp_verifier_is_precomputed(driver):
+    verifiers = [MagicMock(), MagicMock(), MagicMock()]
+    with patch.object(driver, '_create_srp_verifier', side_effect=verifiers):
+        driver.prepare_srp_verifier()
+        assert driver.new_srp_verifier() is verifiers[0]
+        assert driver.next_srp_verifier.result() is verifiers[1]
+        assert driver.new_srp_verifier() is verifiers[1]
+    driver.executer.shutdown()
+
+
+def test_srp_verifier_is_fresh_per_attempt(driver):
+    first, second = driver._create_srp_verifier(), driver._create_srp_verifier()
+    assert first.s != second.s
+    assert first.get_challenge()[1] != second.get_challenge()[1]
+
+
+def run_loop(driver, seconds=0.01):
+    """Run the loop of the driver for a while, e.g. to send the published events."""
+    driver.loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def pushed_events(driver):
+    """Return the characteristics of each pushed event, by client."""
+    pushed = {}
+    for call in driver.http_server.push_event.call_args_list:
+        pushed.setdefault(call[0][1], []).append(
+            json.loads(call[0][0].decode())['characteristics'])
+    return pushed
+
+
+def test_events_are_coalesced_per_client(driver):
+    client, other_client = ('127.0.0.1', 5555), ('127.0.0.1', 5556)
+    driver.subscribe_client_topic(client, (1, 9))
+    driver.subscribe_client_topic(client, (1, 10))
+    driver.subscribe_client_topic(other_client, (1, 10))
+    driver.subscribe_client_topic(other_client, (1, 12))
+    driver.http_server = MagicMock()
+    driver.http_server.push_event.side_effect = lambda data, addr: addr == client
+    for iid, value in ((9, 20), (10, True), (9, 21)):
+        driver.publish({'aid': 1, 'iid': iid, 'value': value})
+    driver.publish({'aid': 1, 'iid': 11, 'value': 0})  # not subscribed
+
+    run_loop(driver)
+    assert driver.event_queue.stats()['superseded'] == 1  # 1.9
+    assert pushed_events(driver) == {
+        client: [[{'aid': 1, 'iid': 9, 'value': 21},
+                  {'aid': 1, 'iid': 10, 'value': True}]],
+        other_client: [[{'aid': 1, 'iid': 10, 'value': True}]],
+    }
+    assert driver.topics == {(1, 9): {client}, (1, 10): {client}}
+
+
+def test_coalesce_window(driver):
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 9))
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 10))
+    driver.http_server = MagicMock()
+    driver.event_coalesce_window = 0.1
+    driver.publish({'aid': 1, 'iid': 9, 'value': 1})
+    driver.loop.call_later(0.01, driver.publish, {'aid': 1, 'iid': 10, 'value': 2})
+    run_loop(driver, 0.05)
+    driver.http_server.push_event.assert_not_called()
+
+    run_loop(driver, 0.2)
+    assert len(driver.http_server.push_event.call_args_list) == 1
+
+
+def test_high_priority_skips_coalesce_window(driver):
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 9))
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 10))
+    driver.http_server = MagicMock()
+    driver.event_coalesce_window = 5
+
+    async def publish():
+        driver.publish({'aid': 1, 'iid': 9, 'value': 1}, priority=2)
+        driver.publish({'aid': 1, 'iid': 10, 'value': 2}, priority=0)
+
+    driver.loop.run_until_complete(publish())
+    run_loop(driver)
+    assert [[event['iid'] for event in events]
+            for events in pushed_events(driver)[('127.0.0.1', 5555)]] == [[10], [9]]
+
+
+def test_high_priority_is_taken_before_batch(driver):
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 9))
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 10))
+    driver.http_server = MagicMock()
+    driver.publish({'aid': 1, 'iid': 9, 'value': 1})
+    driver.publish({'aid': 1, 'iid': 10, 'value': 2}, priority=0)
+    driver.http_server.push_event.assert_not_called()  # sent by the loop
+    run_loop(driver)
+    assert [[event['iid'] for event in events]
+            for events in pushed_events(driver)[('127.0.0.1', 5555)]] == [[10], [9]]
+
+
+def test_event_queue_keeps_latest_value(driver):
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 9))
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 10))
+    driver.http_server = MagicMock()
+    for value in range(1000):
+        driver.publish({'aid': 1, 'iid': 9, 'value': value})
+    driver.publish({'aid': 1, 'iid': 10, 'value': True})
+    driver.publish({'aid': 1, 'iid': 9, 'value': -1})
+
+    run_loop(driver)
+    assert driver.event_queue.stats() == {'queued': [0, 0, 0], 'superseded': 1000}
+    assert pushed_events(driver) == {('127.0.0.1', 5555): [[
+        {'aid': 1, 'iid': 9, 'value': -1}, {'aid': 1, 'iid': 10, 'value': True}]]}
+
+
+def test_stateless_events_are_not_superseded(driver):
+    acc = Accessory(driver, 'TestAcc')
+    char = acc.add_preload_service('StatelessProgrammableSwitch') \
+        .configure_char('ProgrammableSwitchEvent')
+    driver.add_accessory(acc)
+    iid = acc.iid_manager.get_iid(char)
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (acc.aid, iid))
+    driver.http_server = MagicMock()
+    char.set_value(0)
+    char.set_value(0)  # pressed twice before the loop takes the events
+    char.set_value(1)
+
+    run_loop(driver)
+    assert pushed_events(driver) == {('127.0.0.1', 5555): [
+        [{'aid': acc.aid, 'iid': iid, 'value': value}] for value in (0, 0, 1)]}
+
+
+def test_publish_in_loop_is_queued_right_away(driver):
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 9))
+    driver.http_server = MagicMock()
+
+    async def publish():
+        driver.publish({'aid': 1, 'iid': 9, 'value': 1})
+        assert len(driver.event_queue) == 1 and not driver.published_events
+
+    with patch.object(driver.loop, 'call_soon_threadsafe') as call_soon_threadsafe:
+        driver.loop.run_until_complete(publish())
+        run_loop(driver)
+    call_soon_threadsafe.assert_not_called()
+    assert driver.http_server.push_event.call_count == 1
+
+
+def test_writer_is_not_sent_its_write(driver):
+    writer, other_client = ('127.0.0.1', 5555), ('127.0.0.1', 5556)
+    acc = Accessory(driver, 'TestAcc')
+    char = acc.add_preload_service('Switch').configure_char('On')
+    driver.add_accessory(acc)
+    topic = (acc.aid, acc.iid_manager.get_iid(char))
+    driver.subscribe_client_topic(writer, topic)
+    driver.subscribe_client_topic(other_client, topic)
+    driver.http_server = MagicMock()
+
+    driver.set_characteristics({'characteristics': [
+        {'aid': acc.aid, 'iid': acc.iid_manager.get_iid(char), 'value': True}]},
+        writer)
+    run_loop(driver)
+    assert [call[0][1] for call in driver.http_server.push_event.call_args_list] \
+        == [other_client]
+
+    # A later value from the accessory supersedes the write and is sent to both.
+    driver.http_server.reset_mock()
+    driver.set_characteristics({'characteristics': [
+        {'aid': acc.aid, 'iid': acc.iid_manager.get_iid(char), 'value': False}]},
+        writer)
+    char.set_value(True)
+    run_loop(driver)
+    assert {call[0][1] for call in driver.http_server.push_event.call_args_list} \
+        == {writer, other_client}
+
+
+def test_events_and_reads_reuse_value_bytes(driver):
+    acc = Accessory(driver, 'TestAcc')
+    char = acc.add_preload_service('TemperatureSensor') \
+        .configure_char('CurrentTemperature')
+    driver.add_accessory(acc)
+    iid = acc.iid_manager.get_iid(char)
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (acc.aid, iid))
+    char.set_value(20.5)
+
+    with patch('pyhap.accessory_driver.json') as json_module:
+        driver._take_published_events()
+        body = driver.get_characteristics_json(['{}.{}'.format(acc.aid, iid)])
+    json_module.dumps.assert_not_called()
+    assert driver.event_queue.get()[1] == '{{"aid": {}, "iid": {}, "value": 20.5}}' \
+        .format(acc.aid, iid).encode()
+    assert json.loads(body.decode()) == {'characteristics': [
+        {'aid': acc.aid, 'iid': iid, 'value': 20.5, 'status': 0}]}
+
+    char.getter_callback = MagicMock(side_effect=CharacteristicError)
+    body = driver.get_characteristics_json([(acc.aid, iid)])
+    assert json.loads(body.decode()) == {'characteristics': [
+        {'aid': acc.aid, 'iid': iid, 'status': -70402}]}
+
+
+def test_async_set_value_is_resolved_once_written(driver):
+    client, other_client = ('127.0.0.1', 5555), ('127.0.0.1', 5556)
+    acc = Accessory(driver, 'TestAcc')
+    char = acc.add_preload_service('TemperatureSensor') \
+        .configure_char('CurrentTemperature')
+    driver.add_accessory(acc)
+    topic = (acc.aid, acc.iid_manager.get_iid(char))
+    driver.http_server = MagicMock()
+
+    async def set_values(*values):
+        return [char.async_set_value(value) for value in values]
+
+    # Nobody is subscribed.
+    future, = driver.loop.run_until_complete(set_values(20))
+    assert future.result() is True
+
+    driver.subscribe_client_topic(client, topic)
+    driver.subscribe_client_topic(other_client, topic)
+    superseded, future = driver.loop.run_until_complete(set_values(21, 22))
+    run_loop(driver)
+    assert driver.http_server.push_event.call_count == 2
+    assert not future.done()
+    for call in driver.http_server.push_event.call_args_list:
+        call[0][2](True)  # on_written
+    run_loop(driver)
+    assert future.result() is True and superseded.result() is True
+
+    # The other client is gone.
+    driver.http_server.push_event.side_effect = \
+        lambda data, addr, on_written: addr == client
+    future, = driver.loop.run_until_complete(set_values(23))
+    run_loop(driver)
+    assert not future.done()
+    for call in driver.http_server.push_event.call_args_list[2:]:
+        if call[0][1] == client:
+            call[0][2](True)
+    run_loop(driver)
+    assert future.result() is False
+
+
+def test_async_wait_for_room(driver):
+    driver.max_queued_events = 2
+    driver.event_coalesce_window = 0.05
+    driver.http_server = MagicMock()
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 9))
+    driver.subscribe_client_topic(('127.0.0.1', 5555), (1, 10))
+
+    async def produce():
+        assert await driver.async_wait_for_room(0)
+        driver.async_publish({'aid': 1, 'iid': 9, 'value': 1})
+        driver.async_publish({'aid': 1, 'iid': 10, 'value': 1})
+        # Full until the events are sent and written.
+        assert not await driver.async_wait_for_room(0.1)
+        assert driver.http_server.push_event.call_count == 1
+        driver.http_server.push_event.call_args[0][2](True)  # on_written
+        assert await driver.async_wait_for_room(1)
+
+    driver.loop.run_until_complete(produce())
+
+
+def test_async_wait_for_room_with_client_not_reading(driver):
+    driver.max_queued_events = 4
+    server = driver.http_server = HAPServer(('127.0.0.1', 0), driver)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    client = socket.create_connection(server.server_address)
+    client_addr = client.getsockname()
+    value = 'x' * 65536
+
+    async def produce():
+        for _ in range(1000):
+            if not await driver.async_wait_for_room(0.5):
+                return False
+            driver.async_publish({'aid': 1, 'iid': 9, 'value': value})
+            await asyncio.sleep(0)  # e.g. waiting for the next value
+        return True
+
+    try:
+        deadline = time.monotonic() + 5
+        while client_addr not in server.connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+        driver.subscribe_client_topic(client_addr, (1, 9))
+        # The socket buffers fill up, then the events are no longer written.
+        assert not driver.loop.run_until_complete(produce())
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -1,11 +1,15 @@
 """Tests for pyhap.characteristic."""
+import asyncio
 from unittest.mock import Mock, patch, ANY
 from uuid import uuid1
 
 import pytest
 
 from pyhap.characteristic import (
-    Characteristic, HAP_FORMAT_INT, HAP_FORMAT_DEFAULTS, HAP_PERMISSION_READ)
+    Characteristic, EVENT_PRIORITY_HIGH, EVENT_PRIORITY_LOW, HAP_FORMAT_FLOAT,
+    HAP_FORMAT_INT, HAP_FORMAT_DEFAULTS, HAP_PERMISSION_READ, PROP_DEADBAND,
+    PROP_MIN_NOTIFY_INTERVAL, PROP_MIN_STEP, PROP_PRIORITY, PROP_RELATIVE_DEADBAND,
+    PROP_SKIP_UNCHANGED)
 
 PROPERTIES = {
     'Format': HAP_FORMAT_INT,
@@ -95,6 +99,19 @@ def test_override_properties_valid_values():
     assert char.properties['ValidValues'] == new_valid_values
 
 
+def test_override_properties_priority():
+    """Test that priority names are mapped to their values."""
+    char = get_char(PROPERTIES.copy())
+    char.override_properties(properties={PROP_PRIORITY: 'high'})
+    assert char.properties[PROP_PRIORITY] == EVENT_PRIORITY_HIGH
+    char.override_properties(properties={PROP_PRIORITY: EVENT_PRIORITY_LOW})
+    assert char.properties[PROP_PRIORITY] == EVENT_PRIORITY_LOW
+    for priority in ('urgent', 7):
+        with pytest.raises(ValueError):
+            char.override_properties(properties={PROP_PRIORITY: priority})
+    assert char.properties[PROP_PRIORITY] == EVENT_PRIORITY_LOW
+
+
 def test_override_properties_error():
     """Test that method throws an error if no arguments have been passed."""
     char = get_char(PROPERTIES.copy())
@@ -122,6 +139,84 @@ def test_set_value():
         assert mock_notify.call_count == 1
 
 
+def _notified_values(char, values):
+    """Set the values and return the ones that were published."""
+    char.broker = Mock()
+    for value in values:
+        char.set_value(value)
+    return [call[0][0] for call in char.broker.publish.call_args_list]
+
+
+def test_notify_policy_unchanged():
+    char = get_char(PROPERTIES.copy())
+    assert _notified_values(char, [1, 1, 2]) == [1, 1, 2]
+
+    char = get_char(dict(PROPERTIES, **{PROP_SKIP_UNCHANGED: True}))
+    assert _notified_values(char, [1, 1, 2, 2, 1]) == [1, 2, 1]
+
+
+def test_notify_policy_deadband():
+    props = {'Format': HAP_FORMAT_FLOAT, 'Permissions': [HAP_PERMISSION_READ],
+             PROP_MIN_STEP: 0.1, PROP_SKIP_UNCHANGED: True}
+    char = get_char(dict(props))
+    assert _notified_values(char, [20.0, 20.04, 20.08, 20.1, 20.2]) \
+        == [20.0, 20.1, 20.2]
+
+    char = get_char(dict(props, **{PROP_DEADBAND: 0.5}))
+    assert _notified_values(char, [20.0, 20.4, 20.5, 20.1]) == [20.0, 20.5]
+
+    char = get_char(dict(props, **{PROP_RELATIVE_DEADBAND: 0.1}))
+    assert _notified_values(char, [100.0, 109.0, 111.0, 101.0, 99.0]) \
+        == [100.0, 111.0, 99.0]
+
+
+def test_notify_policy_min_interval():
+    char = get_char(dict(PROPERTIES, **{PROP_MIN_NOTIFY_INTERVAL: 10}))
+    with patch('pyhap.characteristic.time.monotonic', return_value=100):
+        assert _notified_values(char, [1, 2, 3]) == [1]
+    char.broker.driver.call_later.assert_called_once_with(10, char._notify_trailing,
+                                                          char._cancel_trailing)
+
+    with patch('pyhap.characteristic.time.monotonic', return_value=110):
+        char._notify_trailing()
+        assert char.broker.publish.call_args[0][0] == 3
+        assert not char.notify_pending
+
+        char.broker.reset_mock()
+        char.set_value(4)  # held back until 120
+        char.broker.publish.assert_not_called()
+    with patch('pyhap.characteristic.time.monotonic', return_value=120):
+        char.set_value(5)
+    assert char.broker.publish.call_args[0][0] == 5
+
+
+def test_notify_policy_min_interval_call_refused():
+    char = get_char(dict(PROPERTIES, **{PROP_MIN_NOTIFY_INTERVAL: 10}))
+    with patch('pyhap.characteristic.time.monotonic', return_value=100):
+        _notified_values(char, [1])
+        # The driver is stopping: the trailing notification is not scheduled.
+        char.broker.driver.call_later.side_effect = \
+            lambda delay, target, on_cancel: on_cancel()
+        char.set_value(2)
+        assert not char.notify_pending
+        char.set_value(3)
+    assert char.broker.driver.call_later.call_count == 2
+
+
+def test_async_set_value_without_broker():
+    char = get_char(PROPERTIES.copy())
+    loop = asyncio.new_event_loop()
+
+    async def set_value():
+        return await char.async_set_value(3)
+
+    try:
+        assert loop.run_until_complete(set_value()) is True
+    finally:
+        loop.close()
+    assert char.value == 3
+
+
 def test_client_update_value():
     """Test updating the characteristic value with call from the driver."""
     path_notify = 'pyhap.characteristic.Characteristic.notify'
@@ -190,6 +285,23 @@ def test_to_HAP_string():
     assert hap_repr['value'] == char.value
 
 
+def test_value_bytes():
+    """Test that the JSON of the value is cached until the value changes."""
+    char = get_char(PROPERTIES.copy())
+    assert char.value_bytes == b'0'
+    with patch('pyhap.characteristic.json_bytes', return_value=b'0') as json_bytes:
+        char.set_value(0, should_notify=False)
+        assert char.value_bytes == b'0'
+        json_bytes.assert_not_called()
+
+    char.properties['Format'] = HAP_FORMAT_FLOAT
+    char.set_value(0.0, should_notify=False)  # equal, but a different JSON
+    assert char.value_bytes == b'0.0'
+    char.properties['Format'] = 'string'
+    char.set_value('"20 °C"', should_notify=False)
+    assert char.value_bytes == b'"\\"20 \\u00b0C\\""'
+
+
 def test_to_HAP_bool():
     """Test created HAP representation for booleans."""
     char = get_char(PROPERTIES.copy())
@@ -0,0 +1,55 @@
+"""Tests for pyhap.hap_admission."""
+from unittest.mock import patch
+
+import pytest
+
+from pyhap import hap_admission
+
+
+def test_concurrency_cap():
+    admission = hap_admission.HandshakeAdmission(max_concurrent=2, rate=None)
+    admission.acquire('10.0.0.1')
+    admission.acquire('10.0.0.2', new_handshake=False)
+    with pytest.raises(hap_admission.HandshakeRejected) as exc:
+        admission.acquire('10.0.0.3')
+    assert exc.value.reason == hap_admission.REJECT_BUSY
+    admission.release()
+    admission.acquire('10.0.0.3')
+    assert admission.stats() == {'active': 2, 'admitted': 3, 'rejected_busy': 1,
+                                 'rejected_backoff': 0}
+
+
+def test_full_cap_admits_handshakes_in_progress():
+    admission = hap_admission.HandshakeAdmission(max_concurrent=1, rate=None)
+    admission.acquire('10.0.0.1')
+    admission.acquire('10.0.0.2', new_handshake=False)
+    with pytest.raises(hap_admission.HandshakeRejected):
+        admission.acquire('10.0.0.3')
+    assert admission.stats()['active'] == 2
+
+
+def test_token_bucket_per_address():
+    admission = hap_admission.HandshakeAdmission(max_concurrent=None, rate=0.5,
+                                                 burst=2)
+    with patch('pyhap.hap_admission.time.monotonic', return_value=100):
+        admission.acquire('10.0.0.1')
+        admission.acquire('10.0.0.1')
+        admission.acquire('10.0.0.1', new_handshake=False)  # continues a handshake
+        with pytest.raises(hap_admission.HandshakeRejected) as exc:
+            admission.acquire('10.0.0.1')
+        assert exc.value.reason == hap_admission.REJECT_BACKOFF
+        assert exc.value.retry_delay == 2
+        admission.acquire('10.0.0.2')
+    with patch('pyhap.hap_admission.time.monotonic', return_value=102):
+        admission.acquire('10.0.0.1')
+        with pytest.raises(hap_admission.HandshakeRejected):
+            admission.acquire('10.0.0.1')
+    assert admission.stats()['rejected_backoff'] == 2
+
+
+def test_tracked_addresses_are_bounded():
+    admission = hap_admission.HandshakeAdmission(max_concurrent=None)
+    for i in range(hap_admission.MAX_TRACKED_ADDRESSES + 10):
+        admission.acquire('10.0.{}.{}'.format(i // 256, i % 256))
+    assert len(admission.buckets) == hap_admission.MAX_TRACKED_ADDRESSES
+    assert '10.0.0.0' not in admission.buckets
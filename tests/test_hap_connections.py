@@ -0,0 +1,163 @@
+"""Tests for pyhap.hap_connections."""
+import json
+import socket
+import threading
+from unittest.mock import Mock
+
+import pytest
+
+from pyhap import hap_connections
+
+CLIENT = ('127.0.0.1', 5555)
+OTHER_CLIENT = ('127.0.0.1', 5556)
+
+
+def test_add_remove():
+    on_remove = Mock()
+    registry = hap_connections.ConnectionRegistry(max_connections=1,
+                                                  on_remove=on_remove)
+    conn, other_conn = object(), object()
+    assert registry.add(CLIENT, conn)
+    assert not registry.add(OTHER_CLIENT, other_conn)
+    assert registry[CLIENT] is conn and OTHER_CLIENT not in registry
+
+    registry.replace(CLIENT, other_conn, encrypted=True)
+    assert registry.stats() == {'live': 1, 'encrypted': 1, 'reaped': 0, 'rejected': 1}
+
+    assert registry.remove(CLIENT, conn) is None
+    on_remove.assert_not_called()
+    assert registry.remove(CLIENT) is other_conn
+    on_remove.assert_called_once_with(CLIENT)
+    assert len(registry) == 0
+    assert registry.stats()['encrypted'] == 0
+
+
+def test_reap_idle():
+    registry = hap_connections.ConnectionRegistry(idle_timeout=10)
+    conn, other_conn = object(), object()
+    registry.add(CLIENT, conn)
+    registry.add(OTHER_CLIENT, other_conn)
+    now = registry.last_active[CLIENT]
+    registry.last_active[CLIENT] -= 11
+
+    assert registry.reap_idle(now) == [(CLIENT, conn)]
+    assert registry.reap_idle(now) == []  # only once
+    assert registry.reap_idle(now + 11) == [(OTHER_CLIENT, other_conn)]
+    assert registry.stats()['reaped'] == 2
+    assert len(registry.clear()) == 2
+
+    assert hap_connections.ConnectionRegistry().reap_idle(now + 1000) == []
+
+
+def test_set_keepalive():
+    sock = socket.socket()
+    with sock:
+        hap_connections.set_keepalive(sock)
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+
+
+def _payload(*chars):
+    return json.dumps({'characteristics': [
+        {'aid': 1, 'iid': iid, 'value': value} for iid, value in chars]}).encode()
+
+
+def test_coalesce_events():
+    merged = hap_connections.coalesce_events(
+        [_payload((9, 1), (10, 1)), _payload((9, 2)), _payload((11, 3))])
+    assert json.loads(merged.decode())['characteristics'] == [
+        {'aid': 1, 'iid': 10, 'value': 1}, {'aid': 1, 'iid': 9, 'value': 2},
+        {'aid': 1, 'iid': 11, 'value': 3}]
+
+
+def test_slow_consumer_policy():
+    with pytest.raises(ValueError):
+        hap_connections.SlowConsumerPolicy('ignore')
+
+    policy = hap_connections.SlowConsumerPolicy(
+        hap_connections.SLOW_CONSUMER_DROP, max_events=2)
+    backlog = hap_connections.EventBacklog(policy)
+    callbacks = [Mock() for _ in range(4)]
+    for value in range(4):
+        assert backlog.put(_payload((9, value)), callbacks[value])
+    assert backlog.pop_all() == ([_payload((9, 2)), _payload((9, 3))], callbacks[2:])
+    assert len(backlog) == 0 and backlog.nbytes == 0
+    callbacks[0].assert_called_once_with(False)  # dropped
+    callbacks[2].assert_not_called()  # up to the writer
+
+    policy = hap_connections.SlowConsumerPolicy(
+        hap_connections.SLOW_CONSUMER_COALESCE, max_events=2)
+    backlog = hap_connections.EventBacklog(policy)
+    on_written = Mock()
+    for iid, value in ((9, 1), (10, 1), (9, 2)):
+        assert backlog.put(_payload((iid, value)), on_written)
+    assert backlog.pop_all() == ([_payload((10, 1), (9, 2))], [on_written] * 3)
+
+    policy = hap_connections.SlowConsumerPolicy(
+        hap_connections.SLOW_CONSUMER_DISCONNECT, max_events=None, max_bytes=100)
+    backlog = hap_connections.EventBacklog(policy)
+    assert backlog.put(_payload((9, 1)))
+    assert not backlog.put(_payload((9, 2), (10, 2)), on_written)
+    backlog.clear()
+    on_written.assert_called_once_with(False)
+    policy.evict(CLIENT)
+    policy.evict(CLIENT, timed_out=True)
+    assert policy.stats() == {'evicted': 1, 'timed_out': 1, 'dropped': 0,
+                              'coalesced': 0}
+
+
+def test_event_writer():
+    sent = []
+    release = threading.Event()
+
+    def send(events):
+        release.wait(5)
+        if b'fail' in events:
+            raise OSError('broken pipe')
+        sent.extend(events)
+
+    on_error, on_written = Mock(), Mock()
+    writer = hap_connections.EventWriter(CLIENT, send, on_error)
+    assert writer.put(b'1', on_written)
+    assert writer.thread.name == 'EventWriter-127.0.0.1:5555'
+    release.set()
+    writer.thread.join(0.2)
+    assert sent == [b'1']
+    on_written.assert_called_once_with(True)
+    release.clear()
+    on_written.reset_mock()
+    assert writer.put(b'2') and writer.put(b'fail', on_written)
+    release.set()
+    writer.thread.join(5)
+    assert isinstance(on_error.call_args[0][0], OSError)
+    on_written.assert_called_once_with(False)
+    assert not writer.put(b'3')
+
+    writer = hap_connections.EventWriter(CLIENT, sent.extend, on_error)
+    writer.put(b'4')
+    writer.close()
+    writer.thread.join(5)
+    assert sent[-1] == b'4' and not writer.put(b'5')
+
+
+def test_event_writer_in_pool():
+    tasks, sent = [], []
+    writer = hap_connections.EventWriter(CLIENT, sent.append, Mock(), submit=tasks.append)
+    assert writer.thread is None
+    assert writer.put(b'1') and writer.put(b'2')
+    assert len(tasks) == 1  # one drain task at a time
+    tasks.pop()()
+    assert sent == [[b'1', b'2']] and not writer.draining
+    assert writer.put(b'3') and len(tasks) == 1
+
+
+def test_attach():
+    registry = hap_connections.ConnectionRegistry()
+    attached = Mock()
+    assert registry.attach(CLIENT, Mock) is None  # not connected
+    registry.add(CLIENT, 'socket')
+    assert registry.attach(CLIENT, lambda: attached) is attached
+    assert registry.attach(CLIENT, Mock) is attached
+    assert registry.attachments() == {CLIENT: attached}
+    registry.remove(CLIENT)
+    attached.close.assert_called_once_with()
+    assert registry.attach(CLIENT, Mock) is None and not registry.attached
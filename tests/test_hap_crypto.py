@@ -0,0 +1,170 @@
+"""Tests for pyhap.hap_crypto."""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import struct
+
+import ed25519
+import pytest
+
+import pyhap.hap_crypto as hap_crypto
+
+PROVIDERS = list(hap_crypto.PROVIDERS.values())
+
+
+@pytest.fixture(params=PROVIDERS, ids=[p.name for p in PROVIDERS])
+def provider(request):
+    yield request.param
+
+
+def test_aead_roundtrip(provider):
+    key = os.urandom(32)
+    nonce = hap_crypto.pad_tls_nonce(b'\x01')
+    sealed = provider.aead(key).seal(nonce, b'data', b'aad')
+    assert len(sealed) == 4 + hap_crypto.TAG_LENGTH
+    assert provider.aead(key).open(nonce, memoryview(sealed), b'aad') == b'data'
+    assert provider.aead(key).open(nonce, sealed, b'other') is None
+
+
+def test_providers_interoperate(provider):
+    key = os.urandom(32)
+    nonce = hap_crypto.pad_tls_nonce(b'PV-Msg02')
+    default = hap_crypto.CryptoProvider
+    sealed = default.aead(key).seal(nonce, b'message', b'')
+    assert provider.aead(key).seal(nonce, b'message', b'') == sealed
+    assert provider.hkdf(key, b'salt', b'info') == default.hkdf(key, b'salt', b'info')
+
+
+def test_x25519(provider):
+    priv_a, pub_a = provider.x25519_generate()
+    priv_b, pub_b = hap_crypto.CryptoProvider.x25519_generate()
+    assert len(pub_a) == 32
+    assert provider.x25519_exchange(priv_a, pub_b) == \
+        hap_crypto.CryptoProvider.x25519_exchange(priv_b, pub_a)
+
+
+def test_ed25519(provider):
+    signing_key, verifying_key = ed25519.create_keypair()
+    signature = provider.ed25519_sign(signing_key, b'material')
+    assert signature == signing_key.sign(b'material')
+    assert provider.ed25519_verify(verifying_key.to_bytes(), signature, b'material')
+    assert not provider.ed25519_verify(verifying_key.to_bytes(), signature, b'other')
+
+
+def test_set_provider():
+    original = hap_crypto.get_provider()
+    try:
+        hap_crypto.set_provider(hap_crypto.BACKEND_PYTHON)
+        assert hap_crypto.get_provider() is hap_crypto.CryptoProvider
+        with pytest.raises(ValueError):
+            hap_crypto.set_provider('unknown')
+    finally:
+        hap_crypto.set_provider(original.name)
+
+
+def test_keypool_hits_and_misses():
+    executor = ThreadPoolExecutor(1)
+    pool = hap_crypto.X25519KeyPool(size=2, executor=executor)
+    private_key, public_key = pool.take()  # empty, generated inline
+    assert len(public_key) == 32
+    executor.submit(lambda: None).result()  # wait for the refill
+    assert len(pool) == 2
+    first, second = pool.take(), pool.take()
+    assert first[1] != second[1]
+    assert pool.stats() == {'available': len(pool), 'hits': 2, 'misses': 1}
+    pool.close()
+    assert len(pool) == 0
+    pool.take()
+    assert len(pool) == 0
+    executor.shutdown()
+
+
+def test_keypool_drops_keys_of_other_provider():
+    original = hap_crypto.get_provider()
+    if original is hap_crypto.CryptoProvider:
+        pytest.skip('only the default provider is installed')
+    executor = ThreadPoolExecutor(1)
+    pool = hap_crypto.X25519KeyPool(size=1, executor=executor)
+    pool.refill()
+    executor.shutdown()
+    try:
+        hap_crypto.set_provider(hap_crypto.BACKEND_PYTHON)
+        private_key, public_key = pool.take()
+        other_private, other_public = hap_crypto.CryptoProvider.x25519_generate()
+        assert hap_crypto.CryptoProvider.x25519_exchange(private_key, other_public) == \
+            hap_crypto.CryptoProvider.x25519_exchange(other_private, public_key)
+        assert pool.stats()['misses'] == 1
+    finally:
+        hap_crypto.set_provider(original.name)
+
+
+def _seal_frames(cipher, data, block=0x400):
+    frames = b''
+    for count, offset in enumerate(range(0, len(data), block)):
+        chunk = data[offset:offset + block]
+        length = struct.pack('H', len(chunk))
+        nonce = hap_crypto.pad_tls_nonce(struct.pack('Q', count))
+        frames += length + cipher.seal(nonce, chunk, length)
+    return frames
+
+
+def test_frame_decoder_partial_frames():
+    cipher = hap_crypto.get_provider().aead(os.urandom(32))
+    data = os.urandom(5000)
+    frames = _seal_frames(cipher, data)
+    decoder = hap_crypto.HAPFrameDecoder(cipher)
+
+    out = bytearray()
+    buffer = bytearray(700)
+    for offset in range(0, len(frames), 333):
+        decoder.feed(frames[offset:offset + 333])
+        while True:
+            read = decoder.read_into(buffer)
+            if not read:
+                break
+            out += buffer[:read]
+    assert out == data
+    assert decoder.pending == 0
+
+
+def test_frame_decoder_receive_into_buffer():
+    cipher = hap_crypto.get_provider().aead(os.urandom(32))
+    data = os.urandom(3 * hap_crypto.HAPFrameDecoder.BUFFER_SIZE)
+    frames = _seal_frames(cipher, data, block=0x1000)
+    decoder = hap_crypto.HAPFrameDecoder(cipher)
+
+    out = bytearray(len(data))
+    written = 0
+    while frames:
+        buffer = decoder.get_buffer()
+        nbytes = min(len(buffer), len(frames))
+        buffer[:nbytes] = frames[:nbytes]
+        decoder.buffer_updated(nbytes)
+        frames = frames[nbytes:]
+        written += decoder.read_into(memoryview(out)[written:])
+    assert written == len(data)
+    assert out == data
+
+
+def test_frame_decoder_rejects_tampered_frame():
+    cipher = hap_crypto.get_provider().aead(os.urandom(32))
+    frames = bytearray(_seal_frames(cipher, b'payload'))
+    frames[-1] ^= 1
+    decoder = hap_crypto.HAPFrameDecoder(cipher)
+    decoder.feed(frames)
+    with pytest.raises(ValueError):
+        decoder.read_into(bytearray(10))
+
+
+def test_frame_encoder_roundtrip():
+    cipher = hap_crypto.get_provider().aead(os.urandom(32))
+    encoder = hap_crypto.HAPFrameEncoder(cipher)
+    decoder = hap_crypto.HAPFrameDecoder(cipher)
+    buffers = [b'HTTP/1.1 200 OK\r\n\r\n', os.urandom(3000), b'', os.urandom(1024)]
+
+    frames = encoder.encrypt(buffers)
+    frames += encoder.encrypt([b'second'])
+    decoder.feed(frames)
+    out = bytearray(5000)
+    read = decoder.read_into(out)
+    assert out[:read] == b''.join(buffers) + b'second'
+    assert len(frames) == read + 5 * (2 + hap_crypto.TAG_LENGTH)
@@ -0,0 +1,86 @@
+"""Tests for pyhap.hap_events."""
+import asyncio
+
+import pytest
+
+from pyhap import hap_events
+
+CLIENT = ('127.0.0.1', 5555)
+OTHER_CLIENT = ('127.0.0.1', 5556)
+
+
+def test_latest_value_queue():
+    events = hap_events.LatestValueQueue()
+    events.put(((1, 9), b'1', None, 1))
+    events.put(((1, 10), b'2', None, 1))
+    events.put(((1, 9), b'3', CLIENT, 1))
+    assert len(events) == 2
+    assert events.get() == ((1, 9), b'3', CLIENT, 1)
+    assert events.get() == ((1, 10), b'2', None, 1)
+    assert events.stats() == {'queued': [0, 0, 0], 'superseded': 1}
+    assert not events
+    with pytest.raises(IndexError):
+        events.get()
+
+
+def test_latest_value_queue_priorities():
+    events = hap_events.LatestValueQueue()
+    for iid in range(10):
+        events.put(((1, iid), b'', None, 2))
+    events.put(((1, 20), b'', None, 1))
+    events.put(((1, 30), b'', None, 0))
+    events.put(((1, 5), b'', None, 0))  # moves to the higher priority
+    assert events.stats()['queued'] == [2, 1, 9]
+    assert [events.get()[0] for _ in range(4)] \
+        == [(1, 30), (1, 5), (1, 20), (1, 0)]
+
+
+def test_latest_value_queue_without_superseding():
+    events = hap_events.LatestValueQueue()
+    events.put(((1, 9), b'0', None, 0), supersede=False)
+    events.put(((1, 10), b'1', None, 1))
+    events.put(((1, 9), b'2', None, 0), supersede=False)
+    assert len(events) == 3 and events.unsuperseded == 2
+    assert events.peek() == ((1, 9), b'0', None, 0)
+    assert [events.get()[1] for _ in range(3)] == [b'0', b'2', b'1']
+    assert events.stats() == {'queued': [0, 0, 0], 'superseded': 0}
+    assert events.unsuperseded == 0
+    with pytest.raises(IndexError):
+        events.peek()
+
+
+def test_subscription_registry():
+    registry = hap_events.SubscriptionRegistry()
+    registry.subscribe(CLIENT, (1, 9))
+    registry.subscribe(CLIENT, (1, 10))
+    registry.subscribe(OTHER_CLIENT, (1, 10))
+    snapshot = registry.get((1, 10))
+    assert snapshot == {CLIENT, OTHER_CLIENT}
+
+    registry.subscribe(OTHER_CLIENT, (1, 10), False)
+    registry.subscribe(OTHER_CLIENT, (1, 11), False)  # not subscribed
+    assert snapshot == {CLIENT, OTHER_CLIENT}  # readers keep their snapshot
+    assert registry.get((1, 10)) == {CLIENT}
+    assert OTHER_CLIENT not in registry.clients
+
+    registry.unsubscribe_client(CLIENT)
+    registry.unsubscribe_client(CLIENT)
+    assert len(registry) == 0 and not registry.clients
+    assert (1, 9) not in registry and registry.get((1, 9)) == frozenset()
+
+
+def test_event_delivery():
+    loop = asyncio.new_event_loop()
+    futures = [loop.create_future(), loop.create_future()]
+    futures[1].cancel()
+    delivery = hap_events.EventDelivery(futures, {CLIENT, OTHER_CLIENT})
+    delivery.written(CLIENT, True)
+    assert not futures[0].done()
+    delivery.written(OTHER_CLIENT, False)
+    delivery.written(OTHER_CLIENT, True)  # only the first outcome counts
+    assert futures[0].result() is False
+
+    future = loop.create_future()
+    hap_events.EventDelivery([future], ())
+    assert future.result() is True
+    loop.close()
@@ -0,0 +1,50 @@
+"""Tests for pyhap.hap_http."""
+import io
+
+import pytest
+
+from pyhap import hap_http
+
+
+def test_parse_request_line():
+    assert hap_http.parse_request_line(b'GET /characteristics?id=1.9 HTTP/1.1\r\n') \
+        == ('GET', '/characteristics?id=1.9', 'HTTP/1.1')
+
+    for line, status in ((b'GET /accessories\r\n', 400),
+                         (b'GET /accessories HTTP/1.x\r\n', 400),
+                         (b'GET /accessories HTTP/\xb2.0\r\n', 400),
+                         (b'GET /accessories HTTP/2.0\r\n', 505)):
+        with pytest.raises(hap_http.HTTPParseError) as exc_info:
+            hap_http.parse_request_line(line)
+        assert exc_info.value.status == status
+
+
+def test_read_headers():
+    rfile = io.BytesIO(b'Host: x\r\ncontent-LENGTH:  12 \r\n\r\nbody')
+    headers = hap_http.read_headers(rfile)
+    assert headers['Content-Length'] == '12'
+    assert headers.get('content-length') == '12'
+    assert 'HOST' in headers
+    assert hap_http.content_length(headers) == 12
+    assert rfile.read() == b'body'
+
+    assert hap_http.content_length(hap_http.Headers()) == 0
+    for value in (b'-1', b'\xb2', b''):
+        with pytest.raises(hap_http.HTTPParseError) as exc_info:
+            hap_http.content_length(hap_http.read_headers(
+                io.BytesIO(b'Content-Length: ' + value + b'\r\n\r\n')))
+        assert exc_info.value.status == 400
+    with pytest.raises(hap_http.HTTPParseError):
+        hap_http.read_headers(io.BytesIO(b'Bad header\r\n\r\n'))
+    with pytest.raises(hap_http.HTTPParseError) as exc_info:
+        hap_http.read_headers(io.BytesIO(b'X: y\r\n' * (hap_http.MAX_HEADERS + 1)))
+    assert exc_info.value.status == 431
+
+
+def test_parse_char_ids():
+    assert hap_http.parse_char_ids('id=1.9,2.10') == [(1, 9), (2, 10)]
+    assert hap_http.parse_char_ids('meta=1&id=1.9%2C3.4&ev=1') == [(1, 9), (3, 4)]
+    with pytest.raises(ValueError):
+        hap_http.parse_char_ids('ev=1')
+    with pytest.raises(ValueError):
+        hap_http.parse_char_ids('id=1.x')
@@ -0,0 +1,351 @@
+"""Tests for pyhap.hap_protocol."""
+import asyncio
+import hashlib
+import json
+import os
+import time
+import uuid
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap import (
+    hap_admission, hap_connections, hap_protocol, hap_sessions, hap_workers, hsrp, tlv)
+from pyhap.hap_server import HAP_SERVER_STATUS, HAPServerHandler
+from pyhap.params import HAP_SRP_PARAMS, get_srp_context
+from pyhap.util import long_to_bytes
+
+CLIENT = ('127.0.0.1', 5555)
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def server():
+    driver = MagicMock()
+    driver.state.paired = True
+    yield hap_protocol.AsyncHAPServer(('127.0.0.1', 0), driver)
+
+
+def _connect(loop, server, client=CLIENT):
+    transport = MagicMock()
+    transport.get_extra_info.side_effect = {'peername': client}.get
+    transport.is_closing.return_value = False
+    protocol = hap_protocol.HAPServerProtocol(loop, server, server.accessory_handler)
+    protocol.connection_made(transport)
+    return protocol, transport
+
+
+def _wait_idle(loop, protocol):
+    async def _wait():
+        while protocol.handling:
+            await asyncio.sleep(0.01)
+    loop.run_until_complete(_wait())
+
+
+def _written(transport):
+    data = b''
+    for call in transport.writelines.call_args_list:
+        data += b''.join(call[0][0])
+    return data
+
+
+def test_unencrypted_request_is_unauthorized(loop, server):
+    protocol, transport = _connect(loop, server)
+    assert server.connections[CLIENT] is protocol
+
+    protocol.data_received(b'GET /accessories HTTP/1.1\r\nHost: x\r\n')
+    assert not protocol.handling
+    protocol.data_received(b'\r\n')
+    _wait_idle(loop, protocol)
+
+    head, body = _written(transport).split(b'\r\n\r\n', 1)
+    assert head.startswith(b'HTTP/1.0 401')
+    assert json.loads(body.decode()) == {
+        'status': HAP_SERVER_STATUS.INSUFFICIENT_PRIVILEGES}
+    server.accessory_handler.get_accessories.assert_not_called()
+
+    protocol.connection_lost(None)
+    assert CLIENT not in server.connections
+    server.accessory_handler.unsubscribe_client.assert_called_once_with(CLIENT)
+
+
+def test_requests_are_handled_in_order(loop, server):
+    protocol, transport = _connect(loop, server)
+    request = b'PUT /characteristics HTTP/1.1\r\nContent-Length: 2\r\n\r\n{}'
+    protocol.data_received(request * 2)
+    _wait_idle(loop, protocol)
+    _wait_idle(loop, protocol)
+    assert _written(transport).count(b' 401 ') == 2
+
+
+def test_bad_request_closes_connection(loop, server):
+    protocol, transport = _connect(loop, server)
+    protocol.data_received(b'GET /accessories HTTP/1.x\r\n\r\n')
+    assert b'400' in _written(transport)
+    transport.close.assert_called_once_with()
+
+
+def test_bad_request_after_response(loop, server):
+    protocol, transport = _connect(loop, server)
+    protocol.data_received(b'GET /accessories HTTP/1.1\r\n\r\n')
+    _wait_idle(loop, protocol)
+    assert _written(transport).startswith(b'HTTP/1.0 401')
+    transport.writelines.reset_mock()
+
+    protocol.data_received(b'BOGUS\r\n\r\n')
+    written = _written(transport)
+    assert b'400' in written and b'401' not in written  # without the old response
+    transport.close.assert_called_once_with()
+
+
+def test_push_event(loop, server):
+    server.loop = loop
+    assert not server.push_event(b'{}', CLIENT)
+    protocol, transport = _connect(loop, server)
+    assert server.push_event(b'{}', CLIENT)
+    loop.run_until_complete(asyncio.sleep(0))
+    assert _written(transport).startswith(b'EVENT/1.0 200 OK\r\n')
+    assert _written(transport).endswith(b'Content-Length: 2\r\n\r\n{}')
+
+
+def test_events_wait_for_paused_transport(loop, server):
+    server.loop = loop
+    protocol, transport = _connect(loop, server)
+    other, other_transport = _connect(loop, server, ('127.0.0.1', 5556))
+    protocol.pause_writing()
+    for _ in range(3):
+        assert server.push_event(b'{}', CLIENT)
+        assert server.push_event(b'{}', ('127.0.0.1', 5556))
+    loop.run_until_complete(asyncio.sleep(0))
+    transport.writelines.assert_not_called()
+    assert other_transport.writelines.call_count == 1
+    assert _written(other_transport).count(b'EVENT/1.0') == 3
+    assert server.event_queue_depths() == {CLIENT: 3, ('127.0.0.1', 5556): 0}
+
+    protocol.resume_writing()
+    assert transport.writelines.call_count == 1
+    assert _written(transport).count(b'EVENT/1.0') == 3
+    assert server.event_queue_depths()[CLIENT] == 0
+
+
+def test_slow_consumers_are_evicted(loop):
+    slow_consumer = hap_connections.SlowConsumerPolicy(
+        hap_connections.SLOW_CONSUMER_DISCONNECT, max_events=2, send_timeout=0.01)
+    server = hap_protocol.AsyncHAPServer(('127.0.0.1', 0), MagicMock(),
+                                         slow_consumer=slow_consumer)
+    server.loop = loop
+    protocol, transport = _connect(loop, server)
+    protocol.pause_writing()
+    protocol.resume_writing()
+    protocol.pause_writing()
+    loop.run_until_complete(asyncio.sleep(0.05))
+    transport.abort.assert_called_once_with()
+    assert slow_consumer.stats()['timed_out'] == 1
+
+    protocol, transport = _connect(loop, server, ('127.0.0.1', 5556))
+    protocol.pause_writing()
+    assert server.push_event(b'{}', ('127.0.0.1', 5556))
+    assert server.push_event(b'{}', ('127.0.0.1', 5556))
+    assert not server.push_event(b'{}', ('127.0.0.1', 5556))
+    loop.run_until_complete(asyncio.sleep(0))
+    transport.abort.assert_called_once_with()
+    assert slow_consumer.stats()['evicted'] == 1
+    protocol.connection_lost(None)
+
+
+def test_unknown_path_is_not_found(loop, server):
+    protocol, transport = _connect(loop, server)
+    protocol.data_received(b'GET /unknown HTTP/1.1\r\n\r\n')
+    _wait_idle(loop, protocol)
+    assert _written(transport).startswith(b'HTTP/1.0 404')
+
+
+def test_max_connections(loop):
+    server = hap_protocol.AsyncHAPServer(('127.0.0.1', 0), MagicMock(),
+                                         max_connections=1)
+    _connect(loop, server)
+    protocol, transport = _connect(loop, server, ('127.0.0.1', 5556))
+    transport.close.assert_called_once_with()
+    protocol.data_received(b'GET /accessories HTTP/1.1\r\n\r\n')
+    protocol.connection_lost(None)
+    assert CLIENT in server.connections
+    assert server.connections.stats()['rejected'] == 1
+
+
+def test_idle_connections_are_reaped(loop):
+    server = hap_protocol.AsyncHAPServer(('127.0.0.1', 0), MagicMock(),
+                                         idle_timeout=0)
+    server.REAP_INTERVAL = 0.01
+    loop.run_until_complete(server.async_start(loop))
+    _, transport = _connect(loop, server)
+    loop.run_until_complete(asyncio.sleep(0.05))
+    transport.close.assert_called_once_with()
+    assert server.connections.stats()['reaped'] == 1
+    loop.run_until_complete(server.async_stop())
+
+
+def test_pair_resume(loop, server):
+    provider = hap_crypto.get_provider()
+    client_uuid = uuid.uuid4()
+    shared_key, session_id = os.urandom(32), os.urandom(8)
+    driver = server.accessory_handler
+    driver.state.paired_clients = {client_uuid: b'public key'}
+    driver.session_cache = hap_sessions.SessionCache()
+    driver.session_cache.add(session_id, shared_key, client_uuid)
+
+    _, client_public = provider.x25519_generate()
+    request_key = provider.hkdf(shared_key, client_public + session_id,
+                                HAPServerHandler.PRESUME_1_INFO)
+    proof = provider.aead(request_key).seal(HAPServerHandler.PRESUME_1_NONCE, b'', b'')
+    body = tlv.encode(b'\x06', b'\x01', b'\x00', b'\x06', b'\x03', client_public,
+                      b'\x0e', session_id, b'\x05', proof)
+
+    protocol, transport = _connect(loop, server)
+    protocol.data_received(b'POST /pair-verify HTTP/1.1\r\nContent-Length: %d\r\n\r\n'
+                           % len(body) + body)
+    _wait_idle(loop, protocol)
+
+    response = tlv.decode(_written(transport).split(b'\r\n\r\n', 1)[1])
+    assert response[b'\x00'] == b'\x06'
+    new_session_id = response[b'\x0e']
+    response_key = provider.hkdf(shared_key, client_public + new_session_id,
+                                 HAPServerHandler.PRESUME_2_INFO)
+    assert provider.aead(response_key).open(
+        HAPServerHandler.PRESUME_2_NONCE, response[b'\x05'], b'') == b''
+    assert protocol.encoder is not None
+    assert driver.session_cache.pop(session_id) is None
+    assert driver.session_cache.pop(new_session_id)[1] == client_uuid
+    assert driver.session_cache.stats()['hits'] == 1
+
+
+def test_pair_resume_bad_proof_keeps_session(server):
+    client_uuid = uuid.uuid4()
+    shared_key, session_id = os.urandom(32), os.urandom(8)
+    driver = server.accessory_handler
+    driver.state.paired_clients = {client_uuid: b'public key'}
+    driver.session_cache = hap_sessions.SessionCache()
+    driver.session_cache.add(session_id, shared_key, client_uuid)
+
+    _, client_public = hap_crypto.get_provider().x25519_generate()
+    handler = hap_protocol.AsyncHAPServerHandler(CLIENT, server, driver)
+    assert not handler._pair_resume({b'\x03': client_public, b'\x0e': session_id,
+                                     b'\x05': os.urandom(16)})
+    assert driver.session_cache.get(session_id) == (shared_key, client_uuid)
+    assert driver.session_cache.stats()['misses'] == 1
+
+
+def test_handshake_backoff(loop, server):
+    driver = server.accessory_handler
+    driver.handshake_admission = hap_admission.HandshakeAdmission(rate=1, burst=0)
+    body = tlv.encode(b'\x06', b'\x01', b'\x03', os.urandom(32))
+
+    protocol, transport = _connect(loop, server)
+    protocol.data_received(b'POST /pair-verify HTTP/1.1\r\nContent-Length: %d\r\n\r\n'
+                           % len(body) + body)
+    _wait_idle(loop, protocol)
+
+    response = tlv.decode(_written(transport).split(b'\r\n\r\n', 1)[1])
+    assert response == {b'\x06': b'\x02', b'\x07': b'\x03', b'\x08': b'\x01'}
+    driver.keypair_pool.take.assert_not_called()
+    assert driver.handshake_admission.stats()['active'] == 0
+
+
+def _pair_setup_step(handler, body):
+    head = b'POST /pair-setup HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body)
+    assert handler.parse_head(head)
+    return tlv.decode(b''.join(handler.handle_request(body)).split(b'\r\n\r\n', 1)[1])
+
+
+def _srp_m3(m2, pincode=b'123-45-678'):
+    """Return the M3 request of a controller, computed from the M2 response."""
+    ctx = get_srp_context(*HAP_SRP_PARAMS)
+    N, g, salt = ctx['N'], ctx['g'], m2[b'\x02']
+    B = hsrp.bytes_to_long(m2[b'\x03'])
+    a = hsrp.bytes_to_long(os.urandom(32))
+    A = pow(g, a, N)
+    x = hsrp.get_x(b'Pair-Setup', pincode, salt, ctx)
+    u = hsrp.bytes_to_long(hashlib.sha512(
+        hsrp.padN(long_to_bytes(A), ctx) + hsrp.padN(long_to_bytes(B), ctx)).digest())
+    K = hsrp.get_session_key(pow((B - ctx['k'] * pow(g, x, N)) % N, a + u * x, N), ctx)
+    M = hashlib.sha512(ctx['group_hash'] + hashlib.sha512(b'Pair-Setup').digest() + salt
+                       + long_to_bytes(A) + long_to_bytes(B) + long_to_bytes(K)).digest()
+    return tlv.encode(b'\x06', b'\x03', b'\x03', long_to_bytes(A), b'\x04', M)
+
+
+@pytest.fixture
+def unpaired_driver(server):
+    driver = server.accessory_handler
+    driver.state.paired = False
+    driver.crypto_pool = None
+    driver.handshake_admission = hap_admission.HandshakeAdmission()
+    driver.new_srp_verifier.side_effect = \
+        lambda: hap_workers.create_srp_verifier(b'123-45-678')
+    yield driver
+
+
+def test_concurrent_pair_setups(server, unpaired_driver):
+    handlers = [hap_protocol.AsyncHAPServerHandler(('127.0.0.1', port), server,
+                                                   unpaired_driver)
+                for port in (5555, 5556)]
+    m2s = [_pair_setup_step(handler, tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01'))
+           for handler in handlers]
+    for handler, m2 in zip(handlers, m2s):
+        m4 = _pair_setup_step(handler, _srp_m3(m2))
+        assert m4[b'\x06'] == b'\x04' and b'\x04' in m4 and b'\x07' not in m4
+
+
+def test_full_cap_finishes_pair_setup(server, unpaired_driver):
+    unpaired_driver.handshake_admission = hap_admission.HandshakeAdmission(
+        max_concurrent=1)
+    handler = hap_protocol.AsyncHAPServerHandler(CLIENT, server, unpaired_driver)
+    m2 = _pair_setup_step(handler, tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01'))
+    unpaired_driver.handshake_admission.acquire('10.0.0.2')  # fills the cap
+    m4 = _pair_setup_step(handler, _srp_m3(m2))
+    assert m4[b'\x06'] == b'\x04' and b'\x04' in m4 and b'\x07' not in m4
+
+
+def test_full_cap_rejects_continuation_without_handshake(server, unpaired_driver):
+    unpaired_driver.handshake_admission = hap_admission.HandshakeAdmission(
+        max_concurrent=1)
+    handler = hap_protocol.AsyncHAPServerHandler(CLIENT, server, unpaired_driver)
+    unpaired_driver.handshake_admission.acquire('10.0.0.2')  # fills the cap
+    # Labelled M3, but no pair setup was started on the connection.
+    m4 = _pair_setup_step(handler, tlv.encode(b'\x06', b'\x03', b'\x03', b'\x01',
+                                              b'\x04', b'\x01'))
+    assert m4[b'\x06'] == b'\x04' and m4[b'\x07'] == b'\x07'  # Busy
+
+
+def test_pair_setup_expires(server, unpaired_driver):
+    handler = hap_protocol.AsyncHAPServerHandler(CLIENT, server, unpaired_driver)
+    m2 = _pair_setup_step(handler, tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01'))
+    expired = time.monotonic() + HAPServerHandler.PAIR_SETUP_TIMEOUT + 1
+    with patch('pyhap.hap_server.time.monotonic', return_value=expired):
+        m4 = _pair_setup_step(handler, _srp_m3(m2))
+    assert m4[b'\x07'] == b'\x02'
+    assert handler.srp_verifier is None
+
+
+def test_abandoned_pair_setup_is_evicted(server, unpaired_driver):
+    handler = hap_protocol.AsyncHAPServerHandler(CLIENT, server, unpaired_driver)
+    _pair_setup_step(handler, tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01'))
+    unpaired_driver.call_later.assert_called_once_with(
+        HAPServerHandler.PAIR_SETUP_TIMEOUT, handler._expire_pair_setup)
+    unpaired_driver.call_later.call_args[0][1]()
+    assert handler.srp_verifier is None
+
+
+def test_pair_setup_eviction_is_cancelled_on_close(loop, server, unpaired_driver):
+    protocol, _ = _connect(loop, server)
+    _pair_setup_step(protocol.handler,
+                     tlv.encode(b'\x00', b'\x00', b'\x06', b'\x01'))
+    protocol.connection_lost(None)
+    assert protocol.handler.srp_verifier is None
+    unpaired_driver.cancel_call_later.assert_called_once_with(
+        protocol.handler._expire_pair_setup)
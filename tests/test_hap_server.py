@@ -0,0 +1,233 @@
+"""Tests for pyhap.hap_server."""
+import os
+import socket
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap import hap_server
+
+
+def _client_ciphers(shared_key):
+    """Return the (outbound, inbound) ciphers of the controller side."""
+    provider = hap_crypto.get_provider()
+    salt = hap_server.HAPSocket.CIPHER_SALT
+    out_key = provider.hkdf(shared_key, salt, hap_server.HAPSocket.IN_CIPHER_INFO)
+    in_key = provider.hkdf(shared_key, salt, hap_server.HAPSocket.OUT_CIPHER_INFO)
+    return provider.aead(out_key), provider.aead(in_key)
+
+
+def _recv_exactly(sock, length):
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        assert chunk
+        data += chunk
+    return data
+
+
+def test_send_buffers_plain_socket():
+    server, client = socket.socketpair()
+    with server, client:
+        hap_server.send_buffers(server, [b'head', b'', bytearray(b'er'), b'body' * 10])
+        assert _recv_exactly(client, 46) == b'header' + b'body' * 10
+
+
+def test_hap_socket_roundtrip():
+    shared_key = os.urandom(32)
+    server, client = socket.socketpair()
+    hap_socket = hap_server.HAPSocket(server, shared_key)
+    client_out, client_in = _client_ciphers(shared_key)
+    payload = os.urandom(5000)
+
+    with hap_socket, client:
+        client.sendall(hap_crypto.HAPFrameEncoder(client_out).encrypt([payload]))
+        assert hap_socket.makefile('rb').read(len(payload)) == payload
+
+        sender = threading.Thread(
+            target=hap_server.send_buffers, args=(hap_socket, [b'x' * 10, payload]))
+        sender.start()
+        decoder = hap_crypto.HAPFrameDecoder(client_in)
+        frames = 5010 // 1024 + 1
+        decoder.feed(_recv_exactly(client, 5010 + frames * (2 + hap_crypto.TAG_LENGTH)))
+        sender.join()
+        out = bytearray(5010)
+        assert decoder.read_into(out) == 5010
+        assert bytes(out) == b'x' * 10 + payload
+
+
+def test_send_within_times_out():
+    server, client = socket.socketpair()
+    with server, client:
+        hap_server.send_within(server, b'x' * 100, 1)
+        assert _recv_exactly(client, 100) == b'x' * 100
+        server.setblocking(True)
+        with pytest.raises(socket.timeout):
+            hap_server.send_within(server, b'x' * 0x1000000, 0.05)
+        assert server.gettimeout() is None
+
+
+def _start_pooled_server(**kwargs):
+    driver = MagicMock()
+    driver.state.paired = True
+    server = hap_server.HAPServer(('127.0.0.1', 0), driver, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,))
+    thread.start()
+    return server, thread
+
+
+def _stop_server(server, thread):
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_worker_pool_serves_connections_in_turn():
+    server, thread = _start_pooled_server(max_workers=2)
+    request = b'GET /accessories HTTP/1.1\r\n\r\n'
+    clients = [socket.create_connection(server.server_address) for _ in range(5)]
+    try:
+        for client in clients:
+            client.sendall(request * 3)
+        for client in clients:
+            client.settimeout(5)
+            data = b''
+            while data.count(b' 401 ') < 3:
+                chunk = client.recv(4096)
+                assert chunk
+                data += chunk
+        assert len(server.connections) == 5
+    finally:
+        for client in clients:
+            client.close()
+        workers = list(server.workers)
+        _stop_server(server, thread)
+    assert len(workers) == 2
+    assert not any(worker.is_alive() for worker in workers)
+    assert not server.connections
+
+
+def test_worker_pool_rejects_when_accept_queue_is_full():
+    server, thread = _start_pooled_server(max_workers=1, accept_queue_size=1)
+    blocker = threading.Event()
+    server.ready.put(blocker.wait)  # keep the only worker busy
+    clients = []
+    try:
+        clients = [socket.create_connection(server.server_address) for _ in range(2)]
+        clients[1].settimeout(5)
+        assert clients[1].recv(1) == b''
+        assert server.accepting == 1
+        blocker.set()
+        clients[0].sendall(b'GET /accessories HTTP/1.1\r\n\r\n')
+        clients[0].settimeout(5)
+        assert b' 401 ' in clients[0].recv(4096)
+    finally:
+        blocker.set()
+        for client in clients:
+            client.close()
+        _stop_server(server, thread)
+
+
+def test_worker_pool_closes_stalled_requests():
+    server, thread = _start_pooled_server(max_workers=2)
+    stalled = []
+    try:
+        with patch.object(hap_server.PooledHAPServerHandler, 'REQUEST_TIMEOUT', 0.2):
+            stalled = [socket.create_connection(server.server_address)
+                       for _ in range(2)]
+            stalled[0].sendall(b'GET /acc')
+            # Drips a request a byte at a time, each well within the timeout.
+            request = b'GET /accessories HTTP/1.1\r\n\r\n'
+            stalled[1].settimeout(0.05)
+            closed = False
+            for byte in request:
+                try:
+                    stalled[1].sendall(bytes((byte,)))
+                    closed = stalled[1].recv(4096) == b''
+                except socket.timeout:
+                    continue
+                except OSError:
+                    closed = True
+                break
+            assert closed, "the whole request was dripped"
+            client = socket.create_connection(server.server_address)
+            stalled.append(client)
+            client.sendall(request)
+            client.settimeout(5)
+            assert b' 401 ' in client.recv(4096)
+            stalled[0].settimeout(5)
+            assert stalled[0].recv(4096) == b''
+    finally:
+        for client in stalled:
+            client.close()
+        _stop_server(server, thread)
+
+
+def test_worker_pool_unblocks_upgraded_connection():
+    handler = hap_server.PooledHAPServerHandler.__new__(
+        hap_server.PooledHAPServerHandler)
+    handler.connection = plain = MagicMock()
+    handler.rfile = plain_rfile = MagicMock()
+    handler.is_encrypted = False
+    encrypted = MagicMock()
+    handler.close_connection = False
+
+    def upgrade():
+        assert plain_rfile.raw.deadline > time.monotonic()
+        handler.connection = encrypted
+        handler.rfile = MagicMock()
+        handler.is_encrypted = True
+
+    handler.handle_one_request = upgrade
+    assert handler.handle_next()
+    plain.settimeout.assert_not_called()
+    encrypted.settimeout.assert_called_once_with(None)
+    assert handler.rfile.raw.deadline is None
+    assert encrypted.read_deadline is None
+
+
+def test_push_event_in_worker_pool():
+    server, thread = _start_pooled_server(max_workers=1)
+    client = socket.create_connection(server.server_address)
+    try:
+        client.sendall(b'GET /accessories HTTP/1.1\r\n\r\n')
+        client.settimeout(5)
+        assert b' 401 ' in client.recv(4096)
+        client_addr = client.getsockname()
+        threads = threading.active_count()
+        assert server.push_event(b'{}', client_addr)
+        assert server.connections.attached[client_addr].thread is None
+        assert threading.active_count() == threads
+        assert _recv_exactly(client, 77).startswith(b'EVENT/1.0 200 OK\r\n')
+    finally:
+        client.close()
+        _stop_server(server, thread)
+
+
+def test_push_event_uses_writer_per_client():
+    driver = MagicMock()
+    server = hap_server.HAPServer(('127.0.0.1', 0), driver)
+    sock, client = socket.socketpair()
+    client_addr = ('127.0.0.1', 5555)
+    try:
+        assert not server.push_event(b'{}', client_addr)
+        server.connections.add(client_addr, sock)
+        assert server.push_event(b'{}', client_addr)
+        client.settimeout(5)
+        data = _recv_exactly(client, 77)
+        assert data.startswith(b'EVENT/1.0 200 OK\r\n')
+        assert data.endswith(b'\r\n\r\n{}')
+        assert server.event_queue_depths() == {client_addr: 0}
+
+        writer = server.connections.attached[client_addr]
+        server._remove_connection(client_addr)
+        writer.thread.join(5)
+        assert not writer.thread.is_alive()
+        assert not server.connections.attached
+        driver.unsubscribe_client.assert_called_once_with(client_addr)
+    finally:
+        server.server_close()
+        client.close()
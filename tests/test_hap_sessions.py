@@ -0,0 +1,66 @@
+"""Tests for pyhap.hap_sessions."""
+import uuid
+from unittest.mock import patch
+
+from pyhap import hap_sessions
+
+CLIENT_UUID = uuid.uuid4()
+
+
+def test_lru_and_pop_once():
+    cache = hap_sessions.SessionCache(max_sessions=2)
+    cache.add(b'1', b'secret1', CLIENT_UUID)
+    cache.add(b'2', b'secret2', CLIENT_UUID)
+    cache.add(b'1', b'secret1', CLIENT_UUID)  # now most recently used
+    cache.add(b'3', b'secret3', CLIENT_UUID)
+    assert len(cache) == 2
+    assert cache.pop(b'2') is None
+    assert cache.pop(b'1') == (b'secret1', CLIENT_UUID)
+    assert cache.pop(b'1') is None
+
+
+def test_get_keeps_session():
+    cache = hap_sessions.SessionCache(ttl=10)
+    with patch('pyhap.hap_sessions.time.monotonic', return_value=100):
+        cache.add(b'1', b'secret', CLIENT_UUID)
+        assert cache.get(b'1') == (b'secret', CLIENT_UUID)
+        assert cache.get(b'2') is None
+    assert len(cache) == 1
+    with patch('pyhap.hap_sessions.time.monotonic', return_value=110.1):
+        assert cache.get(b'1') is None
+
+
+def test_expiry():
+    cache = hap_sessions.SessionCache(ttl=10)
+    with patch('pyhap.hap_sessions.time.monotonic', return_value=100):
+        cache.add(b'1', b'secret', CLIENT_UUID)
+        cache.add(b'2', b'secret', CLIENT_UUID)
+    with patch('pyhap.hap_sessions.time.monotonic', return_value=110):
+        assert cache.pop(b'1') is not None
+    with patch('pyhap.hap_sessions.time.monotonic', return_value=110.1):
+        assert cache.pop(b'2') is None
+
+
+def test_remove_client():
+    cache = hap_sessions.SessionCache()
+    other_uuid = uuid.uuid4()
+    cache.add(b'1', b'secret', CLIENT_UUID)
+    cache.add(b'2', b'secret', other_uuid)
+    cache.remove_client(CLIENT_UUID)
+    assert cache.pop(b'1') is None
+    assert cache.pop(b'2') == (b'secret', other_uuid)
+
+
+def test_stats():
+    cache = hap_sessions.SessionCache()
+    assert cache.stats()['hit_rate'] == 0
+    cache.record_full_verify(0.03)
+    cache.record_full_verify(0.01)
+    cache.record_resume(True, 0.001)
+    cache.record_resume(True, 0.001)
+    cache.record_resume(False)
+    cache.record_resume(False)
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['misses'] == 2
+    assert stats['hit_rate'] == 0.5
+    assert abs(stats['time_saved'] - 0.038) < 1e-9
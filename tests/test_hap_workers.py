@@ -0,0 +1,40 @@
+"""Tests for pyhap.hap_workers."""
+import os
+
+import ed25519
+
+import pyhap.hap_crypto as hap_crypto
+from pyhap import hap_workers
+from pyhap.util import long_to_bytes
+
+
+def test_pair_verify_exchange():
+    provider = hap_crypto.get_provider()
+    client_private, client_public = provider.x25519_generate()
+    public_key, shared_key = hap_workers.pair_verify_exchange(provider.name,
+                                                              client_public)
+    assert provider.x25519_exchange(client_private, public_key) == shared_key
+
+
+def test_ed25519_verify():
+    provider = hap_crypto.get_provider()
+    signing_key, verifying_key = ed25519.create_keypair()
+    signature = provider.ed25519_sign(signing_key, b'data')
+    assert hap_workers.ed25519_verify(provider.name, verifying_key.to_bytes(),
+                                      signature, b'data')
+    assert not hap_workers.ed25519_verify(provider.name, verifying_key.to_bytes(),
+                                          signature, b'other data')
+
+
+def test_process_pool():
+    pool = hap_workers.CryptoProcessPool(1)
+    try:
+        verifier = pool.run(hap_workers.create_srp_verifier, b'123-45-678')
+        A = long_to_bytes(pow(verifier.ctx['g'], 12345, verifier.ctx['N']))
+        premaster_secret = pool.run(hap_workers.srp_premaster_secret, verifier, A)
+        verifier.set_A(A, premaster_secret)
+        assert verifier.S == verifier.derive_premaster_secret()
+        assert pool.submit(hap_workers.pair_verify_exchange,
+                           hap_crypto.get_provider().name, os.urandom(32)).result()
+    finally:
+        pool.shutdown()
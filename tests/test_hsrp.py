@@ -0,0 +1,54 @@
+"""Tests for pyhap.hsrp."""
+import hashlib
+
+import pytest
+
+from pyhap import hsrp
+from pyhap.params import get_srp_context
+from pyhap.util import long_to_bytes
+
+
+@pytest.fixture
+def ctx():
+    return get_srp_context(3072, hashlib.sha512, 16)
+
+
+def test_long_to_bytes():
+    assert long_to_bytes(0) == b''
+    assert long_to_bytes(1) == b'\x01'
+    assert long_to_bytes(0x1ff) == b'\x01\xff'
+    assert hsrp.bytes_to_long(long_to_bytes(2 ** 3071 + 5)) == 2 ** 3071 + 5
+
+
+def test_context_constants(ctx):
+    assert get_srp_context(3072, hashlib.sha512, 16) is ctx
+    uncached = {key: ctx[key] for key in ('N', 'g', 'hashfunc', 'N_len', 'salt_len')}
+    assert hsrp.get_k(uncached) == ctx['k']
+    assert hsrp.get_group_hash(uncached) == ctx['group_hash']
+
+
+def test_modpow():
+    assert hsrp.modpow(3, 2 ** 200 + 1, 2 ** 255 - 19) \
+        == pow(3, 2 ** 200 + 1, 2 ** 255 - 19)
+    assert isinstance(hsrp.modpow(3, 5, 7), int)
+
+
+def test_session_key_agreement(ctx):
+    server = hsrp.Server(ctx, b'Pair-Setup', b'123-45-678')
+    salt, B = server.get_challenge()
+    N, g = ctx['N'], ctx['g']
+    a = 123456789
+    A = pow(g, a, N)
+    x = hsrp.get_x(b'Pair-Setup', b'123-45-678', salt, ctx)
+    u = hsrp.bytes_to_long(hashlib.sha512(
+        hsrp.padN(long_to_bytes(A), ctx) + hsrp.padN(long_to_bytes(B), ctx)).digest())
+    S = pow((B - ctx['k'] * pow(g, x, N)) % N, a + u * x, N)
+    server.set_A(long_to_bytes(A))
+    assert server.get_session_key() == hsrp.get_session_key(S, ctx)
+
+
+@pytest.mark.parametrize('A', [0, 1])
+def test_set_A_rejects_zero(ctx, A):
+    server = hsrp.Server(ctx, b'Pair-Setup', b'123-45-678')
+    with pytest.raises(ValueError):
+        server.set_A(long_to_bytes(A * ctx['N']))
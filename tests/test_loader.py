@@ -2,7 +2,9 @@
 import pytest
 
 from pyhap import CHARACTERISTICS_FILE, SERVICES_FILE
-from pyhap.characteristic import Characteristic
+from pyhap.characteristic import (
+    EVENT_PRIORITY_HIGH, EVENT_PRIORITY_LOW, PROP_PRIORITY, PROP_STATELESS,
+    Characteristic)
 from pyhap.service import Service
 from pyhap.loader import get_loader, Loader
 
@@ -77,3 +79,29 @@ def test_get_loader():
     assert loader.serv_types == loader2.serv_types
 
     assert get_loader() == loader
+
+
+def test_loader_event_priorities():
+    """Test that the loader sets the default event priorities."""
+    loader = Loader()
+    assert set(loader.char_priorities) <= set(loader.char_types)
+    assert set(loader.serv_priorities) <= set(loader.serv_types)
+
+    assert loader.get_char('MotionDetected').properties[PROP_PRIORITY] \
+        == EVENT_PRIORITY_HIGH
+    assert loader.get_char('CurrentTemperature').properties[PROP_PRIORITY] \
+        == EVENT_PRIORITY_LOW
+    assert PROP_PRIORITY not in loader.get_char('On').properties
+    assert PROP_PRIORITY not in loader.char_types['MotionDetected']
+
+    security = loader.get_service('SecuritySystem')
+    assert all(char.properties[PROP_PRIORITY] == EVENT_PRIORITY_HIGH
+               for char in security.characteristics)
+
+
+def test_loader_stateless_chars():
+    """Test that the loader marks the stateless characteristics."""
+    loader = Loader()
+    assert loader.stateless_chars <= set(loader.char_types)
+    assert loader.get_char('ProgrammableSwitchEvent').properties[PROP_STATELESS]
+    assert PROP_STATELESS not in loader.get_char('On').properties